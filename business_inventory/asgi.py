@@ -3,6 +3,25 @@ ASGI config for business_inventory project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Deployment profile: the read-heavy JSON endpoints (get_unpaid_bills,
+search, analytics/data and the analytics dashboard) are async views, so a
+slow PDF or report request no longer holds the worker that field staff's
+lookups are waiting for. Run it with uvicorn:
+
+    uvicorn business_inventory.asgi:application --workers 2 --host 0.0.0.0 --port 8000
+
+or under gunicorn's process manager:
+
+    gunicorn business_inventory.asgi:application -k uvicorn.workers.UvicornWorker --workers 2 --bind 0.0.0.0:8000
+
+Sync views keep working, each request in its own thread. Connections made
+from those threads are not reused by later requests, so database
+connections are closed after each request (CONN_MAX_AGE=0 unless set); on
+PostgreSQL put PgBouncer in front of the database (POSTGRES_POOLER=pgbouncer).
+PDF batches, statements and reports are better queued as background jobs
+(manage.py run_worker). `manage.py load_test --compare` measures this
+profile against the WSGI one under mixed load.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -12,5 +31,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'business_inventory.settings')
+os.environ.setdefault('CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
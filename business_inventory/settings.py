@@ -46,6 +46,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'inventory.middleware.RequestProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -73,12 +74,142 @@ WSGI_APPLICATION = 'business_inventory.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
+#
+# SQLite by default. Set DB_ENGINE=postgres (and the POSTGRES_* variables) to
+# run on PostgreSQL, which needs psycopg 3 (see requirements.txt). A
+# throwaway local instance for tests and benchmarks:
+#
+#   docker run --rm -e POSTGRES_PASSWORD=postgres -p 5432:5432 postgres:16
+#   DB_ENGINE=postgres python manage.py test
+#
+# Move existing data over with `manage.py migrate_sqlite_to_postgres`.
+#
+# Connections are kept open between requests (CONN_MAX_AGE), so each worker
+# thread holds one pooled connection. When many workers share PostgreSQL put
+# PgBouncer in transaction mode in front of it, point POSTGRES_HOST/PORT at
+# it and set POSTGRES_POOLER=pgbouncer.
+#
+# Every new SQLite connection gets the pragmas from inventory/db.py (WAL
+# journal, synchronous=NORMAL, busy timeout, mmap and page cache), override
+# them in SQLITE_PRAGMAS. Ledger writes start with BEGIN IMMEDIATE so
+# concurrent writers wait for the lock instead of failing with "database is
+# locked".
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'business_inventory'),
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', 'postgres'),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', '600')),
+            'CONN_HEALTH_CHECKS': True,
+            # Server side cursors do not survive PgBouncer's transaction pooling
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('POSTGRES_POOLER') == 'pgbouncer',
+            'OPTIONS': {
+                'connect_timeout': 10,
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', '600')),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                # Seconds sqlite3 waits for a lock, matches busy_timeout
+                'timeout': 20,
+            },
+        }
+    }
+
+SQLITE_PRAGMAS = {}
+SQLITE_IMMEDIATE_TRANSACTIONS = True
+
 
-DATABASES = {
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+#
+# The analytics dashboard caches its widgets in the "analytics" cache. The
+# file based backend is shared between worker processes so invalidation on
+# writes reaches all of them; for a single process
+# 'django.core.cache.backends.locmem.LocMemCache' works as well, and
+# 'django.core.cache.backends.db.DatabaseCache' keeps it in SQLite
+# (run `manage.py createcachetable` first).
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'analytics': {
+        'BACKEND': os.environ.get('ANALYTICS_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('ANALYTICS_CACHE_LOCATION', os.path.join(BASE_DIR, 'cache', 'analytics')),
+        # Holds a ledger version per dukandaar besides the widgets, far more than the default 300 entries
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('ANALYTICS_CACHE_MAX_ENTRIES', 20000))},
+    },
+    'profiling': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'profiling'),
+    },
+}
+
+ANALYTICS_CACHE_ALIAS = 'analytics'
+
+# Per widget TTL overrides in seconds, see inventory/cache.py for the defaults
+ANALYTICS_CACHE_TTLS = {}
+
+# Threads computing dashboard widgets concurrently, per worker process; each keeps
+# its own database connection like a request thread
+ANALYTICS_WIDGET_THREADS = 4
+
+# Shared cache holding the version of the in-memory search index (inventory/search.py),
+# so a save in one worker process makes the others rebuild theirs
+SEARCH_INDEX_CACHE_ALIAS = 'analytics'
+
+# Reorder suggestions: sales velocity is averaged over the last REORDER_WINDOW_DAYS; a product
+# is due when its stock covers less than the supplier lead time, and the suggested order
+# covers the lead time plus REORDER_COVER_DAYS
+REORDER_WINDOW_DAYS = 30
+REORDER_LEAD_DAYS = 7
+REORDER_COVER_DAYS = 14
+
+
+# Request profiling
+# inventory.middleware.RequestProfilingMiddleware records query counts, DB time,
+# slowest and repeated statements for a sample of requests. It does not need
+# DEBUG; staff can also profile a single request by adding ?_profile=1.
+
+REQUEST_PROFILING_ENABLED = os.environ.get('REQUEST_PROFILING_ENABLED', '') == '1'
+REQUEST_PROFILING_SAMPLE_RATE = float(os.environ.get('REQUEST_PROFILING_SAMPLE_RATE', '0.1'))
+REQUEST_PROFILING_SLOW_MS = 500
+REQUEST_PROFILING_CACHE_ALIAS = 'profiling'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'plain': {
+            'format': '%(asctime)s %(levelname)s %(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'plain',
+        },
+    },
+    'loggers': {
+        'inventory': {
+            'handlers': ['console'],
+            'level': os.environ.get('INVENTORY_LOG_LEVEL', 'INFO'),
+        },
+    },
 }
 
 
@@ -127,6 +258,29 @@ MEDIA_ROOT=os.path.join(BASE_DIR,'media')
 
 MEDIA_URL='/media/'
 
+# Rendered bill PDFs, keyed by bill id and a hash of its rows, deleted by run_worker
+# once unused for BILL_PDF_CACHE_DAYS days
+BILL_PDF_CACHE_DIR = os.path.join(MEDIA_ROOT, 'bill_pdfs')
+BILL_PDF_CACHE_DAYS = 30
+
+# Worker processes used to render bills for batch printing, for batches of at least
+# BILL_PDF_POOL_MIN_BILLS bills; smaller ones are rendered in process, as starting the
+# workers costs more than rendering them
+BILL_PDF_PROCESSES = min(4, os.cpu_count() or 1)
+BILL_PDF_POOL_MIN_BILLS = 40
+
+# Collection route sheets written each morning by `manage.py generate_route_sheets`
+ROUTE_SHEET_DIR = os.path.join(MEDIA_ROOT, 'route_sheets')
+
+# Background jobs (inventory/jobs.py), run by `manage.py run_worker`: files written by jobs,
+# threads per worker, first retry delay in seconds (doubled on each attempt), seconds after
+# which a running job is considered abandoned, and days finished jobs are kept
+JOB_RESULT_DIR = os.path.join(MEDIA_ROOT, 'jobs')
+JOB_WORKER_THREADS = 2
+JOB_RETRY_DELAY = 30
+JOB_TIMEOUT = 3600
+JOB_RESULT_DAYS = 7
+
 # Add STATICFILES_DIRS for custom static files during development
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),  # Add this directory for your custom static files
@@ -3,16 +3,66 @@ from io import StringIO
 from django.contrib import admin
 
 from .forms import PurchaseOrderAdminForm, BillAdminForm, DailyCollectionForm
-from .models import Company, Product, Dukandaar, Bill, DailyCollection, Item, PurchaseItem, PurchaseOrder, Area, CompanyPayment
+from .models import Company, Product, Dukandaar, Bill, DailyCollection, Item, PurchaseItem, PurchaseOrder, Area, CompanyPayment, StockMovement, Job
 from django.utils.html import format_html
 from django.urls import reverse
 from django.contrib.admin import DateFieldListFilter
+from django.contrib.admin.options import IncorrectLookupParameters
+from .ledger import BillLine, post_bill
+from .exports import get_export_queryset, stream_csv
+from django.core.exceptions import PermissionDenied
+from django.urls import path
+from django.http import HttpResponse, HttpResponseBadRequest
+from .pdf import render_bills_batch
+from .utils import DukandaarListFilter, EstimatedCountPaginator
+from .search import search_ids
+from .jobs import submit
 
 # Customizing the admin site titles (optional)
 admin.site.site_header = "Neelkamal Admin"
 admin.site.site_title = "Neelkamal Administration"
 admin.site.index_title = "Manage Inventory and Bills"
 
+class ExportCsvMixin:
+    """Streams the changelist, with its current filters, or the selected rows as CSV."""
+    export_name = None
+    change_list_template = 'admin/inventory/export_change_list.html'
+    actions = ['export_as_csv']
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path('export/', self.admin_site.admin_view(self.export_view), name='%s_%s_export' % info),
+        ] + super().get_urls()
+
+    def export_view(self, request):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        try:
+            # Filters are validated by the changelist's own filter specs
+            changelist = self.get_changelist_instance(request)
+        except IncorrectLookupParameters as error:
+            return HttpResponseBadRequest(f'Invalid filter: {error}')
+        queryset = get_export_queryset(self.export_name, changelist.get_queryset(request))
+        return stream_csv(self.export_name, queryset, f'{self.export_name}.csv')
+
+    @admin.action(description='Export selected to CSV')
+    def export_as_csv(self, request, queryset):
+        return stream_csv(self.export_name, get_export_queryset(self.export_name, queryset), f'{self.export_name}.csv')
+
+class IndexedSearchMixin:
+    """
+    Answers changelist and autocomplete searches from the in-memory name index
+    (see search.py): every row whose name contains each word of the search, as
+    the default search on name would find, without scanning the table.
+    """
+    search_index = None
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        return queryset.filter(pk__in=search_ids(self.search_index, search_term)), False
+
 class PurchaseItemInLine(admin.TabularInline):
     model = PurchaseItem
     extra = 1
@@ -28,12 +78,16 @@ class BillInline(admin.TabularInline):
 class AreaAdmin(admin.ModelAdmin):
     list_display = ['area_name', 'city_name']
 
-class DailyCollectionAdmin(admin.ModelAdmin):
+class DailyCollectionAdmin(ExportCsvMixin, admin.ModelAdmin):
+    export_name = 'collections'
     list_display = ['collection_time', 'dukandaar', 'amount_collected', 'pending_amount_as_of_today']
+    list_select_related = ['dukandaar__area']
     list_filter = [
         ('collection_time', DateFieldListFilter),  # Filters by date, with day, month, and year options
-        'dukandaar',
+        ('dukandaar', DukandaarListFilter),
     ]
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
     autocomplete_fields = ['dukandaar']
     search_fields = ['dukandaar__name', 'collection_time']
     change_form_template = 'admin/inventory/change_form.html'
@@ -46,18 +100,37 @@ class DailyCollectionAdmin(admin.ModelAdmin):
             'admin/js/dukandaar_bill_filter.js',
         )
 
-class DukandaarAdmin(admin.ModelAdmin):
+class DukandaarAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    search_index = 'dukandaar'
     inlines = [BillInline]
-    list_display = ('name', 'contact_info', 'pending_amount')
+    list_display = ('name', 'contact_info', 'pending_amount', 'statement_field')
     search_fields = ['name']
     list_filter = [
         'area',
     ]
 
+    def get_queryset(self, request):
+        # Autocomplete renders each result with __str__, which includes the area
+        return super().get_queryset(request).select_related('area')
+
+    @admin.display(description='Statement')
+    def statement_field(self, obj):
+        return format_html(
+            '<a href="{}" target="_blank"><button type="button">Statement</button></a>',
+            reverse('dukandaar_statement_pdf', args=[obj.id])
+        )
+
 class ItemAdmin(admin.ModelAdmin):
     fields = ['product', 'kg', 'price_per_kg', 'amount']
     list_display = ['product', 'kg', 'price_per_kg', 'amount']
+    list_select_related = ['product']
     autocomplete_fields = ['product']
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+
+    def get_queryset(self, request):
+        # Item.__str__ walks the bill, its dukandaar and area
+        return super().get_queryset(request).select_related('product', 'bill__dukandaar__area')
 
     def has_change_permission(self, request, obj=None):
         # Only allow creating new Bill objects, not changing existing ones
@@ -66,25 +139,45 @@ class ItemAdmin(admin.ModelAdmin):
     def has_add_permission(self, request, obj=None):
         return False
 
-class ProductAdmin(admin.ModelAdmin):
+    def delete_queryset(self, request, queryset):
+        # One at a time, so each line is taken off its bill, the shop, stock and the rollup
+        for item in queryset:
+            item.delete()
+
+class ProductAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    search_index = 'product'
     search_fields = ['name']
-    list_display = ['name', 'stock_in_kg', 'stock_in_bora']
+    list_display = ['name', 'stock_in_kg', 'stock_in_bora', 'average_cost']
+
+    def save_model(self, request, obj, form, change):
+        # Stock entered by hand is journalled: the opening stock of a new product, an adjustment otherwise
+        if 'stock_in_kg' not in form.changed_data:
+            return super().save_model(request, obj, form, change)
+        counted = obj.stock_in_kg
+        obj.stock_in_kg = Product.objects.values_list('stock_in_kg', flat=True).get(pk=obj.pk) if change else 0
+        super().save_model(request, obj, form, change)
+        StockMovement.record(obj, StockMovement.ADJUSTMENT if change else StockMovement.OPENING,
+                             counted - obj.stock_in_kg)
 
     def has_delete_permission(self, request, obj=None):
         # Only allow creating new Bill objects, not deleting existing ones
         return False
 
-class BillAdmin(admin.ModelAdmin):
+class BillAdmin(ExportCsvMixin, admin.ModelAdmin):
+    export_name = 'bills'
     inlines = [ItemInLine]
     form = BillAdminForm
     list_display = ['id', 'date', 'dukandaar', 'total_amount', 'paid', 'print_field']
+    list_select_related = ['dukandaar__area']
     # Use autocomplete for the Dukandaar foreign key
     autocomplete_fields = ['dukandaar']
     list_filter = [
         ('date', DateFieldListFilter),
-        'dukandaar',
+        ('dukandaar', DukandaarListFilter),
         'paid'
     ]
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
     search_fields = ['dukandaar__name', 'date']
 
     class Media:
@@ -97,17 +190,53 @@ class BillAdmin(admin.ModelAdmin):
             print_url
         )
 
+    actions = ExportCsvMixin.actions + ['print_selected', 'print_selected_in_background']
+
+    @admin.action(description='Print selected bills')
+    def print_selected(self, request, queryset):
+        pdf = render_bills_batch(queryset.order_by('id').values_list('id', flat=True))
+        response = HttpResponse(pdf, content_type='application/pdf')
+        response['Content-Disposition'] = 'inline; filename="bills.pdf"'
+        return response
+
+    @admin.action(description='Print selected bills in the background')
+    def print_selected_in_background(self, request, queryset):
+        job = submit('bills_pdf', request.user, bill_ids=list(queryset.order_by('id').values_list('id', flat=True)))
+        self.message_user(request, format_html(
+            'Printing {} bills as job {}. <a href="{}">Check its status</a>',
+            len(job.kwargs['bill_ids']), job.id, reverse('job_status', args=[job.id])
+        ))
+
     def save_model(self, request, obj, form, change):
         super().save_model(request, obj, form, change)
 
+    def save_formset(self, request, form, formset, change):
+        if formset.model is not Item:
+            return super().save_formset(request, form, formset, change)
+
+        # Post all new lines of the bill in one batch instead of one Item.save() each
+        instances = formset.save(commit=False)
+        for obj in formset.deleted_objects:
+            obj.delete()
+        lines = [BillLine(item.product, item.bora, item.kg, item.price_per_kg)
+                 for item in instances if item.pk is None]
+        formset.new_objects = post_bill(form.instance.dukandaar, lines, bill=form.instance)
+        for item in instances:
+            if item.pk is not None:
+                item.save()
+        formset.save_m2m()
+
     def has_change_permission(self, request, obj=None):
         # Only allow creating new Bill objects, not changing existing ones
         return False
 
 
-class PurchaseOrderAdmin(admin.ModelAdmin):
+class PurchaseOrderAdmin(ExportCsvMixin, admin.ModelAdmin):
+    export_name = 'purchases'
     inlines = [PurchaseItemInLine]
     form = PurchaseOrderAdminForm
+    list_select_related = ['company']
+    show_full_result_count = False
 
 
 class CompanyAdmin(admin.ModelAdmin):
@@ -121,7 +250,14 @@ class CompanyPaymentAdmin(admin.ModelAdmin):
 class PurchaseItemAdmin(admin.ModelAdmin):
     fields = ['product', 'bora', 'kg', 'price_per_kg', 'amount']
     list_display = ['product', 'bora', 'kg', 'price_per_kg', 'amount']
+    list_select_related = ['product']
     autocomplete_fields = ['product']
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+
+    def get_queryset(self, request):
+        # PurchaseItem.__str__ walks the purchase order and its company
+        return super().get_queryset(request).select_related('product', 'purchase_order__company')
 
     def has_change_permission(self, request, obj=None):
         # Only allow creating new Bill objects, not changing existing ones
@@ -130,6 +266,38 @@ class PurchaseItemAdmin(admin.ModelAdmin):
     def has_add_permission(self, request, obj=None):
         return False
 
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ['date', 'product', 'kind', 'kg', 'unit_cost', 'value', 'bill', 'purchase_order']
+    list_filter = ['kind', ('date', DateFieldListFilter)]
+    list_select_related = ['product', 'bill__dukandaar__area', 'purchase_order__company']
+    autocomplete_fields = ['product']
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+
+    # The journal is append-only, movements are written by the sale and purchase lines
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'task', 'status', 'attempts', 'submitted_by', 'created_at', 'finished_at']
+    list_filter = ['status', 'task']
+    list_select_related = ['submitted_by']
+    readonly_fields = [field.name for field in Job._meta.fields]
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 admin.site.register(Bill, BillAdmin)
 admin.site.register(Dukandaar, DukandaarAdmin)
 admin.site.register(Product, ProductAdmin)
@@ -140,3 +308,5 @@ admin.site.register(CompanyPayment)
 admin.site.register(Area, AreaAdmin)
 admin.site.register(Company, CompanyAdmin)
 admin.site.register(Item, ItemAdmin)
+admin.site.register(StockMovement, StockMovementAdmin)
+admin.site.register(Job, JobAdmin)
@@ -0,0 +1,278 @@
+"""
+Consistent, incremental backups of the SQLite database.
+
+A snapshot is taken with SQLite's online backup API in a single step: one
+read transaction copies every page, which in WAL mode does not block the
+writers. Copying a few pages per step instead restarts whenever another
+connection writes, so under steady writes it may never finish. Unlike
+VACUUM INTO, it keeps the page layout, so unchanged pages stay in the same
+blocks from one snapshot to the next. The snapshot is
+split into fixed size blocks and compared with the block hashes of the
+previous snapshot: unchanged blocks are not shipped again. A chain starts
+with a full, gzip compressed copy, followed by deltas holding only the
+changed blocks; a new full copy is taken every `full_every` backups.
+
+Files are named so that chains can be grouped without reading them:
+
+    <prefix>-<base stamp>.full.gz
+    <prefix>-<base stamp>-<stamp>.delta.gz
+
+Storage is pluggable, anything with upload/download/list/delete works; see
+LocalDirectoryStorage and GoogleDriveStorage.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import time
+from datetime import datetime
+
+BLOCK_SIZE = 64 * 1024
+DELTA_MAGIC = b'SQLDELTA1'
+STATE_FILE = 'last_backup.json'
+
+
+class BackupError(Exception):
+    pass
+
+
+class LocalDirectoryStorage:
+    """Keeps backups in a local directory, for tests or a mounted disk."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def upload(self, local_path, name):
+        shutil.copyfile(local_path, os.path.join(self.path, name))
+
+    def download(self, name, local_path):
+        shutil.copyfile(os.path.join(self.path, name), local_path)
+
+    def list(self):
+        return sorted(os.listdir(self.path))
+
+    def delete(self, name):
+        os.remove(os.path.join(self.path, name))
+
+
+class GoogleDriveStorage:
+    """Keeps backups in a Google Drive folder, uploading in resumable chunks."""
+
+    def __init__(self, service, folder_id, chunk_size=5 * 1024 * 1024, retries=5):
+        self.service = service
+        self.folder_id = folder_id
+        self.chunk_size = chunk_size
+        self.retries = retries
+
+    def upload(self, local_path, name):
+        from googleapiclient.errors import HttpError
+        from googleapiclient.http import MediaFileUpload
+
+        media = MediaFileUpload(local_path, mimetype='application/octet-stream',
+                                chunksize=self.chunk_size, resumable=True)
+        request = self.service.files().create(
+            body={'name': name, 'parents': [self.folder_id]}, media_body=media, fields='id'
+        )
+        response, failures = None, 0
+        while response is None:
+            try:
+                _, response = request.next_chunk()
+                failures = 0
+            except HttpError as error:
+                # Resume from the last acknowledged chunk on transient errors
+                failures += 1
+                if error.resp.status < 500 or failures > self.retries:
+                    raise
+                time.sleep(2 ** failures)
+
+    def _files(self):
+        page_token = None
+        while True:
+            response = self.service.files().list(
+                q=f"'{self.folder_id}' in parents and trashed = false",
+                fields='nextPageToken, files(id, name)', pageToken=page_token,
+            ).execute()
+            yield from response.get('files', [])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    def _file_id(self, name):
+        for file in self._files():
+            if file['name'] == name:
+                return file['id']
+        raise BackupError(f'{name} not found in Drive folder')
+
+    def download(self, name, local_path):
+        from googleapiclient.http import MediaIoBaseDownload
+
+        request = self.service.files().get_media(fileId=self._file_id(name))
+        with open(local_path, 'wb') as local_file:
+            downloader = MediaIoBaseDownload(local_file, request, chunksize=self.chunk_size)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+
+    def list(self):
+        return sorted(file['name'] for file in self._files())
+
+    def delete(self, name):
+        self.service.files().delete(fileId=self._file_id(name)).execute()
+
+
+def snapshot(db_path, dest_path):
+    """Consistent copy of a live database, every page in one step of the online backup API."""
+    source = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    destination = sqlite3.connect(dest_path)
+    try:
+        source.backup(destination, pages=-1)
+    finally:
+        destination.close()
+        source.close()
+
+
+def block_hashes(path, block_size=BLOCK_SIZE):
+    hashes = []
+    with open(path, 'rb') as snapshot_file:
+        for block in iter(lambda: snapshot_file.read(block_size), b''):
+            hashes.append(hashlib.sha256(block).hexdigest())
+    return hashes
+
+
+def write_full(snapshot_path, dest_path):
+    with open(snapshot_path, 'rb') as source, gzip.open(dest_path, 'wb') as destination:
+        shutil.copyfileobj(source, destination, BLOCK_SIZE)
+
+
+def write_delta(snapshot_path, dest_path, changed, block_size=BLOCK_SIZE):
+    size = os.path.getsize(snapshot_path)
+    with open(snapshot_path, 'rb') as source, gzip.open(dest_path, 'wb') as destination:
+        destination.write(DELTA_MAGIC + struct.pack('>QI', size, block_size))
+        for index in changed:
+            source.seek(index * block_size)
+            block = source.read(block_size)
+            destination.write(struct.pack('>II', index, len(block)) + block)
+
+
+def apply_delta(delta_path, db_file):
+    with gzip.open(delta_path, 'rb') as delta:
+        header = delta.read(len(DELTA_MAGIC) + 12)
+        if not header.startswith(DELTA_MAGIC):
+            raise BackupError(f'{delta_path} is not a delta backup')
+        size, block_size = struct.unpack('>QI', header[len(DELTA_MAGIC):])
+        while True:
+            record = delta.read(8)
+            if not record:
+                break
+            index, length = struct.unpack('>II', record)
+            db_file.seek(index * block_size)
+            db_file.write(delta.read(length))
+        db_file.truncate(size)
+
+
+def make_backup(db_path, storage, state_dir, prefix='db', full_every=7, keep_chains=4):
+    """
+    Snapshot db_path and ship it to storage, as a delta against the previous
+    snapshot when possible. Returns the name of the uploaded file.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    state_path = os.path.join(state_dir, STATE_FILE)
+    try:
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    except (FileNotFoundError, ValueError):
+        state = None
+
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S%f')
+    with tempfile.TemporaryDirectory() as work_dir:
+        snapshot_path = os.path.join(work_dir, 'snapshot.sqlite3')
+        snapshot(db_path, snapshot_path)
+        hashes = block_hashes(snapshot_path)
+
+        full = (state is None or state['chain_length'] >= full_every
+                or state.get('block_size') != BLOCK_SIZE
+                or f"{prefix}-{state['base']}.full.gz" not in storage.list())
+        if full:
+            base = stamp
+            name = f'{prefix}-{base}.full.gz'
+            write_full(snapshot_path, os.path.join(work_dir, name))
+            chain_length = 1
+        else:
+            base = state['base']
+            previous = state['hashes']
+            changed = [index for index, digest in enumerate(hashes)
+                       if index >= len(previous) or previous[index] != digest]
+            name = f'{prefix}-{base}-{stamp}.delta.gz'
+            write_delta(snapshot_path, os.path.join(work_dir, name), changed)
+            chain_length = state['chain_length'] + 1
+
+        storage.upload(os.path.join(work_dir, name), name)
+
+    with open(state_path, 'w') as state_file:
+        json.dump({
+            'base': base,
+            'chain_length': chain_length,
+            'block_size': BLOCK_SIZE,
+            'hashes': hashes,
+        }, state_file)
+
+    apply_retention(storage, prefix, keep_chains)
+    return name
+
+
+def chains(storage, prefix='db'):
+    """{base stamp: [full name, delta names in order]} for the backups in storage."""
+    result = {}
+    for name in storage.list():
+        if not name.startswith(prefix + '-'):
+            continue
+        parts = name[len(prefix) + 1:].split('.')[0].split('-')
+        base = '-'.join(parts[:2])
+        result.setdefault(base, []).append(name)
+    for names in result.values():
+        names.sort(key=lambda name: (not name.endswith('.full.gz'), name))
+    return result
+
+
+def apply_retention(storage, prefix='db', keep_chains=4):
+    """Delete all but the newest keep_chains full backups and their deltas."""
+    all_chains = chains(storage, prefix)
+    for base in sorted(all_chains)[:-keep_chains]:
+        for name in all_chains[base]:
+            storage.delete(name)
+
+
+def restore(storage, dest_path, name=None, prefix='db'):
+    """
+    Rebuild the database as of backup `name` (the newest one by default) by
+    applying the deltas of its chain on top of the full copy.
+    """
+    all_chains = chains(storage, prefix)
+    if not all_chains:
+        raise BackupError('No backups found')
+    if name is None:
+        names = all_chains[max(all_chains)]
+    else:
+        names = next((chain for chain in all_chains.values() if name in chain), None)
+        if names is None:
+            raise BackupError(f'{name} not found')
+        names = names[:names.index(name) + 1]
+    if not names[0].endswith('.full.gz'):
+        raise BackupError(f'Full backup of the chain of {names[-1]} is missing')
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        full_path = os.path.join(work_dir, names[0])
+        storage.download(names[0], full_path)
+        with gzip.open(full_path, 'rb') as source, open(dest_path, 'wb') as destination:
+            shutil.copyfileobj(source, destination, BLOCK_SIZE)
+        with open(dest_path, 'r+b') as db_file:
+            for delta_name in names[1:]:
+                delta_path = os.path.join(work_dir, delta_name)
+                storage.download(delta_name, delta_path)
+                apply_delta(delta_path, db_file)
+    return names[-1]
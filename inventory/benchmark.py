@@ -0,0 +1,212 @@
+import os
+import random
+import statistics
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time, timedelta
+from decimal import Decimal
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .ledger import explicit_dates
+from .middleware import QueryRecorder, recording
+from .models import (Area, Company, Product, Dukandaar, Bill, Item, DailyCollection, PurchaseOrder,
+                     PurchaseItem, CompanyPayment)
+
+BATCH_SIZE = 2000
+
+
+def seed_dataset(scale=1, years=3, seed=0, stdout=None):
+    """
+    Generate a synthetic but realistically shaped dataset: at scale 1 that is
+    10 areas, 200 shops, 5 companies, 40 products and roughly 40 bills of 1-8
+    items per day over `years` years, plus weekly purchase orders paid off
+    the following week and collections against about two thirds of the bills.
+
+    Balances (stock, pending amounts, loans) are set from the generated rows
+    and the sales rollup is rebuilt. Returns a dict of row counts.
+    """
+    rng = random.Random(seed)
+    end = date.today()
+    start = end - timedelta(days=365 * years)
+    days = (end - start).days + 1
+
+    with transaction.atomic(), explicit_dates():
+        areas = Area.objects.bulk_create([Area(area_name=f'Area {i}') for i in range(10 * scale)])
+        companies = Company.objects.bulk_create([Company(name=f'Company {i}') for i in range(5)])
+        products = Product.objects.bulk_create([
+            Product(name=f'Product {i}', company=companies[i % len(companies)], one_bora_in_kg=rng.choice([25, 50]))
+            for i in range(40)
+        ])
+        existing = Dukandaar.objects.count()
+        dukandaars = Dukandaar.objects.bulk_create([
+            Dukandaar(name=f'Shop {existing + i}', area=rng.choice(areas)) for i in range(200 * scale)
+        ])
+        prices = {product.pk: Decimal(rng.randint(20, 90)) for product in products}
+
+        counts = {'bills': 0, 'items': 0, 'collections': 0, 'purchase_orders': 0, 'purchase_items': 0,
+                  'company_payments': 0}
+        last_orders = {}
+        bills_per_day = 40 * scale
+        for offset in range(days):
+            day = start + timedelta(days=offset)
+            # Totals are worked out in memory so every row is written exactly once
+            bills = [Bill(dukandaar=rng.choice(dukandaars), date=day)
+                     for _ in range(rng.randint(bills_per_day // 2, bills_per_day))]
+            items, collections = [], []
+            for bill in bills:
+                for product in rng.sample(products, rng.randint(1, 8)):
+                    item = Item(bill=bill, product=product, bora=Decimal(rng.randint(0, 3)),
+                                kg=Decimal(rng.randint(0, 20)), price_per_kg=prices[product.pk])
+                    item.amount = item.calculate_amount()
+                    items.append(item)
+                    bill.total_amount += item.amount
+                bill.pending_amount = bill.total_amount
+                if rng.random() < 0.66:
+                    collections.append(DailyCollection(
+                        dukandaar_id=bill.dukandaar_id, bill=bill, amount_collected=bill.total_amount,
+                        collection_time=timezone.make_aware(datetime.combine(
+                            min(end, day + timedelta(days=rng.randint(0, 20))), dt_time(10))),
+                    ))
+                    bill.pending_amount = 0
+                    bill.paid = True
+            Bill.objects.bulk_create(bills, batch_size=BATCH_SIZE)
+            Item.objects.bulk_create(items, batch_size=BATCH_SIZE)
+            DailyCollection.objects.bulk_create(collections, batch_size=BATCH_SIZE)
+            counts['bills'] += len(bills)
+            counts['items'] += len(items)
+            counts['collections'] += len(collections)
+
+            if day.weekday() == 0:
+                for company in companies:
+                    if company.pk in last_orders:
+                        CompanyPayment.objects.create(company=company, payment_date=day,
+                                                      amount_paid=last_orders[company.pk])
+                        counts['company_payments'] += 1
+                    order = PurchaseOrder.objects.create(company=company, date=day)
+                    purchase_items = []
+                    for product in [p for p in products if p.company_id == company.pk]:
+                        item = PurchaseItem(purchase_order=order, product=product, bora=Decimal(rng.randint(20, 60)),
+                                            kg=Decimal(0), price_per_kg=prices[product.pk] * Decimal('0.85'))
+                        item.amount = item.bora * item.price_per_kg * product.one_bora_in_kg
+                        purchase_items.append(item)
+                        order.total_amount += item.amount
+                    PurchaseItem.objects.bulk_create(purchase_items)
+                    PurchaseOrder.objects.filter(pk=order.pk).update(total_amount=order.total_amount)
+                    last_orders[company.pk] = order.total_amount
+                    counts['purchase_orders'] += 1
+                    counts['purchase_items'] += len(purchase_items)
+
+            if stdout and offset % 90 == 0:
+                stdout.write(f"  {day}: {counts['bills']} bills, {counts['items']} items")
+
+        set_balances_from_rows(dukandaars, companies, products)
+
+    call_command('rebuild_sales_rollup', stdout=stdout or open(os.devnull, 'w'))
+    return counts
+
+
+def set_balances_from_rows(dukandaars, companies, products):
+    pending = dict(Bill.objects.filter(dukandaar__in=dukandaars, paid=False)
+                   .values_list('dukandaar').annotate(Sum('pending_amount')))
+    for dukandaar in dukandaars:
+        dukandaar.pending_amount = pending.get(dukandaar.pk, 0)
+    Dukandaar.objects.bulk_update(dukandaars, ['pending_amount'], batch_size=BATCH_SIZE)
+
+    loans = dict(PurchaseOrder.objects.filter(company__in=companies)
+                 .values_list('company').annotate(Sum('total_amount')))
+    payments = dict(CompanyPayment.objects.filter(company__in=companies)
+                    .values_list('company').annotate(Sum('amount_paid')))
+    for company in companies:
+        company.loan_amount = loans.get(company.pk, 0) - payments.get(company.pk, 0)
+    Company.objects.bulk_update(companies, ['loan_amount'])
+
+    bought = {product_id: (kg, value) for product_id, kg, value in (
+        PurchaseItem.objects.filter(product__in=products).values_list('product')
+        .annotate(kg_bought=Sum(F('kg') + F('bora') * F('product__one_bora_in_kg')), value=Sum('amount')))}
+    sold = dict(Item.objects.filter(product__in=products).values_list('product')
+                .annotate(kg_sold=Sum(F('kg') + F('bora') * F('product__one_bora_in_kg'))))
+    for product in products:
+        kg_bought, value = bought.get(product.pk, (0, 0))
+        product.stock_in_kg = (kg_bought or 0) - (sold.get(product.pk) or 0)
+        if kg_bought:
+            product.average_cost = (Decimal(value) / Decimal(kg_bought)).quantize(Decimal('0.0001'))
+    Product.objects.bulk_update(products, ['stock_in_kg', 'average_cost'])
+
+
+def time_call(func, repeat=5):
+    """Median wall time of func() in milliseconds, after one warm-up call."""
+    func()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def measure(func, repeat=5):
+    """
+    Run func() `repeat` times after a warm-up call and return median and p95
+    wall time in milliseconds plus the number of queries of the last run.
+    Queries are counted like the profiling middleware counts them, so those
+    of the analytics widget threads are included.
+    """
+    func()
+    timings = []
+    for _ in range(repeat):
+        with recording(QueryRecorder()) as queries:
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        'median_ms': round(statistics.median(timings), 2),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+        'queries': len(queries.queries),
+    }
+
+
+class Rollback(Exception):
+    pass
+
+
+def rolled_back(func):
+    """Wrap func so whatever it writes is rolled back, letting write paths be timed repeatedly."""
+    def run():
+        try:
+            with transaction.atomic():
+                func()
+                raise Rollback
+        except Rollback:
+            pass
+    return run
+
+
+@contextmanager
+def benchmark_session(prefix='benchmark'):
+    """
+    Key of a logged in session of a superuser made for the run, so the
+    benchmarks need neither the login form nor a real account. The user and
+    the session are deleted again on exit, whatever database this runs on.
+    """
+    user = User.objects.create_superuser(f'{prefix}-{uuid.uuid4().hex[:8]}')
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    try:
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.set_expiry(3600)
+        session.save()
+        yield session.session_key
+    finally:
+        session.delete()
+        user.delete()
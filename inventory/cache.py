@@ -0,0 +1,157 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections, connection, transaction
+
+from .middleware import record_queries
+
+# Seconds each analytics widget may be served from the cache. Any write to the
+# rows the dashboard reads invalidates everything earlier, see signals.py.
+DEFAULT_ANALYTICS_CACHE_TTLS = {
+    'sales': 60,
+    'revenue': 300,
+    'customer': 3600,
+    'todaysaleslist': 60,
+    'topsellinglist': 300,
+    'sales_data': 300,
+    'spider_data': 600,
+    'products_sold': 600,
+    'ageing': 300,
+}
+
+VERSION_KEY = 'analytics:version'
+STATS_KEY = 'analytics:stats:{}:{}'
+
+
+def get_analytics_cache():
+    return caches[getattr(settings, 'ANALYTICS_CACHE_ALIAS', 'default')]
+
+
+def get_widget_ttl(widget):
+    ttls = {**DEFAULT_ANALYTICS_CACHE_TTLS, **getattr(settings, 'ANALYTICS_CACHE_TTLS', {})}
+    return ttls.get(widget, 60)
+
+
+def _incr(cache, key):
+    # add() is a no-op when the key exists, so counters survive across processes
+    cache.add(key, 0, timeout=None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr()
+        cache.set(key, 1, timeout=None)
+        return 1
+
+
+def _current_version(cache):
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Never a version used before, in case the key was culled: entries cached
+        # under an older version must not become current again
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def get_cached_widget(widget, func, *args, **kwargs):
+    """
+    Return func(*args, **kwargs) from the analytics cache, computing and storing
+    it on a miss. Entries are keyed on the current invalidation version, so
+    bumping the version makes every older entry unreachable.
+    """
+    cache = get_analytics_cache()
+    key = f'analytics:{_current_version(cache)}:{widget}'
+    value = cache.get(key)
+    if value is not None:
+        _incr(cache, STATS_KEY.format(widget, 'hits'))
+        return value
+
+    _incr(cache, STATS_KEY.format(widget, 'misses'))
+    value = func(*args, **kwargs)
+    cache.set(key, value, timeout=get_widget_ttl(widget))
+    return value
+
+
+# Threads of their own rather than the event loop's default pool, so the number of threads, and
+# of the connections they keep open, stays at ANALYTICS_WIDGET_THREADS
+_widget_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'ANALYTICS_WIDGET_THREADS', 4),
+                                      thread_name_prefix='analytics')
+
+
+def _get_cached_widget_in_thread(widget, func):
+    # Pool threads keep their connection between calls; drop it once stale, as a request would.
+    # The thread's queries count towards the request when it is being profiled.
+    close_old_connections()
+    try:
+        with record_queries(connection):
+            return get_cached_widget(widget, func)
+    finally:
+        close_old_connections()
+
+
+async def aget_cached_widgets(widgets):
+    """
+    get_cached_widget for each {name: func}, concurrently on the
+    ANALYTICS_WIDGET_THREADS widget threads, each with its own database
+    connection. Returns {name: value}.
+    """
+    values = await asyncio.gather(*(
+        sync_to_async(_get_cached_widget_in_thread, thread_sensitive=False, executor=_widget_executor)(widget, func)
+        for widget, func in widgets.items()
+    ))
+    return dict(zip(widgets, values))
+
+
+def invalidate_analytics_cache():
+    """Drop all cached widgets once the current transaction commits."""
+    def bump():
+        get_analytics_cache().set(VERSION_KEY, time.time_ns(), timeout=None)
+    transaction.on_commit(bump)
+
+
+def get_analytics_cache_stats():
+    cache = get_analytics_cache()
+    stats = {}
+    for widget in DEFAULT_ANALYTICS_CACHE_TTLS:
+        hits = cache.get(STATS_KEY.format(widget, 'hits'), 0)
+        misses = cache.get(STATS_KEY.format(widget, 'misses'), 0)
+        stats[widget] = {
+            'hits': hits,
+            'misses': misses,
+            'ttl': get_widget_ttl(widget),
+        }
+    return {
+        'version': _current_version(cache),
+        'widgets': stats,
+    }
+
+
+LEDGER_VERSION_KEY = 'ledger:version:{}'
+
+
+async def aget_ledger_versions(dukandaar_ids):
+    """
+    Current version of each shop's bills and collections, and of all of them
+    (key None). Used as ETags: a version changes whenever a bill, item or
+    collection of the shop is written.
+    """
+    cache = get_analytics_cache()
+    keys = {dukandaar_id: LEDGER_VERSION_KEY.format(dukandaar_id) for dukandaar_id in [None, *dukandaar_ids]}
+    found = await cache.aget_many(keys.values())
+    missing = {key: time.time_ns() for key in keys.values() if key not in found}
+    for key, version in missing.items():
+        await cache.aadd(key, version, timeout=None)
+    if missing:
+        found.update(await cache.aget_many(missing))
+    return {dukandaar_id: found.get(key) for dukandaar_id, key in keys.items()}
+
+
+def bump_ledger_version(dukandaar_id=None):
+    """New ledger version for one shop, or for all shops without an id, once the transaction commits."""
+    def bump():
+        get_analytics_cache().set(LEDGER_VERSION_KEY.format(dukandaar_id), time.time_ns(), timeout=None)
+    transaction.on_commit(bump)
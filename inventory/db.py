@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+# Applied to every new SQLite connection, see SQLITE_PRAGMAS in settings
+DEFAULT_SQLITE_PRAGMAS = {
+    # Readers no longer block the writer and the writer no longer blocks readers
+    'journal_mode': 'WAL',
+    # In WAL mode this is still safe against corruption, only the last
+    # transactions before a power loss may be lost
+    'synchronous': 'NORMAL',
+    # Wait for the write lock instead of failing with "database is locked"
+    'busy_timeout': 20000,
+    'mmap_size': 256 * 1024 * 1024,
+    # Negative values are in KiB
+    'cache_size': -64000,
+    'temp_store': 'MEMORY',
+}
+
+
+def get_sqlite_pragmas():
+    return {**DEFAULT_SQLITE_PRAGMAS, **getattr(settings, 'SQLITE_PRAGMAS', {})}
+
+
+def configure_connection(connection):
+    """Set the pragmas from get_sqlite_pragmas() on a new SQLite connection."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in get_sqlite_pragmas().items():
+            if value is not None:
+                cursor.execute(f'PRAGMA {pragma} = {value}')
+
+
+class ImmediateAtomic(transaction.Atomic):
+    """
+    transaction.atomic that, on SQLite, starts the outermost transaction with
+    BEGIN IMMEDIATE. A deferred transaction that reads before it writes has to
+    upgrade its lock, which fails straight away with "database is locked" when
+    another writer got there first, busy timeout or not. Taking the write lock
+    up front makes concurrent writers queue on the busy timeout instead.
+    """
+
+    def __enter__(self):
+        connection = transaction.get_connection(self.using)
+        immediate = (connection.vendor == 'sqlite' and not connection.in_atomic_block
+                     and getattr(settings, 'SQLITE_IMMEDIATE_TRANSACTIONS', True))
+        if not immediate:
+            return super().__enter__()
+        # Atomic starts SQLite transactions through this hook; the connection
+        # object belongs to this thread so shadowing it for one call is safe
+        connection._start_transaction_under_autocommit = lambda: connection.cursor().execute('BEGIN IMMEDIATE')
+        try:
+            return super().__enter__()
+        finally:
+            del connection._start_transaction_under_autocommit
+
+
+def immediate_atomic(using=None, savepoint=True, durable=False):
+    """Like transaction.atomic, usable as a decorator with or without arguments."""
+    if callable(using):
+        return ImmediateAtomic(DEFAULT_DB_ALIAS, savepoint, durable)(using)
+    return ImmediateAtomic(using, savepoint, durable)
@@ -0,0 +1,101 @@
+import csv
+
+from django.http import StreamingHttpResponse
+
+from .models import Item, DailyCollection, PurchaseItem
+
+EXPORT_CHUNK_SIZE = 2000
+
+# Each export streams rows of `model`, projected onto the lookups in `columns`.
+# `parent_lookup` maps a queryset of the admin's model (Bill, DailyCollection,
+# PurchaseOrder) onto the exported rows, `date_field` is used for date ranges.
+EXPORTS = {
+    'bills': {
+        'model': Item,
+        'parent_lookup': 'bill__in',
+        'date_field': 'bill__date',
+        'ordering': ['bill_id', 'id'],
+        'columns': [
+            ('Bill Id', 'bill_id'),
+            ('Date', 'bill__date'),
+            ('Dukandaar', 'bill__dukandaar__name'),
+            ('Area', 'bill__dukandaar__area__area_name'),
+            ('Product', 'product__name'),
+            ('Bora', 'bora'),
+            ('Kg', 'kg'),
+            ('Price per kg', 'price_per_kg'),
+            ('Amount', 'amount'),
+            ('Bill Total', 'bill__total_amount'),
+            ('Bill Pending', 'bill__pending_amount'),
+            ('Paid', 'bill__paid'),
+        ],
+    },
+    'collections': {
+        'model': DailyCollection,
+        'parent_lookup': 'pk__in',
+        'date_field': 'collection_time__date',
+        'ordering': ['collection_time', 'id'],
+        'columns': [
+            ('Collection Time', 'collection_time'),
+            ('Dukandaar', 'dukandaar__name'),
+            ('Area', 'dukandaar__area__area_name'),
+            ('Bill Id', 'bill_id'),
+            ('Amount Collected', 'amount_collected'),
+            ('Pending As Of Today', 'pending_amount_as_of_today'),
+        ],
+    },
+    'purchases': {
+        'model': PurchaseItem,
+        'parent_lookup': 'purchase_order__in',
+        'date_field': 'purchase_order__date',
+        'ordering': ['purchase_order_id', 'id'],
+        'columns': [
+            ('Purchase Order Id', 'purchase_order_id'),
+            ('Date', 'purchase_order__date'),
+            ('Company', 'purchase_order__company__name'),
+            ('Product', 'product__name'),
+            ('Bora', 'bora'),
+            ('Kg', 'kg'),
+            ('Price per kg', 'price_per_kg'),
+            ('Amount', 'amount'),
+        ],
+    },
+}
+
+
+class Echo:
+    """File-like object whose write() hands the line back to the csv writer's caller."""
+
+    def write(self, value):
+        return value
+
+
+def get_export_queryset(name, parent_queryset=None, start_date=None, end_date=None):
+    export = EXPORTS[name]
+    queryset = export['model'].objects.all()
+    if parent_queryset is not None:
+        queryset = queryset.filter(**{export['parent_lookup']: parent_queryset})
+    if start_date:
+        queryset = queryset.filter(**{export['date_field'] + '__gte': start_date})
+    if end_date:
+        queryset = queryset.filter(**{export['date_field'] + '__lte': end_date})
+    return queryset.order_by(*export['ordering'])
+
+
+def stream_csv(name, queryset, filename):
+    """
+    Stream queryset as CSV using a values_list projection read in chunks, so
+    memory stays flat regardless of how many rows are exported.
+    """
+    columns = EXPORTS[name]['columns']
+    rows = queryset.values_list(*[lookup for _, lookup in columns]).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    writer = csv.writer(Echo())
+
+    def lines():
+        yield writer.writerow([header for header, _ in columns])
+        for row in rows:
+            yield writer.writerow(row)
+
+    response = StreamingHttpResponse(lines(), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,217 @@
+"""
+A small job queue kept in the Job table. Views submit work with submit()
+and return the job id straight away; `manage.py run_worker` claims due jobs
+and runs them, retrying failures with exponential backoff. Tasks return a
+JSON-able result, usually the name of a file written with save_result(),
+which is then served by the job download view.
+"""
+import inspect
+import logging
+import os
+import traceback
+from collections import namedtuple
+from datetime import timedelta
+from io import StringIO
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .cache import get_cached_widget, invalidate_analytics_cache
+from .ledger import get_statement
+from .models import Bill, Dukandaar, Job
+from .pdf import render_bills_batch, render_statement_pdf
+from .reconcile import reconcile
+from .routes import generate_route_sheets
+from .utils import ANALYTICS_WIDGETS, write_receivables_ageing_csv
+
+logger = logging.getLogger(__name__)
+
+# permission is the user flag needed to submit the task and see its jobs,
+# 'is_staff' or 'is_superuser', or None for any logged in user
+Task = namedtuple('Task', 'func permission')
+
+TASKS = {}
+
+
+def task(name, permission='is_staff'):
+    """Register func(job, **kwargs) as the task name."""
+    def register(func):
+        TASKS[name] = Task(func, permission)
+        return func
+    return register
+
+
+def has_permission(name, user):
+    """Whether user may submit the task name and see its jobs; tasks no longer registered are superuser only."""
+    if user.is_superuser:
+        return True
+    permission = TASKS[name].permission if name in TASKS else 'is_superuser'
+    return user.is_authenticated and (permission is None or getattr(user, permission))
+
+
+def get_result_dir(job):
+    root = getattr(settings, 'JOB_RESULT_DIR', os.path.join(settings.MEDIA_ROOT, 'jobs'))
+    return os.path.join(root, str(job.pk))
+
+
+def save_result(job, filename, data, content_type):
+    """Store a task's output file; returns the result to record on the job."""
+    directory = get_result_dir(job)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, filename), 'wb') as out:
+        out.write(data)
+    return {'file': filename, 'content_type': content_type}
+
+
+def get_result_path(job):
+    """Path of the file a succeeded job wrote, or None."""
+    if job.status != Job.SUCCEEDED or not job.result or 'file' not in job.result:
+        return None
+    return os.path.join(get_result_dir(job), job.result['file'])
+
+
+def check_kwargs(name, kwargs):
+    """Raise ValueError unless name is a task that accepts kwargs."""
+    if name not in TASKS:
+        raise ValueError(f'Unknown task {name}')
+    try:
+        inspect.signature(TASKS[name].func).bind(None, **kwargs)
+    except TypeError as error:
+        raise ValueError(f'Invalid arguments for {name}: {error}')
+
+
+def submit(name, user=None, max_attempts=None, **kwargs):
+    """
+    Queue the task name with kwargs (JSON-able) and return its Job. Jobs
+    submitted for a user are refused with PermissionDenied unless the user
+    has the task's permission; without a user (cron) they are always queued.
+    """
+    check_kwargs(name, kwargs)
+    if user is not None and not has_permission(name, user):
+        raise PermissionDenied(f'You do not have permission to run {name} jobs.')
+    job = Job(task=name, kwargs=kwargs, submitted_by=user if user and user.is_authenticated else None)
+    if max_attempts is not None:
+        job.max_attempts = max_attempts
+    job.save()
+    return job
+
+
+def claim(worker, tasks=None):
+    """
+    Take the oldest due job, or None. The UPDATE only succeeds while the
+    job is still queued, so two workers can never claim the same one.
+    """
+    now = timezone.now()
+    due = Job.objects.filter(status=Job.QUEUED, run_after__lte=now)
+    if tasks:
+        due = due.filter(task__in=tasks)
+    for pk in due.order_by('run_after', 'id').values_list('pk', flat=True)[:10]:
+        claimed = Job.objects.filter(pk=pk, status=Job.QUEUED).update(
+            status=Job.RUNNING, worker=worker, started_at=now, attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def run(job):
+    """Run a claimed job and record its outcome, requeueing it while it has attempts left."""
+    try:
+        result = TASKS[job.task].func(job, **job.kwargs)
+    except Exception:
+        logger.exception('Job %s (%s) failed on attempt %s', job.pk, job.task, job.attempts)
+        job.error = traceback.format_exc()
+        if job.task in TASKS and job.attempts < job.max_attempts:
+            delay = getattr(settings, 'JOB_RETRY_DELAY', 30) * 2 ** (job.attempts - 1)
+            job.status = Job.QUEUED
+            job.run_after = timezone.now() + timedelta(seconds=delay)
+        else:
+            job.status = Job.FAILED
+            job.finished_at = timezone.now()
+    else:
+        job.status = Job.SUCCEEDED
+        job.result = result
+        job.error = ''
+        job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'result', 'error', 'run_after', 'finished_at'])
+    return job
+
+
+def requeue_stale(timeout=None):
+    """
+    Jobs left running longer than JOB_TIMEOUT seconds belonged to a worker
+    that died; queue them again, or fail them when out of attempts.
+    """
+    timeout = timeout or getattr(settings, 'JOB_TIMEOUT', 3600)
+    stale = Job.objects.filter(status=Job.RUNNING, started_at__lt=timezone.now() - timedelta(seconds=timeout))
+    requeued = stale.filter(attempts__lt=F('max_attempts')).update(status=Job.QUEUED, run_after=timezone.now())
+    failed = stale.update(status=Job.FAILED, finished_at=timezone.now(), error='Timed out')
+    return requeued, failed
+
+
+def purge(days):
+    """Delete jobs finished more than days ago, with their files."""
+    old = Job.objects.filter(status__in=[Job.SUCCEEDED, Job.FAILED],
+                             finished_at__lt=timezone.now() - timedelta(days=days))
+    for job in old.only('pk'):
+        directory = get_result_dir(job)
+        if os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                os.remove(os.path.join(directory, filename))
+            os.rmdir(directory)
+    return old.delete()[0]
+
+
+# Tasks
+
+@task('bills_pdf')
+def bills_pdf(job, bill_ids=None, date=None):
+    if bill_ids is None:
+        bill_ids = Bill.objects.filter(date=date).values_list('id', flat=True)
+    bill_ids = list(Bill.objects.filter(pk__in=bill_ids).order_by('id').values_list('id', flat=True))
+    if not bill_ids:
+        raise ValueError('No bills found')
+    return save_result(job, 'bills.pdf', render_bills_batch(bill_ids), 'application/pdf')
+
+
+@task('statement_pdf', permission=None)
+def statement_pdf(job, dukandaar_id, start=None, end=None):
+    dukandaar = Dukandaar.objects.select_related('area').get(pk=dukandaar_id)
+    statement = get_statement(dukandaar, start and parse_date(start), end and parse_date(end))
+    return save_result(job, f'statement_{dukandaar_id}.pdf', render_statement_pdf(statement), 'application/pdf')
+
+
+@task('route_sheets')
+def route_sheets(job, area_ids=None):
+    return {'sheets': len(generate_route_sheets(area_ids))}
+
+
+@task('ageing_csv', permission='is_superuser')
+def ageing_csv(job, group_by='dukandaar'):
+    out = StringIO()
+    write_receivables_ageing_csv(out, group_by)
+    return save_result(job, f'receivables_ageing_{group_by}.csv', out.getvalue().encode(), 'text/csv')
+
+
+@task('warm_analytics', permission='is_superuser')
+def warm_analytics(job):
+    # Drop the cached widgets and compute them all again, so the next dashboard load is served from cache
+    invalidate_analytics_cache()
+    for name, func in ANALYTICS_WIDGETS.items():
+        get_cached_widget(name, func)
+    return {'widgets': len(ANALYTICS_WIDGETS)}
+
+
+@task('reconcile', permission='is_superuser')
+def reconcile_balances(job, fix=False):
+    return {name: len(drifts) for name, drifts in reconcile(fix).items()}
+
+
+@task('backup', permission='is_superuser')
+def backup(job, local_dir=None, full_every=7, keep=4):
+    # The backup script lives next to manage.py, which is on the path of every management command
+    from upload_to_drive import upload_file
+    return {'backup': upload_file(local_dir, full_every, keep)}
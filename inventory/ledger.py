@@ -0,0 +1,159 @@
+import heapq
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db.models import BooleanField, ExpressionWrapper, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .cache import invalidate_analytics_cache, bump_ledger_version
+from .db import immediate_atomic
+from .models import (Bill, Item, DailySalesRollup, DailyCollection, StockMovement, PurchaseOrder, CompanyPayment,
+                     settled_outside_collections)
+
+BillLine = namedtuple('BillLine', ['product', 'bora', 'kg', 'price_per_kg'])
+StatementLine = namedtuple('StatementLine', ['date', 'kind', 'reference', 'bill_id', 'debit', 'credit', 'balance'])
+
+
+@immediate_atomic
+def post_bill(dukandaar, lines, bill=None):
+    """
+    Post a whole bill in one batch: the items are created with a single
+    bulk_create and the bill, the shop, every product and the sales rollup
+    receive one aggregated delta each, instead of the per-item cascade done
+    by Item.save. lines is an iterable of BillLine(product, bora, kg,
+    price_per_kg). A new bill is created unless one is given.
+
+    Returns the created items.
+    """
+    if bill is None:
+        bill = Bill.objects.create(dukandaar=dukandaar)
+        products_on_bill = set()
+    else:
+        products_on_bill = set(bill.items.values_list('product_id', flat=True))
+
+    items = []
+    total = Decimal(0)
+    products = {}
+    kg_by_product = defaultdict(Decimal)
+    revenue_by_product = defaultdict(Decimal)
+    for line in lines:
+        product, bora, kg, price_per_kg = line
+        item = Item(bill=bill, product=product, bora=Decimal(bora), kg=Decimal(kg),
+                    price_per_kg=Decimal(price_per_kg))
+        item.amount = item.calculate_amount()
+        items.append(item)
+        total += item.amount
+        products[product.pk] = product
+        kg_by_product[product.pk] += item.kg_sold
+        revenue_by_product[product.pk] += item.amount
+
+    if not items:
+        return []
+
+    Item.objects.bulk_create(items)
+
+    bill.post_amount(total)
+
+    for product_id, product in products.items():
+        StockMovement.record(product, StockMovement.SALE, -kg_by_product[product_id], date=bill.date, bill=bill)
+        DailySalesRollup.record(
+            bill.date, product_id, dukandaar.pk,
+            revenue=revenue_by_product[product_id],
+            kg_sold=kg_by_product[product_id],
+            bill_count=0 if product_id in products_on_bill else 1,
+        )
+
+    # bulk_create does not send post_save
+    invalidate_analytics_cache()
+    bump_ledger_version(dukandaar.pk)
+    return items
+
+
+@contextmanager
+def explicit_dates():
+    """Let bulk_create keep the dates we set instead of overwriting auto_now_add fields with now."""
+    fields = [Bill._meta.get_field('date'), PurchaseOrder._meta.get_field('date'),
+              DailyCollection._meta.get_field('collection_time'), CompanyPayment._meta.get_field('payment_date')]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def _start_of_day(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def get_opening_balance(dukandaar_id, start_date):
+    """
+    What the shop owed before start_date: bills billed, less those settled
+    outside the collections, minus amounts collected.
+    """
+    if start_date is None:
+        return Decimal(0)
+    billed = (Bill.objects.filter(dukandaar_id=dukandaar_id, date__lt=start_date)
+              .exclude(settled_outside_collections())
+              .aggregate(total=Sum('total_amount'))['total'] or Decimal(0))
+    collected = DailyCollection.objects.filter(
+        dukandaar_id=dukandaar_id, collection_time__lt=_start_of_day(start_date)
+    ).aggregate(total=Sum('amount_collected'))['total'] or Decimal(0)
+    return billed - collected
+
+
+def iter_statement(dukandaar_id, start_date=None, end_date=None, opening_balance=Decimal(0)):
+    """
+    Yield StatementLines for the shop's bills and collections between the
+    dates (inclusive), oldest first, with the running balance. Both tables
+    are read as sorted, projected streams and merged, so memory and query
+    count stay constant however long the history is. On a day with both,
+    bills come before collections. A bill settled outside the collections
+    (see Bill.post_amount) is credited in full on its own line, so like
+    Dukandaar.pending_amount the balance never owes it.
+    """
+    bills = Bill.objects.filter(dukandaar_id=dukandaar_id)
+    collections = DailyCollection.objects.filter(dukandaar_id=dukandaar_id)
+    if start_date:
+        bills = bills.filter(date__gte=start_date)
+        collections = collections.filter(collection_time__gte=_start_of_day(start_date))
+    if end_date:
+        bills = bills.filter(date__lte=end_date)
+        collections = collections.filter(collection_time__lt=_start_of_day(end_date + timedelta(days=1)))
+
+    bill_rows = ((day, 0, pk, pk, amount, settled) for day, pk, amount, settled in
+                 bills.annotate(settled=ExpressionWrapper(settled_outside_collections(), output_field=BooleanField()))
+                 .order_by('date', 'id').values_list('date', 'id', 'total_amount', 'settled').iterator())
+    collection_rows = ((day, 1, pk, bill_id, amount, False) for day, pk, bill_id, amount in
+                       collections.annotate(day=TruncDate('collection_time')).order_by('collection_time', 'id')
+                       .values_list('day', 'id', 'bill_id', 'amount_collected').iterator())
+
+    balance = opening_balance
+    for day, order, pk, bill_id, amount, settled in heapq.merge(bill_rows, collection_rows, key=lambda row: row[:2]):
+        if order == 0:
+            credit = amount if settled else Decimal(0)
+            balance += amount - credit
+            yield StatementLine(day, 'bill', pk, bill_id, amount, credit, balance)
+        else:
+            balance -= amount
+            yield StatementLine(day, 'collection', pk, bill_id, Decimal(0), amount, balance)
+
+
+def get_statement(dukandaar, start_date=None, end_date=None):
+    """Opening balance, lines, totals and closing balance of a shop's statement."""
+    opening_balance = get_opening_balance(dukandaar.pk, start_date)
+    lines = list(iter_statement(dukandaar.pk, start_date, end_date, opening_balance))
+    return {
+        'dukandaar': dukandaar,
+        'start_date': start_date,
+        'end_date': end_date,
+        'opening_balance': opening_balance,
+        'lines': lines,
+        'total_debit': sum((line.debit for line in lines), Decimal(0)),
+        'total_credit': sum((line.credit for line in lines), Decimal(0)),
+        'closing_balance': lines[-1].balance if lines else opening_balance,
+    }
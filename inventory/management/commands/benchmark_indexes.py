@@ -0,0 +1,63 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max
+
+from inventory.benchmark import Rollback, seed_dataset, time_call
+from inventory.models import Bill, DailyCollection, PurchaseOrder
+from inventory.utils import (get_sales_count_comparison, get_todays_sales_list, get_sales_time_series,
+                             get_annual_customer_count_and_trend)
+
+
+class Command(BaseCommand):
+    help = ("Time the date-range and unpaid-bill queries with and without the indexes added in "
+            "migration 0006. Run it against a benchmark database, optionally seeded with --seed-scale.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed-scale', type=int, default=0,
+                            help='Generate a synthetic dataset of this scale first (see seed_benchmark)')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        if options['seed_scale']:
+            self.stdout.write(f"Seeding scale {options['seed_scale']} dataset")
+            seed_dataset(scale=options['seed_scale'], stdout=self.stdout)
+
+        dukandaar_id = Bill.objects.filter(paid=False).values_list('dukandaar_id', flat=True).first()
+        today = date.today()
+        last_30 = today - timedelta(days=30)
+        queries = {
+            'unpaid bills of a dukandaar': lambda: list(Bill.objects.filter(dukandaar_id=dukandaar_id, paid=False)),
+            'bills by date': lambda: Bill.objects.filter(date=today - timedelta(days=7)).count(),
+            'collections last 30 days': lambda: list(DailyCollection.objects.filter(collection_time__range=[last_30, today])),
+            'last collection per dukandaar': lambda: DailyCollection.objects.filter(
+                dukandaar_id=dukandaar_id).aggregate(Max('collection_time')),
+            'purchase orders this month': lambda: list(PurchaseOrder.objects.filter(date__gte=today.replace(day=1))),
+            'get_sales_count_comparison': get_sales_count_comparison,
+            'get_todays_sales_list': get_todays_sales_list,
+            'get_sales_time_series (30 days)': lambda: get_sales_time_series(last_30, today),
+            'get_annual_customer_count_and_trend': get_annual_customer_count_and_trend,
+        }
+
+        repeat = options['repeat']
+        with_indexes = {name: time_call(query, repeat) for name, query in queries.items()}
+
+        # Drop the indexes inside a transaction that is rolled back afterwards
+        without_indexes = {}
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    for model in (Bill, DailyCollection, PurchaseOrder):
+                        for index in model._meta.indexes:
+                            cursor.execute(f'DROP INDEX {connection.ops.quote_name(index.name)}')
+                without_indexes = {name: time_call(query, repeat) for name, query in queries.items()}
+                raise Rollback
+        except Rollback:
+            pass
+
+        self.stdout.write(f"{'query':<40} {'no index ms':>12} {'indexed ms':>12} {'speedup':>8}")
+        for name in queries:
+            before, after = without_indexes[name], with_indexes[name]
+            speedup = before / after if after else 0
+            self.stdout.write(f"{name:<40} {before:>12.2f} {after:>12.2f} {speedup:>7.1f}x")
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from inventory.routes import generate_route_sheets
+
+
+class Command(BaseCommand):
+    help = ("Generate today's collection route sheets (PDF and JSON) for all areas, or the given "
+            "ones, in parallel. Schedule it before the day starts, e.g. with cron: "
+            "0 6 * * * cd /path/to/project && python manage.py generate_route_sheets")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--areas', type=int, nargs='+', help='Area ids, all areas by default')
+        parser.add_argument('--processes', type=int, help='Worker processes, BILL_PDF_PROCESSES by default')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        paths = generate_route_sheets(options['areas'], options['processes'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {len(paths)} route sheets in {time.monotonic() - started:.1f}s'
+        ))
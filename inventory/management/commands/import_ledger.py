@@ -0,0 +1,304 @@
+import csv
+import time
+from collections import defaultdict
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal, InvalidOperation
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+from django.utils import timezone
+
+from inventory.cache import invalidate_analytics_cache, bump_ledger_version
+from inventory.db import immediate_atomic
+from inventory.ledger import explicit_dates
+from inventory.models import (Bill, Item, Company, Dukandaar, Product, PurchaseOrder, PurchaseItem,
+                              DailyCollection, StockMovement)
+
+# Columns each file must have, the optional ones in the help below are read with row.get()
+REQUIRED_COLUMNS = {
+    'bills': ['bill_ref', 'date', 'dukandaar', 'product', 'bora', 'kg', 'price_per_kg'],
+    'purchases': ['order_ref', 'date', 'company', 'product', 'bora', 'kg', 'price_per_kg'],
+    'collections': ['date', 'dukandaar', 'amount_collected'],
+}
+
+
+class Command(BaseCommand):
+    help = """
+    Import historical bills, purchase orders and daily collections from CSV files.
+
+    Files are streamed and written in batches of --chunk-size rows, each batch
+    committed on its own together with the balances it changes (pending amounts,
+    loans, stock and its journal), so the ledger stays consistent while an import
+    runs. If a row is rejected, the batches before it stay imported: fix the file
+    and import the rows after the last committed line. Purchases are imported
+    before bills, so sales are valued at the average cost of the imported stock.
+    The sales rollup is rebuilt for the days the bills cover.
+
+      --bills        bill_ref,date,dukandaar,product,bora,kg,price_per_kg[,paid]
+                     one row per item, rows of the same bill_ref must be consecutive
+      --purchases    order_ref,date,company,product,bora,kg,price_per_kg[,disc_percent]
+                     one row per item, rows of the same order_ref must be consecutive
+      --collections  date,dukandaar,amount_collected[,bill_ref]
+                     bill_ref refers to a bill imported from --bills in the same run;
+                     collections against a bill marked paid are what settled it
+
+    Dukandaars, companies and products are matched by name and must already exist.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bills', help='CSV file with bill items')
+        parser.add_argument('--purchases', help='CSV file with purchase order items')
+        parser.add_argument('--collections', help='CSV file with daily collections')
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help='Number of CSV rows written and committed per batch')
+
+    def handle(self, *args, **options):
+        if not any(options[name] for name in ('bills', 'purchases', 'collections')):
+            raise CommandError('Pass at least one of --bills, --purchases or --collections')
+
+        self.chunk_size = options['chunk_size']
+        self.dukandaars = dict(Dukandaar.objects.values_list('name', 'id'))
+        self.companies = dict(Company.objects.values_list('name', 'id'))
+        self.products = {product.name: product for product in Product.objects.order_by('-id')}
+
+        self.bill_ids = {}
+        # Total of each bill imported as paid, until a collection against it is imported
+        self.paid_bill_totals = {}
+        self.bill_dates = []
+        self.adjusted = defaultdict(set)
+
+        try:
+            if options['purchases']:
+                self.run_import('purchases', options['purchases'], self.import_purchases)
+            if options['bills']:
+                self.run_import('bills', options['bills'], self.import_bills)
+            if options['collections']:
+                self.run_import('collections', options['collections'], self.import_collections)
+        finally:
+            if self.bill_dates:
+                call_command('rebuild_sales_rollup', start=min(self.bill_dates), end=max(self.bill_dates),
+                             stdout=self.stdout)
+            invalidate_analytics_cache()
+            bump_ledger_version()
+            self.stdout.write(
+                f"Adjusted {len(self.adjusted['dukandaars'])} dukandaars, {len(self.adjusted['companies'])} "
+                f"companies, {len(self.adjusted['products'])} products and {len(self.adjusted['bills'])} bills"
+            )
+
+    def run_import(self, label, path, importer):
+        started = time.monotonic()
+        self.committed_line = None
+        with open(path, newline='', encoding='utf-8') as csv_file:
+            reader = csv.DictReader(csv_file)
+            missing = [column for column in REQUIRED_COLUMNS[label] if column not in (reader.fieldnames or [])]
+            if missing:
+                raise CommandError(f"{label}: {path} is missing the columns {', '.join(missing)}")
+            try:
+                rows = importer(reader)
+            except CommandError as error:
+                committed = f'up to line {self.committed_line}' if self.committed_line else 'nothing'
+                raise CommandError(f'{error}; {label}: committed {committed}')
+        elapsed = time.monotonic() - started
+        rate = rows / elapsed if elapsed else rows
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {rows} {label} rows in {elapsed:.1f}s ({rate:.0f} rows/sec)"
+        ))
+
+    # Parsing helpers
+
+    def lookup(self, table, name, line, kind):
+        try:
+            return table[name.strip()]
+        except KeyError:
+            raise CommandError(f"Line {line}: unknown {kind} '{name}'")
+
+    def decimal(self, value, line, column):
+        try:
+            return Decimal(value.strip() or 0)
+        except InvalidOperation:
+            raise CommandError(f"Line {line}: invalid number '{value}' in column {column}")
+
+    def parse_date(self, value, line):
+        try:
+            return date.fromisoformat(value.strip()[:10])
+        except ValueError:
+            raise CommandError(f"Line {line}: invalid date '{value}'")
+
+    def parse_flag(self, value):
+        return (value or '').strip().lower() in ('1', 'true', 'yes', 'y')
+
+    def grouped(self, reader, key):
+        """Yield (ref, [(line, row), ...]) for runs of consecutive rows sharing the same key."""
+        ref, group = None, []
+        for line, row in enumerate(reader, start=2):
+            if group and row[key] != ref:
+                yield ref, group
+                group = []
+            ref = row[key]
+            group.append((line, row))
+        if group:
+            yield ref, group
+
+    # Importers, each returns the number of CSV rows written
+
+    def import_bills(self, reader):
+        rows, batch = 0, []
+        for ref, group in self.grouped(reader, 'bill_ref'):
+            line, first = group[0]
+            bill = Bill(dukandaar_id=self.lookup(self.dukandaars, first['dukandaar'], line, 'dukandaar'),
+                        date=self.parse_date(first['date'], line),
+                        paid=self.parse_flag(first.get('paid')))
+            items = []
+            for line, row in group:
+                product = self.lookup(self.products, row['product'], line, 'product')
+                item = Item(bill=bill, product=product,
+                            bora=self.decimal(row['bora'], line, 'bora'),
+                            kg=self.decimal(row['kg'], line, 'kg'),
+                            price_per_kg=self.decimal(row['price_per_kg'], line, 'price_per_kg'))
+                item.amount = item.calculate_amount()
+                items.append(item)
+            bill.total_amount = sum(item.amount for item in items)
+            bill.pending_amount = 0 if bill.paid else bill.total_amount
+            batch.append((ref, bill, items))
+            rows += len(group)
+            if sum(len(items) for _, _, items in batch) >= self.chunk_size:
+                self.flush_bills(batch, line)
+                batch = []
+        if batch:
+            self.flush_bills(batch, line)
+        return rows
+
+    def flush_bills(self, batch, line):
+        bills = [bill for _, bill, _ in batch]
+        pending = defaultdict(Decimal)
+        movements = {}
+        for _, bill, items in sorted(batch, key=lambda entry: entry[1].date):
+            pending[bill.dukandaar_id] += bill.pending_amount
+            for item in items:
+                movement = movements.setdefault((id(bill), item.product.pk), StockMovement(
+                    product=item.product, kind=StockMovement.SALE, kg=0, date=bill.date, bill=bill))
+                movement.kg -= item.kg_sold
+
+        with immediate_atomic(), explicit_dates():
+            Bill.objects.bulk_create(bills)
+            Item.objects.bulk_create([item for _, _, items in batch for item in items])
+            self.add_deltas(Dukandaar, 'pending_amount', pending, 'dukandaars')
+            self.record_movements(movements.values())
+
+        for ref, bill, _ in batch:
+            self.bill_ids[ref] = bill.pk
+            if bill.paid:
+                self.paid_bill_totals[bill.pk] = bill.total_amount
+        self.bill_dates += [min(bill.date for bill in bills), max(bill.date for bill in bills)]
+        self.committed_line = line
+
+    def import_purchases(self, reader):
+        rows, batch = 0, []
+        for ref, group in self.grouped(reader, 'order_ref'):
+            line, first = group[0]
+            order = PurchaseOrder(company_id=self.lookup(self.companies, first['company'], line, 'company'),
+                                  date=self.parse_date(first['date'], line))
+            if first.get('disc_percent'):
+                order.disc_percent = self.decimal(first['disc_percent'], line, 'disc_percent')
+            items = []
+            for line, row in group:
+                product = self.lookup(self.products, row['product'], line, 'product')
+                item = PurchaseItem(purchase_order=order, product=product,
+                                    bora=self.decimal(row['bora'], line, 'bora'),
+                                    kg=self.decimal(row['kg'], line, 'kg'),
+                                    price_per_kg=self.decimal(row['price_per_kg'], line, 'price_per_kg'))
+                item.amount = (item.kg * item.price_per_kg) + (item.bora * item.price_per_kg * product.one_bora_in_kg)
+                items.append(item)
+            order.total_amount = sum(item.amount for item in items)
+            batch.append((order, items))
+            rows += len(group)
+            if sum(len(items) for _, items in batch) >= self.chunk_size:
+                self.flush_purchases(batch, line)
+                batch = []
+        if batch:
+            self.flush_purchases(batch, line)
+        return rows
+
+    def flush_purchases(self, batch, line):
+        loans = defaultdict(Decimal)
+        movements = []
+        for order, items in sorted(batch, key=lambda entry: entry[0].date):
+            loans[order.company_id] += order.total_amount
+            # One movement per line, as PurchaseItem.save records them
+            movements += [StockMovement(product=item.product, kind=StockMovement.PURCHASE, kg=item.kg_bought,
+                                        unit_cost=item.price_per_kg, date=order.date, purchase_order=order)
+                          for item in items]
+
+        with immediate_atomic(), explicit_dates():
+            PurchaseOrder.objects.bulk_create([order for order, _ in batch])
+            PurchaseItem.objects.bulk_create([item for _, items in batch for item in items])
+            self.add_deltas(Company, 'loan_amount', loans, 'companies')
+            self.record_movements(movements)
+        self.committed_line = line
+
+    def import_collections(self, reader):
+        rows, batch = 0, []
+        for line, row in enumerate(reader, start=2):
+            bill_id = None
+            if row.get('bill_ref'):
+                bill_id = self.lookup(self.bill_ids, row['bill_ref'], line, 'bill_ref')
+            collection_date = self.parse_date(row['date'], line)
+            batch.append(DailyCollection(
+                dukandaar_id=self.lookup(self.dukandaars, row['dukandaar'], line, 'dukandaar'),
+                bill_id=bill_id,
+                amount_collected=self.decimal(row['amount_collected'], line, 'amount_collected'),
+                collection_time=timezone.make_aware(datetime.combine(collection_date, dt_time.min)),
+            ))
+            rows += 1
+            if len(batch) >= self.chunk_size:
+                self.flush_collections(batch, line)
+                batch = []
+        if batch:
+            self.flush_collections(batch, line)
+        return rows
+
+    def flush_collections(self, batch, line):
+        pending = defaultdict(Decimal)
+        by_bill = defaultdict(Decimal)
+        for collection in batch:
+            if collection.bill_id in self.paid_bill_totals:
+                # The bill was imported settled; its collections are what settled it, so
+                # it is owed again first and they pay it off, as if entered one by one
+                total = self.paid_bill_totals.pop(collection.bill_id)
+                pending[collection.dukandaar_id] += total
+                by_bill[collection.bill_id] += total
+            pending[collection.dukandaar_id] -= collection.amount_collected
+            # The change to the shop's balance so far, the balance itself is read below
+            collection.pending_amount_as_of_today = pending[collection.dukandaar_id]
+            if collection.bill_id:
+                by_bill[collection.bill_id] -= collection.amount_collected
+
+        with immediate_atomic(), explicit_dates():
+            balances = dict(Dukandaar.objects.select_for_update().filter(pk__in=pending)
+                            .values_list('pk', 'pending_amount'))
+            for collection in batch:
+                collection.pending_amount_as_of_today += balances[collection.dukandaar_id]
+            DailyCollection.objects.bulk_create(batch)
+            self.add_deltas(Dukandaar, 'pending_amount', pending, 'dukandaars')
+            bills = list(Bill.objects.filter(pk__in=by_bill).only('pending_amount', 'paid'))
+            for bill in bills:
+                bill.pending_amount += by_bill[bill.pk]
+                bill.paid = bill.paid or bill.pending_amount <= 0
+            Bill.objects.bulk_update(bills, ['pending_amount', 'paid'])
+        self.adjusted['bills'].update(by_bill)
+        self.committed_line = line
+
+    # Balances, applied in the transaction of the batch that changed them
+
+    def add_deltas(self, model, field, deltas, label):
+        for pk, delta in deltas.items():
+            if delta:
+                model.objects.filter(pk=pk).update(**{field: F(field) + delta})
+        self.adjusted[label].update(deltas)
+
+    def record_movements(self, movements):
+        movements = [movement for movement in movements if movement.kg]
+        if movements:
+            StockMovement.record_many(movements)
+            self.adjusted['products'].update(movement.product_id for movement in movements)
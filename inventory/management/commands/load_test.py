@@ -0,0 +1,174 @@
+import http.client
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import quote, urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.benchmark import benchmark_session
+from inventory.models import Dukandaar
+
+# How each deployment profile is started, {workers} and {port} filled in
+SERVERS = {
+    'wsgi': ['gunicorn', 'business_inventory.wsgi:application', '--workers', '{workers}',
+             '--bind', '127.0.0.1:{port}', '--timeout', '120'],
+    'asgi': ['uvicorn', 'business_inventory.asgi:application', '--workers', '{workers}',
+             '--port', '{port}', '--no-access-log'],
+}
+
+SEARCH_PREFIXES = ['sh', 'shop 1', 'pro', 'product 2', 'are', 'shop 9']
+
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+class Command(BaseCommand):
+    help = ("Mixed load against a running server: field staff lookups (get_unpaid_bills, search, "
+            "analytics data) alongside slow requests (statement PDFs, ageing CSV), reporting p50/p95 "
+            "latency of each. --compare starts the WSGI (gunicorn) and ASGI (uvicorn) profiles in "
+            "turn with the same number of workers and runs the same load against both. Seed the "
+            "database with seed_benchmark first.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Server to load, without --compare')
+        parser.add_argument('--compare', action='store_true', help='Start and load the WSGI and ASGI profiles')
+        parser.add_argument('--workers', type=int, default=2, help='Server worker processes with --compare')
+        parser.add_argument('--port', type=int, default=8765, help='Port the servers listen on with --compare')
+        parser.add_argument('--duration', type=float, default=20, help='Seconds of load')
+        parser.add_argument('--fast-clients', type=int, default=8, help='Clients making lookups')
+        parser.add_argument('--slow-clients', type=int, default=2, help='Clients making PDF and report requests')
+
+    def handle(self, *args, **options):
+        dukandaar_ids = list(Dukandaar.objects.filter(bill__isnull=False).distinct().values_list('id', flat=True))
+        if not dukandaar_ids:
+            raise CommandError('No data to load, run seed_benchmark first')
+        self.dukandaar_ids = dukandaar_ids
+
+        # The load runs as a superuser created for it, deleted with its session afterwards
+        with benchmark_session('loadtest') as session_key:
+            self.cookie = f'{settings.SESSION_COOKIE_NAME}={session_key}'
+            if not options['compare']:
+                self.report(options['url'], self.run_load(options['url'], options))
+                return
+
+            results = {}
+            for profile, command in SERVERS.items():
+                url = f"http://127.0.0.1:{options['port']}"
+                server = self.start_server(command, options['workers'], options['port'])
+                try:
+                    results[profile] = self.run_load(url, options)
+                finally:
+                    server.terminate()
+                    server.wait(timeout=30)
+                self.report(profile, results[profile])
+
+        self.stdout.write('\nFast requests p95 (ms): ' + ', '.join(
+            f"{profile} {stats['fast']['p95_ms']}" for profile, stats in results.items()))
+
+    def start_server(self, command, workers, port):
+        command = [part.format(workers=workers, port=port) for part in command]
+        # Servers run from the project directory with the same settings and database
+        server = subprocess.Popen(command, cwd=settings.BASE_DIR, env=os.environ.copy(),
+                                  stdout=subprocess.DEVNULL, stderr=sys.stderr)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f"{command[0]} exited, is it installed?")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return server
+            except OSError:
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError(f'{command[0]} did not start listening on port {port}')
+
+    def fast_request(self, rng):
+        kind = rng.choice(['get_unpaid_bills', 'get_unpaid_bills', 'search', 'analytics_data'])
+        if kind == 'get_unpaid_bills':
+            return kind, f'/get_unpaid_bills/?dukandaar={rng.choice(self.dukandaar_ids)}'
+        if kind == 'search':
+            return kind, f'/search/?q={quote(rng.choice(SEARCH_PREFIXES))}'
+        return kind, '/analytics/data/'
+
+    def slow_request(self, rng):
+        if rng.random() < 0.8:
+            return 'statement_pdf', f'/statement/{rng.choice(self.dukandaar_ids)}/pdf/'
+        return 'ageing_csv', '/analytics/ageing/?format=csv'
+
+    def run_load(self, url, options):
+        deadline = time.monotonic() + options['duration']
+        timings = {'fast': [], 'slow': []}
+        by_endpoint = {}
+        errors = []
+        lock = threading.Lock()
+
+        server = urlsplit(url)
+
+        def client(group, make_request, seed):
+            rng = random.Random(seed)
+            # One kept-alive connection per client, like a browser tab
+            connection = http.client.HTTPConnection(server.hostname, server.port or 80, timeout=120)
+            while time.monotonic() < deadline:
+                endpoint, path = make_request(rng)
+                started = time.perf_counter()
+                try:
+                    connection.request('GET', path, headers={'Cookie': self.cookie})
+                    response = connection.getresponse()
+                    response.read()
+                    ok, outcome = response.status in (200, 304, 404), response.status
+                except (OSError, http.client.HTTPException) as error:
+                    connection.close()
+                    ok, outcome = False, error
+                elapsed = (time.perf_counter() - started) * 1000
+                with lock:
+                    if ok:
+                        timings[group].append(elapsed)
+                        by_endpoint.setdefault(endpoint, []).append(elapsed)
+                    else:
+                        errors.append(f'{path}: {outcome}')
+            connection.close()
+
+        threads = [threading.Thread(target=client, args=('fast', self.fast_request, i))
+                   for i in range(options['fast_clients'])]
+        threads += [threading.Thread(target=client, args=('slow', self.slow_request, 1000 + i))
+                    for i in range(options['slow_clients'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        def summary(values):
+            values = sorted(values)
+            if not values:
+                return {'requests': 0, 'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+            return {
+                'requests': len(values),
+                'p50_ms': round(statistics.median(values), 1),
+                'p95_ms': round(percentile(values, 0.95), 1),
+                'max_ms': round(values[-1], 1),
+            }
+
+        return {
+            **{group: summary(values) for group, values in timings.items()},
+            'endpoints': {endpoint: summary(values) for endpoint, values in sorted(by_endpoint.items())},
+            'errors': len(errors),
+            'sample_errors': errors[:5],
+        }
+
+    def report(self, label, stats):
+        self.stdout.write(f'\n{label}')
+        for group in ('fast', 'slow'):
+            self.stdout.write(f'  {group:<18} {json.dumps(stats[group])}')
+        for endpoint, summary in stats['endpoints'].items():
+            self.stdout.write(f'    {endpoint:<16} {json.dumps(summary)}')
+        if stats['errors']:
+            self.stdout.write(self.style.WARNING(f"  {stats['errors']} errors, e.g. {stats['sample_errors']}"))
@@ -0,0 +1,107 @@
+import time
+from functools import partial
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.core.serializers import sort_dependencies
+from django.db import connections, transaction
+
+SOURCE_ALIAS = 'sqlite_source'
+
+# Job.submitted_by refers to auth users, and permissions and admin log entries to content types
+DEFAULT_APPS = ['contenttypes', 'auth', 'admin', 'inventory']
+
+# Tables migrate fills by itself (post_migrate), replaced by the source's rows
+GENERATED_TABLES = ['django_content_type', 'auth_permission']
+
+
+class Command(BaseCommand):
+    help = ("Copy the inventory tables, and the users, groups and admin history they refer to, from a "
+            "SQLite database into the PostgreSQL database in settings (run with DB_ENGINE=postgres). Rows "
+            "are streamed in batches through COPY, sequences are reset afterwards and row counts are "
+            "checked on both sides.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=str(settings.BASE_DIR / 'db.sqlite3'),
+                            help='SQLite database file to copy from')
+        parser.add_argument('--database', default='default', help='PostgreSQL database alias to copy into')
+        parser.add_argument('--apps', nargs='+', default=DEFAULT_APPS,
+                            help='App labels whose tables are copied')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--truncate', action='store_true',
+                            help='Empty the target tables first instead of refusing to copy into them')
+
+    def handle(self, *args, **options):
+        target = connections[options['database']]
+        if target.vendor != 'postgresql':
+            raise CommandError(f"Database '{options['database']}' is {target.vendor}, not PostgreSQL")
+        from django.db.backends.postgresql.psycopg_any import is_psycopg3
+        if not is_psycopg3:
+            raise CommandError('COPY batches need psycopg 3, see requirements.txt')
+
+        connections.settings = connections.configure_settings({
+            **connections.settings,
+            SOURCE_ALIAS: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': options['source']},
+        })
+
+        call_command('migrate', database=options['database'], verbosity=0)
+
+        app_list = [(apps.get_app_config(label), None) for label in options['apps']]
+        models = [model for model in sort_dependencies(app_list, allow_cycles=True)
+                  if model._meta.managed and not model._meta.proxy]
+        # Many-to-many tables (user groups and permissions) after both of their sides
+        models += [field.remote_field.through for model in list(models) for field in model._meta.local_many_to_many
+                   if field.remote_field.through._meta.auto_created]
+
+        with transaction.atomic(using=options['database']):
+            with target.cursor() as cursor:
+                tables = [model._meta.db_table for model in models]
+                if not options['truncate']:
+                    tables = [table for table in tables if table in GENERATED_TABLES]
+                if tables:
+                    cursor.execute(f"TRUNCATE {', '.join(target.ops.quote_name(table) for table in tables)} CASCADE")
+                for model in models:
+                    if model.objects.using(options['database']).exists():
+                        raise CommandError(f'{model._meta.db_table} is not empty, use --truncate')
+
+                for model in models:
+                    started = time.monotonic()
+                    copied = self.copy_model(model, cursor, options['batch_size'])
+                    self.stdout.write(f'{model._meta.db_table:<35} {copied:>9} rows {time.monotonic() - started:>7.1f}s')
+
+                for sql in target.ops.sequence_reset_sql(no_style(), models):
+                    cursor.execute(sql)
+
+            for model in models:
+                source_count = model.objects.using(SOURCE_ALIAS).count()
+                target_count = model.objects.using(options['database']).count()
+                if source_count != target_count:
+                    raise CommandError(f'{model._meta.db_table}: {source_count} rows in SQLite but '
+                                       f'{target_count} copied')
+
+        connections[SOURCE_ALIAS].close()
+        self.stdout.write(self.style.SUCCESS(f'Copied {len(models)} tables'))
+
+    def copy_model(self, model, cursor, batch_size):
+        """
+        Stream the rows of model from SQLite into PostgreSQL with COPY. Rows
+        are read through the ORM so values arrive as the Python types of
+        their fields (Decimal, date, bool) rather than SQLite's storage types.
+        """
+        fields = model._meta.concrete_fields
+        columns = ', '.join(cursor.db.ops.quote_name(field.column) for field in fields)
+        rows = (model.objects.using(SOURCE_ALIAS).order_by('pk')
+                .values_list(*[field.attname for field in fields])
+                .iterator(chunk_size=batch_size))
+        copied = 0
+        # The Django cursor wrapper does not expose COPY, use the psycopg cursor underneath
+        # What each field would send on save, e.g. JSON values wrapped for psycopg
+        prepare = [partial(field.get_db_prep_save, connection=cursor.db) for field in fields]
+        with cursor.cursor.copy(f'COPY {cursor.db.ops.quote_name(model._meta.db_table)} ({columns}) FROM STDIN') as copy:
+            for row in rows:
+                copy.write_row([prep(value) for prep, value in zip(prepare, row)])
+                copied += 1
+        return copied
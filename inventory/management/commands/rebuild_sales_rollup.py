@@ -0,0 +1,61 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum, Count, F
+
+from inventory.models import Item, DailySalesRollup
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the DailySalesRollup table from scratch out of the Bill and Item rows, "
+            "or only the days between --start and --end")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of rollup rows inserted per query')
+        parser.add_argument('--start', type=date.fromisoformat, help='First day to rebuild (YYYY-MM-DD)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day to rebuild (YYYY-MM-DD)')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        items = Item.objects.all()
+        rollups = DailySalesRollup.objects.all()
+        if options['start']:
+            items = items.filter(bill__date__gte=options['start'])
+            rollups = rollups.filter(date__gte=options['start'])
+        if options['end']:
+            items = items.filter(bill__date__lte=options['end'])
+            rollups = rollups.filter(date__lte=options['end'])
+
+        # One grouped query over the items, keyed the same way as the rollup
+        rows = (items
+                .values('bill__date', 'product_id', 'bill__dukandaar_id')
+                .annotate(revenue=Sum('amount'),
+                          kg_sold=Sum(F('kg') + F('bora') * F('product__one_bora_in_kg')),
+                          bill_count=Count('bill', distinct=True))
+                .order_by())
+
+        created = 0
+        with transaction.atomic():
+            rollups.delete()
+            batch = []
+            for row in rows.iterator(chunk_size=batch_size):
+                batch.append(DailySalesRollup(
+                    date=row['bill__date'],
+                    product_id=row['product_id'],
+                    dukandaar_id=row['bill__dukandaar_id'],
+                    revenue=row['revenue'] or 0,
+                    kg_sold=row['kg_sold'] or 0,
+                    bill_count=row['bill_count'],
+                ))
+                if len(batch) >= batch_size:
+                    DailySalesRollup.objects.bulk_create(batch)
+                    created += len(batch)
+                    batch = []
+            if batch:
+                DailySalesRollup.objects.bulk_create(batch)
+                created += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt daily sales rollup with {created} rows"))
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from inventory.reconcile import CHECKS, reconcile
+
+
+class Command(BaseCommand):
+    help = ("Recompute bill totals and pending amounts, dukandaar pending amounts, company loans and "
+            "product stock from the underlying rows and report the ones that drifted; --fix repairs "
+            "them in bulk. Meant to run nightly, e.g. with cron: "
+            "30 1 * * * cd /path/to/project && python manage.py reconcile --fix")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Set drifted balances to their recomputed value')
+        parser.add_argument('--checks', nargs='+', choices=list(CHECKS), help='Checks to run, all by default')
+        parser.add_argument('--show', type=int, default=10, help='Drifted rows listed per check')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows fixed per UPDATE')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        found = reconcile(options['fix'], options['checks'], options['batch_size'])
+
+        for name, drifts in found.items():
+            style = self.style.WARNING if drifts else self.style.SUCCESS
+            action = 'fixed' if options['fix'] and drifts else 'drifted'
+            self.stdout.write(style(f'{name}: {len(drifts)} {action}'))
+            for drift in drifts[:options['show']]:
+                self.stdout.write(f'  #{drift.pk}: stored {drift.stored:.2f}, expected {drift.expected:.2f}')
+            if len(drifts) > options['show']:
+                self.stdout.write(f'  ... and {len(drifts) - options["show"]} more')
+
+        self.stdout.write(f'Reconciled in {time.monotonic() - started:.1f}s')
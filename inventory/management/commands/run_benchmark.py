@@ -0,0 +1,137 @@
+import json
+import subprocess
+import tempfile
+from datetime import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from inventory.benchmark import benchmark_session, measure, rolled_back
+from inventory.cache import get_analytics_cache
+from inventory.ledger import BillLine, post_bill
+from inventory.models import Bill, Item, Dukandaar, Product, DailyCollection, PurchaseItem
+from inventory.pdf import load_bill_document, render_bill_pdf
+from inventory.utils import get_receivables_ageing
+
+# Median latency each path has to stay under, checked with --check-budgets
+LATENCY_BUDGETS_MS = {
+    'receivables ageing by dukandaar': 250,
+    'receivables ageing by area': 250,
+}
+
+
+class Command(BaseCommand):
+    help = ("Time the key paths (bill posting, PDF generation, analytics, get_unpaid_bills, admin "
+            "changelists), count their queries and write a JSON report. Seed the database with "
+            "seed_benchmark first.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--compare', help='Earlier JSON report to compare against')
+        parser.add_argument('--check-budgets', action='store_true',
+                            help='Fail when a path is slower than its budget in LATENCY_BUDGETS_MS')
+
+    def handle(self, *args, **options):
+        dukandaar = Dukandaar.objects.filter(bill__paid=False).first()
+        bill = Bill.objects.filter(items__isnull=False).order_by('-id').first()
+        if dukandaar is None or bill is None:
+            raise CommandError('No data to benchmark, run seed_benchmark first')
+        products = list(Product.objects.all()[:10])
+
+        client = Client()
+
+        def get(url):
+            def run():
+                response = client.get(url)
+                if response.status_code != 200:
+                    raise CommandError(f'{url} returned {response.status_code}')
+                if response.streaming:
+                    b''.join(response.streaming_content)
+            return run
+
+        def analytics_cold():
+            get_analytics_cache().clear()
+            get(reverse('analytics'))()
+
+        lines = [BillLine(products[i % len(products)], Decimal(1), Decimal(5), Decimal(30)) for i in range(30)]
+
+        def item_by_item():
+            new_bill = Bill.objects.create(dukandaar=dukandaar)
+            for line in lines:
+                Item.objects.create(bill=new_bill, product=line.product, bora=line.bora, kg=line.kg,
+                                    price_per_kg=line.price_per_kg)
+
+        paths = {
+            'bill posting, 30 lines, post_bill': rolled_back(lambda: post_bill(dukandaar, lines)),
+            'bill posting, 30 lines, Item.save': rolled_back(item_by_item),
+            'pdf render': lambda: render_bill_pdf(load_bill_document(bill.id)),
+            'pdf view (cached)': get(reverse('generatepdf', args=[bill.id])),
+            'analytics_view (cold cache)': analytics_cold,
+            'analytics_view (warm cache)': get(reverse('analytics')),
+            'get_unpaid_bills': get(reverse('get_unpaid_bills') + f'?dukandaar={dukandaar.id}'),
+            'receivables ageing by dukandaar': lambda: get_receivables_ageing('dukandaar'),
+            'receivables ageing by area': lambda: get_receivables_ageing('area'),
+            'receivables ageing view': get(reverse('receivables_ageing')),
+        }
+        for model in (Bill, Item, DailyCollection, PurchaseItem, Dukandaar, Product):
+            name = model._meta.model_name
+            paths[f'admin changelist {name}'] = get(reverse(f'admin:inventory_{name}_changelist'))
+
+        results = {}
+        # Logged in as a superuser created for the run, deleted with its session afterwards
+        with benchmark_session() as session_key, override_settings(BILL_PDF_CACHE_DIR=tempfile.mkdtemp()):
+            client.cookies[settings.SESSION_COOKIE_NAME] = session_key
+            for name, func in paths.items():
+                results[name] = measure(func, options['repeat'])
+                self.stdout.write(f"{name:<45} {results[name]['median_ms']:>9.2f} ms "
+                                  f"p95 {results[name]['p95_ms']:>9.2f} ms {results[name]['queries']:>5} queries")
+
+        report = {
+            'generated_at': datetime.now().isoformat(timespec='seconds'),
+            'commit': self.git_commit(),
+            'database': connection.vendor,
+            'rows': {model._meta.model_name: model.objects.count()
+                     for model in (Bill, Item, DailyCollection, Dukandaar, Product)},
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+        if options['compare']:
+            self.compare(options['compare'], results)
+        if options['check_budgets']:
+            self.check_budgets(results)
+
+    def git_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def check_budgets(self, results):
+        over = [f"{name}: {results[name]['median_ms']:.2f} ms, budget {budget} ms"
+                for name, budget in LATENCY_BUDGETS_MS.items()
+                if name in results and results[name]['median_ms'] > budget]
+        if over:
+            raise CommandError('Over latency budget:\n' + '\n'.join(over))
+        self.stdout.write(self.style.SUCCESS('All paths within their latency budgets'))
+
+    def compare(self, path, results):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        self.stdout.write(f"\nCompared with {path} (commit {baseline.get('commit')})")
+        for name, result in results.items():
+            before = baseline['results'].get(name)
+            if not before:
+                continue
+            change = (result['median_ms'] - before['median_ms']) / before['median_ms'] * 100 if before['median_ms'] else 0
+            line = (f"{name:<45} {before['median_ms']:>9.2f} -> {result['median_ms']:>9.2f} ms ({change:+.0f}%), "
+                    f"queries {before['queries']} -> {result['queries']}")
+            self.stdout.write(self.style.ERROR(line) if change > 20 else line)
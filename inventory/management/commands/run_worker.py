@@ -0,0 +1,82 @@
+import os
+import signal
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from inventory.jobs import TASKS, claim, purge, requeue_stale, run
+from inventory.pdf import prune_pdf_cache
+
+
+class Command(BaseCommand):
+    help = ("Run queued background jobs (PDF batches, statements, reports, backups) with a pool of "
+            "threads, each claiming the next due job from the Job table. Keep one running next to "
+            "the web server, e.g. under systemd or supervisor; SIGTERM finishes the running jobs and exits.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=getattr(settings, 'JOB_WORKER_THREADS', 2),
+                            help='Jobs run at the same time')
+        parser.add_argument('--tasks', nargs='+', help='Only run these tasks')
+        parser.add_argument('--poll-interval', type=float, default=2, help='Seconds between polls of an empty queue')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+        parser.add_argument('--purge-days', type=int, default=getattr(settings, 'JOB_RESULT_DAYS', 7),
+                            help='Delete finished jobs and their files after this many days')
+
+    def handle(self, *args, **options):
+        unknown = set(options['tasks'] or []) - set(TASKS)
+        if unknown:
+            raise CommandError(f"Unknown tasks: {', '.join(sorted(unknown))}")
+
+        self.stopping = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: self.stopping.set())
+
+        name = f'{socket.gethostname()}:{os.getpid()}'
+        threads = [
+            threading.Thread(target=self.work, name=f'{name}:{i}',
+                             args=(f'{name}:{i}', options['tasks'], options['poll_interval'], options['once']))
+            for i in range(options['concurrency'])
+        ]
+        self.housekeeping(options['purge_days'])
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f"Worker {name} running {options['concurrency']} jobs at a time")
+
+        last_housekeeping = time.monotonic()
+        # Joined with a timeout so the main thread keeps handling signals
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(0.5)
+            if time.monotonic() - last_housekeeping > 60:
+                self.housekeeping(options['purge_days'])
+                last_housekeeping = time.monotonic()
+        connection.close()
+
+    def housekeeping(self, purge_days):
+        requeued, failed = requeue_stale()
+        purged = purge(purge_days)
+        pruned = prune_pdf_cache()
+        if requeued or failed or purged or pruned:
+            self.stdout.write(f'Requeued {requeued} and failed {failed} stale jobs, purged {purged} old ones '
+                              f'and {pruned} unused bill PDFs')
+
+    def work(self, name, tasks, poll_interval, once):
+        try:
+            while not self.stopping.is_set():
+                job = claim(name, tasks)
+                if job is None:
+                    if once:
+                        return
+                    self.stopping.wait(poll_interval)
+                    continue
+                started = time.monotonic()
+                job = run(job)
+                self.stdout.write(f'Job {job.pk} ({job.task}) {job.status} after attempt {job.attempts} '
+                                  f'in {time.monotonic() - started:.1f}s')
+        finally:
+            # Every thread has its own database connection
+            connection.close()
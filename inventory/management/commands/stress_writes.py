@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.db.models import Max, Q
+from django.test import override_settings
+
+from inventory.ledger import BillLine, post_bill
+from inventory.models import Bill, DailySalesRollup, Dukandaar, Product, StockMovement
+
+# What the database ran with before inventory/db.py: rollback journal, full
+# sync, sqlite3's default 5 second timeout and deferred transactions
+UNTUNED = {
+    'SQLITE_PRAGMAS': {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'busy_timeout': 5000,
+                       'mmap_size': 0, 'cache_size': -2000, 'temp_store': 'DEFAULT'},
+    'SQLITE_IMMEDIATE_TRANSACTIONS': False,
+}
+
+
+class Command(BaseCommand):
+    help = ("Post bills from several threads while others read unpaid bills, like billing at the "
+            "counter alongside collection entry, and report write throughput and lock errors. "
+            "The bills are deleted again afterwards. Seed the database with seed_benchmark first.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8)
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--bills', type=int, default=25, help='Bills posted per writer')
+        parser.add_argument('--lines', type=int, default=10, help='Lines per bill')
+        parser.add_argument('--compare', action='store_true',
+                            help='Run once without the SQLite tuning first and compare')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('This stress test is for SQLite')
+        dukandaar_ids = list(Dukandaar.objects.values_list('pk', flat=True)[:200])
+        products = list(Product.objects.all()[:40])
+        if not dukandaar_ids or not products:
+            raise CommandError('No data to post bills against, run seed_benchmark first')
+
+        runs = {}
+        if options['compare']:
+            with override_settings(**UNTUNED):
+                runs['untuned'] = self.run(dukandaar_ids, products, options)
+        runs['tuned'] = self.run(dukandaar_ids, products, options)
+
+        for name, result in runs.items():
+            self.stdout.write(f"{name:<8} {result['bills']:>5} bills in {result['seconds']:>6.2f}s "
+                              f"{result['bills_per_second']:>7.1f} bills/s, {result['reads']:>6} reads, "
+                              f"{result['errors']} lock errors")
+        if 'untuned' in runs and runs['untuned']['bills_per_second']:
+            speedup = runs['tuned']['bills_per_second'] / runs['untuned']['bills_per_second']
+            self.stdout.write(self.style.SUCCESS(f'Write throughput x{speedup:.1f}'))
+
+    def run(self, dukandaar_ids, products, options):
+        # New connections pick up the pragmas of the current settings
+        connections.close_all()
+        connection.ensure_connection()
+        connection.close()
+
+        created, errors, reads = [], [], [0]
+        writing = threading.Event()
+        writing.set()
+
+        def writer(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in range(options['bills']):
+                    dukandaar = Dukandaar(pk=rng.choice(dukandaar_ids))
+                    lines = [BillLine(rng.choice(products), Decimal(1), Decimal(rng.randint(0, 20)), Decimal(30))
+                             for _ in range(options['lines'])]
+                    try:
+                        created.append(post_bill(dukandaar, lines)[0].bill_id)
+                    except OperationalError as error:
+                        errors.append(error)
+            finally:
+                connection.close()
+
+        def reader(seed):
+            rng = random.Random(seed)
+            try:
+                while writing.is_set():
+                    try:
+                        list(Bill.objects.filter(dukandaar_id=rng.choice(dukandaar_ids), paid=False)
+                             .values('id', 'date', 'pending_amount'))
+                        reads[0] += 1
+                    except OperationalError as error:
+                        errors.append(error)
+            finally:
+                connection.close()
+
+        writers = [threading.Thread(target=writer, args=(i,)) for i in range(options['writers'])]
+        readers = [threading.Thread(target=reader, args=(1000 + i,)) for i in range(options['readers'])]
+        started = time.perf_counter()
+        for thread in writers + readers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        seconds = time.perf_counter() - started
+        writing.clear()
+        for thread in readers:
+            thread.join()
+
+        self.remove_bills(created)
+        return {
+            'bills': len(created),
+            'seconds': seconds,
+            'bills_per_second': len(created) / seconds,
+            'reads': reads[0],
+            'errors': len(errors),
+        }
+
+    def remove_bills(self, bill_ids):
+        # Deleting a bill restores the shops, stock and rollup, journalling a reversal of each
+        # sale; the sales and their reversals are then dropped, as are the rollup rows the
+        # bills created and left at zero, which a rebuild would not produce
+        bills = Bill.objects.filter(pk__in=bill_ids)
+        days = set(bills.values_list('date', flat=True))
+        sales = list(StockMovement.objects.filter(bill_id__in=bill_ids).values_list('pk', flat=True))
+        last = StockMovement.objects.aggregate(last=Max('pk'))['last'] or 0
+        for bill in bills.select_related('dukandaar'):
+            bill.delete()
+        StockMovement.objects.filter(Q(pk__in=sales) | Q(pk__gt=last)).delete()
+        DailySalesRollup.objects.filter(date__in=days, revenue=0, kg_sold=0, bill_count=0).delete()
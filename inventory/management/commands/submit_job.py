@@ -0,0 +1,25 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.jobs import TASKS, submit
+
+
+class Command(BaseCommand):
+    help = ("Queue a background job for run_worker, e.g. the nightly backup from cron: "
+            "0 0 * * * cd /path/to/project && python manage.py submit_job backup")
+
+    def add_arguments(self, parser):
+        parser.add_argument('task', choices=sorted(TASKS))
+        parser.add_argument('--kwargs', default='{}', help='Task arguments as a JSON object')
+        parser.add_argument('--max-attempts', type=int, help='Attempts before the job is failed')
+
+    def handle(self, *args, **options):
+        try:
+            kwargs = json.loads(options['kwargs'])
+            if not isinstance(kwargs, dict):
+                raise ValueError('--kwargs must be a JSON object')
+            job = submit(options['task'], max_attempts=options['max_attempts'], **kwargs)
+        except ValueError as error:
+            raise CommandError(error)
+        self.stdout.write(self.style.SUCCESS(f"Queued job {job.pk} ({job.task})"))
@@ -0,0 +1,189 @@
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager, nullcontext
+from contextvars import ContextVar
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+logger = logging.getLogger('inventory.requests')
+
+IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+ENDPOINTS_KEY = 'profiling:endpoints'
+ENDPOINT_KEY = 'profiling:endpoint:{}'
+
+# The recorder of the request being profiled; asgiref carries it into sync_to_async threads
+current_recorder = ContextVar('current_recorder', default=None)
+
+
+def fingerprint(sql):
+    """SQL with IN lists collapsed, so the same statement issued per row groups together."""
+    return IN_LIST.sub('IN (...)', sql)
+
+
+class QueryRecorder:
+    """connection.execute_wrapper() callable recording each statement and its duration."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, (time.perf_counter() - started) * 1000))
+
+    def summary(self, slowest=5):
+        fingerprints = Counter(fingerprint(sql) for sql, _ in self.queries)
+        return {
+            'queries': len(self.queries),
+            'db_ms': round(sum(duration for _, duration in self.queries), 2),
+            'slowest': [{'sql': sql[:500], 'ms': round(duration, 2)}
+                        for sql, duration in sorted(self.queries, key=lambda query: -query[1])[:slowest]],
+            'duplicates': [{'sql': sql[:500], 'count': count}
+                           for sql, count in fingerprints.most_common() if count > 1][:slowest],
+        }
+
+
+@contextmanager
+def recording(recorder):
+    """
+    Record with recorder every query of this thread's connections, and of
+    the work handed to other threads that record_queries() their own.
+    """
+    token = current_recorder.set(recorder)
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            yield recorder
+    finally:
+        current_recorder.reset(token)
+
+
+def record_queries(connection):
+    """
+    Record connection's queries with the profiled request's recorder. For
+    work the request hands to other threads, whose connections the
+    middleware does not wrap (see cache.aget_cached_widgets); a no-op when
+    the request is not profiled.
+    """
+    recorder = current_recorder.get()
+    return connection.execute_wrapper(recorder) if recorder else nullcontext()
+
+
+class RequestProfilingMiddleware:
+    """
+    Records, for a sample of requests, the number of queries, total database
+    time, the slowest statements and statements repeated within the request
+    (the usual sign of an N+1). Works with DEBUG=False since it uses an execute
+    wrapper instead of connection.queries. Results are logged to
+    'inventory.requests' and aggregated per endpoint for the slow endpoints page.
+
+    Staff can profile a single request with ?_profile=1 even when sampling is off.
+
+    Under ASGI unprofiled requests stay async; a profiled one is run in a
+    thread, like a sync view, so the execute wrappers see its queries. Work
+    it hands to other threads is recorded through record_queries().
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def sampled(self):
+        if not getattr(settings, 'REQUEST_PROFILING_ENABLED', False):
+            return False
+        return random.random() < getattr(settings, 'REQUEST_PROFILING_SAMPLE_RATE', 0.1)
+
+    def should_profile(self, request):
+        if request.GET.get('_profile') and getattr(request, 'user', None) and request.user.is_staff:
+            return True
+        return self.sampled()
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.should_profile(request):
+            return self.get_response(request)
+        return self.profile(request, self.get_response)
+
+    async def __acall__(self, request):
+        # Reading request.user for ?_profile queries the session, which must not run on the event loop
+        if request.GET.get('_profile'):
+            profile = await sync_to_async(self.should_profile)(request)
+        else:
+            profile = self.sampled()
+        if not profile:
+            return await self.get_response(request)
+        return await sync_to_async(self.profile)(request, async_to_sync(self.get_response))
+
+    def profile(self, request, get_response):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with recording(recorder):
+            response = get_response(request)
+        duration = (time.perf_counter() - started) * 1000
+
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.view_name if match else request.path
+        record = {
+            'endpoint': endpoint,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(duration, 2),
+            **recorder.summary(),
+        }
+        slow_ms = getattr(settings, 'REQUEST_PROFILING_SLOW_MS', 500)
+        log = logger.warning if duration >= slow_ms or record['duplicates'] else logger.info
+        log(json.dumps(record, default=str))
+        record_endpoint(record)
+        return response
+
+
+def get_profiling_cache():
+    return caches[getattr(settings, 'REQUEST_PROFILING_CACHE_ALIAS', 'default')]
+
+
+def record_endpoint(record):
+    cache = get_profiling_cache()
+    key = ENDPOINT_KEY.format(record['endpoint'])
+    stats = cache.get(key) or {
+        'endpoint': record['endpoint'], 'count': 0, 'total_ms': 0, 'max_ms': 0,
+        'total_queries': 0, 'max_queries': 0, 'slowest': [], 'duplicates': [],
+    }
+    stats['count'] += 1
+    stats['total_ms'] += record['duration_ms']
+    stats['total_queries'] += record['queries']
+    stats['max_queries'] = max(stats['max_queries'], record['queries'])
+    if record['duration_ms'] >= stats['max_ms']:
+        stats['max_ms'] = record['duration_ms']
+        stats['slowest'] = record['slowest']
+        stats['duplicates'] = record['duplicates']
+    cache.set(key, stats, timeout=None)
+
+    endpoints = cache.get(ENDPOINTS_KEY) or []
+    if record['endpoint'] not in endpoints:
+        cache.set(ENDPOINTS_KEY, endpoints + [record['endpoint']], timeout=None)
+
+
+def get_endpoint_stats():
+    """Aggregated profiling results per endpoint, slowest average first."""
+    cache = get_profiling_cache()
+    endpoints = cache.get(ENDPOINTS_KEY) or []
+    stats = list(cache.get_many([ENDPOINT_KEY.format(endpoint) for endpoint in endpoints]).values())
+    for stat in stats:
+        stat['avg_ms'] = round(stat['total_ms'] / stat['count'], 2)
+        stat['avg_queries'] = round(stat['total_queries'] / stat['count'], 1)
+    return sorted(stats, key=lambda stat: -stat['avg_ms'])
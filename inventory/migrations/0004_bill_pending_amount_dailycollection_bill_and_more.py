@@ -0,0 +1,29 @@
+# Generated by Django 4.2.16 on 2026-10-18 12:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0003_alter_product_one_bora_in_kg'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bill',
+            name='pending_amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='dailycollection',
+            name='bill',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='inventory.bill'),
+        ),
+        migrations.AlterField(
+            model_name='dukandaar',
+            name='address',
+            field=models.CharField(blank=True, default='', max_length=50, null=True),
+        ),
+    ]
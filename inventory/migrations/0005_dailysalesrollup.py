@@ -0,0 +1,49 @@
+# Generated by Django 4.2.16 on 2026-10-18 12:50
+
+from django.db import migrations, models
+from django.db.models import Count, F, Sum
+import django.db.models.deletion
+
+
+def populate_rollup(apps, schema_editor):
+    Item = apps.get_model('inventory', 'Item')
+    DailySalesRollup = apps.get_model('inventory', 'DailySalesRollup')
+    rows = (Item.objects
+            .values('bill__date', 'product_id', 'bill__dukandaar_id')
+            .annotate(revenue=Sum('amount'),
+                      kg_sold=Sum(F('kg') + F('bora') * F('product__one_bora_in_kg')),
+                      bill_count=Count('bill', distinct=True))
+            .order_by())
+    DailySalesRollup.objects.bulk_create([
+        DailySalesRollup(date=row['bill__date'], product_id=row['product_id'],
+                         dukandaar_id=row['bill__dukandaar_id'], revenue=row['revenue'] or 0,
+                         kg_sold=row['kg_sold'] or 0, bill_count=row['bill_count'])
+        for row in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0004_bill_pending_amount_dailycollection_bill_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('kg_sold', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('bill_count', models.IntegerField(default=0)),
+                ('dukandaar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inventory.dukandaar')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inventory.product')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dailysalesrollup',
+            constraint=models.UniqueConstraint(fields=('date', 'product', 'dukandaar'), name='unique_daily_sales_rollup'),
+        ),
+        migrations.RunPython(populate_rollup, migrations.RunPython.noop),
+    ]
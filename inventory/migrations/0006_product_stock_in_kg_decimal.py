@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 12:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0005_dailysalesrollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='stock_in_kg',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.16 on 2026-10-18 12:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0006_product_stock_in_kg_decimal'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['date'], name='bill_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(condition=models.Q(('paid', False)), fields=['dukandaar', 'date'], name='bill_unpaid_dukandaar_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dailycollection',
+            index=models.Index(fields=['collection_time'], name='collection_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dailycollection',
+            index=models.Index(fields=['dukandaar', 'collection_time'], name='collection_dukandaar_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchaseorder',
+            index=models.Index(fields=['date'], name='purchase_order_date_idx'),
+        ),
+    ]
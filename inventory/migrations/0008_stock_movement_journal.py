@@ -0,0 +1,67 @@
+# Generated by Django 4.2.16 on 2026-10-18 13:23
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def open_stock_journal(apps, schema_editor):
+    # Average cost from the purchase history, and the current stock as each product's opening movement
+    Product = apps.get_model('inventory', 'Product')
+    PurchaseItem = apps.get_model('inventory', 'PurchaseItem')
+    StockMovement = apps.get_model('inventory', 'StockMovement')
+    purchases = {row['product_id']: row for row in (
+        PurchaseItem.objects.values('product_id')
+        .annotate(value=Sum('amount'), kg=Sum(F('kg') + F('bora') * F('product__one_bora_in_kg')))
+        .order_by()
+    )}
+    today = timezone.localdate()
+    products, movements = [], []
+    for product in Product.objects.all():
+        bought = purchases.get(product.pk)
+        if bought and bought['kg']:
+            product.average_cost = (Decimal(bought['value']) / Decimal(bought['kg'])).quantize(Decimal('0.0001'))
+            products.append(product)
+        movements.append(StockMovement(
+            product=product, date=today, kind='opening', kg=product.stock_in_kg,
+            unit_cost=product.average_cost, value=round(product.stock_in_kg * Decimal(product.average_cost), 2),
+        ))
+    Product.objects.bulk_update(products, ['average_cost'], batch_size=1000)
+    StockMovement.objects.bulk_create(movements, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0007_bill_date_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='average_cost',
+            field=models.DecimalField(decimal_places=4, default=0, editable=False, max_digits=12),
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('kind', models.CharField(choices=[('opening', 'Opening balance'), ('purchase', 'Purchase'), ('sale', 'Sale'), ('adjustment', 'Adjustment')], max_length=10)),
+                ('kg', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('unit_cost', models.DecimalField(decimal_places=4, max_digits=12)),
+                ('value', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('bill', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='inventory.bill')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='inventory.product')),
+                ('purchase_order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='inventory.purchaseorder')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product', 'date'], name='stock_movement_product_idx')],
+            },
+        ),
+        migrations.RunPython(open_stock_journal, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.16 on 2026-10-18 14:10
+
+from decimal import Decimal
+
+from django.db import migrations
+from django.db.models import F, Sum
+from django.utils import timezone
+
+
+def restate_opening_stock(apps, schema_editor):
+    # 0008 journalled each product's whole stock as its opening movement, though the bill and
+    # purchase lines before it explain part of it; reconcile counts those lines as well, so the
+    # opening movement must only carry the rest. Products whose lines and journal already add up
+    # to their stock are left alone, so this is a no-op when run again.
+    Product = apps.get_model('inventory', 'Product')
+    Item = apps.get_model('inventory', 'Item')
+    PurchaseItem = apps.get_model('inventory', 'PurchaseItem')
+    StockMovement = apps.get_model('inventory', 'StockMovement')
+    kg = F('kg') + F('bora') * F('product__one_bora_in_kg')
+    bought = dict(PurchaseItem.objects.values_list('product_id').annotate(kg=Sum(kg)).order_by())
+    sold = dict(Item.objects.values_list('product_id').annotate(kg=Sum(kg)).order_by())
+    journalled = dict(StockMovement.objects.filter(kind__in=['opening', 'adjustment'])
+                      .values_list('product_id').annotate(kg=Sum('kg')).order_by())
+    openings = {}
+    for movement in StockMovement.objects.filter(kind='opening').order_by('id'):
+        openings.setdefault(movement.product_id, movement)
+    today = timezone.localdate()
+    changed, created = [], []
+    for product in Product.objects.all():
+        explained = (Decimal(bought.get(product.pk) or 0) - Decimal(sold.get(product.pk) or 0)
+                     + Decimal(journalled.get(product.pk) or 0))
+        gap = product.stock_in_kg - explained
+        if not gap:
+            continue
+        opening = openings.get(product.pk)
+        if opening is None:
+            opening = StockMovement(product=product, date=today, kind='opening', kg=0,
+                                    unit_cost=product.average_cost)
+            created.append(opening)
+        else:
+            changed.append(opening)
+        opening.kg += gap
+        opening.value = round(opening.kg * Decimal(opening.unit_cost), 2)
+    StockMovement.objects.bulk_update(changed, ['kg', 'value'], batch_size=1000)
+    StockMovement.objects.bulk_create(created, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0008_stock_movement_journal'),
+    ]
+
+    operations = [
+        migrations.RunPython(restate_opening_stock, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,25 @@
-from django.db import models
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q, Case, When, Value, DecimalField, ExpressionWrapper, Exists, FloatField, OuterRef
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from .db import immediate_atomic
+
+
+def apply_deltas(instance, **deltas):
+    """
+    Add deltas to columns of instance's row with a single column-limited
+    UPDATE using F() expressions, so concurrent writers never lose updates.
+    The in-memory instance is adjusted by the same amounts.
+    """
+    type(instance).objects.filter(pk=instance.pk).update(
+        **{field: F(field) + delta for field, delta in deltas.items()}
+    )
+    for field, delta in deltas.items():
+        setattr(instance, field, getattr(instance, field) + delta)
 
 class Area(models.Model):
     city_name = models.CharField(max_length=15, blank=False, default="Jehanabad")
@@ -17,9 +38,12 @@ class Company(models.Model):
 
 class Product(models.Model):
     name = models.CharField(max_length=255, blank=False, null=False)
-    stock_in_kg = models.IntegerField(default=0, blank=False)
+    # Decimal like Item.kg, so fractional sales and purchases are kept exactly
+    stock_in_kg = models.DecimalField(max_digits=14, decimal_places=2, default=0, blank=False)
     one_bora_in_kg = models.IntegerField(default=1, blank=False)
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    # Weighted-average purchase cost per kg, maintained by StockMovement.record
+    average_cost = models.DecimalField(max_digits=12, decimal_places=4, default=0, editable=False)
 
     @property
     def stock_in_bora(self):
@@ -48,15 +72,55 @@ class Bill(models.Model):
     pending_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
     paid = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['date'], name='bill_date_idx'),
+            # Unpaid bills of a shop, oldest first: get_unpaid_bills, the collection form, dues reports
+            models.Index(fields=['dukandaar', 'date'], condition=models.Q(paid=False), name='bill_unpaid_dukandaar_idx'),
+        ]
+
+    @immediate_atomic
     def save(self, *args, **kwargs):
+        if not self._state.adding:
+            stored = Bill.objects.only('paid', 'total_amount', 'pending_amount').get(pk=self.pk)
+            self.total_amount, self.pending_amount = stored.total_amount, stored.pending_amount
+            if self.paid != stored.paid and not self.dailycollection_set.exists():
+                # Ticking paid settles the bill outside the collections, unticking owes its total again
+                pending = Decimal(0) if self.paid else self.total_amount
+                apply_deltas(self.dukandaar, pending_amount=pending - self.pending_amount)
+                self.pending_amount = pending
         super().save(*args, **kwargs)
 
+    def post_amount(self, amount):
+        """
+        Add amount, of item lines posted (or taken off when negative), to the
+        bill. A bill paid with nothing collected against it was settled
+        outside the collections (created, imported or ticked as paid) and has
+        nothing pending, so only its total changes. Any other bill has its
+        total less its collections pending, which its shop owes too, and once
+        something was collected against it, it is paid while nothing is left
+        pending. reconcile.bill_pending checks the same rule.
+        """
+        collected = self.dailycollection_set.exists()
+        if self.paid and not collected:
+            apply_deltas(self, total_amount=amount)
+            return
+        apply_deltas(self, total_amount=amount, pending_amount=amount)
+        apply_deltas(self.dukandaar, pending_amount=amount)
+        if collected:
+            Bill.objects.filter(pk=self.pk).update(
+                paid=Case(When(pending_amount__lte=0, then=Value(True)), default=Value(False))
+            )
+            self.paid = self.pending_amount <= 0
+
+    @immediate_atomic
     def delete(self, *args, **kwargs):
-        if not self.paid:
-            self.dukandaar.pending_amount -= self.pending_amount
-            self.dukandaar.save()
-        for item in self.items.all():
+        # Each Item.delete takes its amount off this bill and, unless settled outside the collections, the shop
+        for item in self.items.select_related('product'):
             item.delete()
+        if self.pending_amount:
+            # What is left pending is minus what was collected; those collections go with the bill
+            apply_deltas(self.dukandaar, pending_amount=-self.pending_amount)
         super().delete(*args, **kwargs)
 
     def __str__(self):
@@ -70,27 +134,193 @@ class Item(models.Model):
     price_per_kg = models.DecimalField(max_digits=10, decimal_places=2)
     amount = models.DecimalField(max_digits=20, decimal_places=2, editable=False)
 
+    def calculate_amount(self):
+        return (self.kg * self.price_per_kg) + (self.bora * self.price_per_kg * self.product.one_bora_in_kg)
+
+    @property
+    def kg_sold(self):
+        return (self.bora * self.product.one_bora_in_kg) + self.kg
+
+    def _first_of_product_in_bill(self):
+        # Whether this is the only line of its product on the bill, used for the rollup bill count
+        return not Item.objects.filter(bill_id=self.bill_id, product_id=self.product_id).exclude(pk=self.pk).exists()
+
+    def _post(self, sign):
+        # Apply (sign=1) or reverse (sign=-1) this line on the bill, shop, stock and rollup
+        amount = sign * self.amount
+        self.bill.post_amount(amount)
+        StockMovement.record(self.product, StockMovement.SALE, -sign * self.kg_sold,
+                             date=self.bill.date, bill=self.bill)
+        DailySalesRollup.record(
+            self.bill.date, self.product_id, self.bill.dukandaar_id,
+            revenue=amount,
+            kg_sold=sign * self.kg_sold,
+            bill_count=sign if self._first_of_product_in_bill() else 0,
+        )
+
+    @immediate_atomic
     def save(self, *args, **kwargs):
-        self.amount = (self.kg * self.price_per_kg) + (self.bora * self.price_per_kg * self.product.one_bora_in_kg)
+        if not self._state.adding:
+            Item.objects.select_related('bill__dukandaar', 'product').get(pk=self.pk)._post(-1)
+        self.amount = self.calculate_amount()
         super().save(*args, **kwargs)
-        self.bill.total_amount += self.amount
-        if not self.bill.paid:
-            self.bill.pending_amount += self.amount
-            self.bill.dukandaar.pending_amount += self.amount
-            self.bill.dukandaar.save()
-        self.bill.save()
-        self.product.stock_in_kg -= ((self.bora * self.product.one_bora_in_kg) + self.kg)
-        self.product.save()
+        self._post(1)
 
+    @immediate_atomic
     def delete(self, *args, **kwargs):
-        self.product.stock_in_kg += (self.bora * self.product.one_bora_in_kg)
-        self.product.save()
+        self._post(-1)
         super().delete(*args, **kwargs)
 
     def __str__(self):
         return f"{self.product.name} - {self.kg} kg @ {self.price_per_kg} per kg {self.bill} Bill order "
 
 
+class DailySalesRollup(models.Model):
+    """
+    Sales pre-aggregated per day, product and dukandaar. Kept up to date by
+    Item.save / Item.delete and rebuilt by the rebuild_sales_rollup command.
+    """
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    dukandaar = models.ForeignKey(Dukandaar, on_delete=models.CASCADE)
+    revenue = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    kg_sold = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    bill_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'product', 'dukandaar'], name='unique_daily_sales_rollup'),
+        ]
+
+    @classmethod
+    def record(cls, date, product_id, dukandaar_id, revenue=0, kg_sold=0, bill_count=0):
+        """Add the given deltas to the (date, product, dukandaar) row, creating it if needed."""
+        rows = cls.objects.filter(date=date, product_id=product_id, dukandaar_id=dukandaar_id)
+        deltas = {
+            'revenue': F('revenue') + revenue,
+            'kg_sold': F('kg_sold') + kg_sold,
+            'bill_count': F('bill_count') + bill_count,
+        }
+        if rows.update(**deltas):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(date=date, product_id=product_id, dukandaar_id=dukandaar_id,
+                                   revenue=revenue, kg_sold=kg_sold, bill_count=bill_count)
+        except IntegrityError:
+            # Another writer created the row in the meantime
+            rows.update(**deltas)
+
+    def __str__(self):
+        return f"{self.date} - {self.product_id} - {self.dukandaar_id} - {self.revenue}"
+
+
+class StockMovement(models.Model):
+    """
+    Append-only journal of stock changes. Reversals (edited or deleted lines)
+    are new movements with the opposite sign, never updates of old ones.
+
+    Opening and adjustment movements carry the stock that bill and purchase
+    lines do not explain, such as counts entered by hand, so stock_in_kg is
+    always purchased - sold + opening + adjustments (see reconcile.py).
+    """
+    OPENING = 'opening'
+    PURCHASE = 'purchase'
+    SALE = 'sale'
+    ADJUSTMENT = 'adjustment'
+    KIND_CHOICES = [
+        (OPENING, 'Opening balance'),
+        (PURCHASE, 'Purchase'),
+        (SALE, 'Sale'),
+        (ADJUSTMENT, 'Adjustment'),
+    ]
+
+    product = models.ForeignKey(Product, related_name='movements', on_delete=models.CASCADE)
+    date = models.DateField()
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    kg = models.DecimalField(max_digits=14, decimal_places=2)
+    unit_cost = models.DecimalField(max_digits=12, decimal_places=4)
+    value = models.DecimalField(max_digits=20, decimal_places=2)
+    bill = models.ForeignKey(Bill, null=True, blank=True, on_delete=models.SET_NULL)
+    purchase_order = models.ForeignKey('PurchaseOrder', null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'date'], name='stock_movement_product_idx'),
+        ]
+
+    @classmethod
+    def record(cls, product, kind, kg, unit_cost=None, date=None, bill=None, purchase_order=None):
+        """
+        Journal kg (signed) of product and update its stock and average cost
+        in one UPDATE, so the cost of a movement never depends on the history.
+
+        Inbound movements with a unit_cost (purchases, opening balances) are
+        blended into the weighted average; a reversal with a negative kg takes
+        its cost back out. Sales and adjustments move stock at the current
+        average, which they leave unchanged.
+        """
+        average_cost = F('average_cost')
+        if unit_cost is not None:
+            decimal = DecimalField(max_digits=12, decimal_places=4)
+            # Float so SQLite does not truncate the division when every operand is a whole number
+            stock = Cast('stock_in_kg', FloatField())
+            blended = ExpressionWrapper(
+                (stock * F('average_cost') + kg * unit_cost) / (stock + kg),
+                output_field=decimal,
+            )
+            whens = [When(stock_in_kg__gt=-kg, then=blended)]
+            if kg > 0:
+                # Nothing (or less) on hand: the stock now costs what was just paid
+                whens.insert(0, When(stock_in_kg__lte=0, then=Value(unit_cost, output_field=decimal)))
+            average_cost = Case(*whens, default=F('average_cost'))
+        Product.objects.filter(pk=product.pk).update(stock_in_kg=F('stock_in_kg') + kg, average_cost=average_cost)
+        product.stock_in_kg += kg
+        product.average_cost = Product.objects.values_list('average_cost', flat=True).get(pk=product.pk)
+        if unit_cost is None:
+            unit_cost = product.average_cost
+        return cls.objects.create(
+            product=product, kind=kind, kg=kg, unit_cost=unit_cost, value=round(kg * unit_cost, 2),
+            date=date or timezone.localdate(), bill=bill, purchase_order=purchase_order,
+        )
+
+    @staticmethod
+    def blend_cost(stock, average_cost, kg, unit_cost):
+        """The average cost after kg at unit_cost comes in, as computed by the UPDATE in record()."""
+        if kg > 0 and stock <= 0:
+            return unit_cost
+        if stock > -kg:
+            return ((stock * average_cost + kg * unit_cost) / (stock + kg)).quantize(Decimal('0.0001'))
+        return average_cost
+
+    @classmethod
+    def record_many(cls, movements):
+        """
+        record() for a batch of unsaved movements, in the order given: costs
+        are worked out in memory, the movements written with one bulk_create
+        and each product updated once. Must run inside a transaction.
+        """
+        product_ids = {movement.product_id for movement in movements}
+        state = {pk: [stock, average_cost] for pk, stock, average_cost in
+                 Product.objects.select_for_update().filter(pk__in=product_ids)
+                 .values_list('pk', 'stock_in_kg', 'average_cost')}
+        for movement in movements:
+            stock, average_cost = state[movement.product_id]
+            if movement.unit_cost is None:
+                movement.unit_cost = average_cost
+            else:
+                state[movement.product_id][1] = cls.blend_cost(stock, average_cost, movement.kg, movement.unit_cost)
+            state[movement.product_id][0] = stock + movement.kg
+            movement.value = round(movement.kg * movement.unit_cost, 2)
+        cls.objects.bulk_create(movements)
+        for pk, (stock, average_cost) in state.items():
+            Product.objects.filter(pk=pk).update(stock_in_kg=stock, average_cost=average_cost)
+
+    def __str__(self):
+        return f"{self.date} - {self.product_id} - {self.kind} - {self.kg} kg"
+
+
 class DailyCollection(models.Model):
     dukandaar = models.ForeignKey(Dukandaar, related_name='dukandaar', on_delete=models.CASCADE)
     bill = models.ForeignKey(Bill, on_delete=models.CASCADE, null=True, blank=True)
@@ -98,33 +328,48 @@ class DailyCollection(models.Model):
     amount_collected = models.DecimalField(max_digits=10, decimal_places=2)
     pending_amount_as_of_today = models.DecimalField(max_digits=10, decimal_places=2, editable=False, default=0)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['collection_time'], name='collection_time_idx'),
+            models.Index(fields=['dukandaar', 'collection_time'], name='collection_dukandaar_time_idx'),
+        ]
+
+    def _post(self, sign):
+        # Apply (sign=1) or reverse (sign=-1) this collection on the bill and the shop
+        amount = sign * self.amount_collected
+        if self.bill_id:
+            # Compared against the pending amount before this update, i.e. the bill is settled
+            # once nothing is left pending and reopened when a reversal leaves something pending
+            if sign > 0:
+                paid = Case(When(pending_amount__lte=amount, then=Value(True)), default=F('paid'))
+            else:
+                paid = Case(When(pending_amount__gt=amount, then=Value(False)), default=F('paid'))
+            Bill.objects.filter(pk=self.bill_id).update(pending_amount=F('pending_amount') - amount, paid=paid)
+            self.bill.pending_amount -= amount
+            if (self.bill.pending_amount <= 0) == (sign > 0):
+                self.bill.paid = sign > 0
+        apply_deltas(self.dukandaar, pending_amount=-amount)
+
+    @immediate_atomic
     def save(self, *args, **kwargs):
+        if not self._state.adding:
+            DailyCollection.objects.select_related('bill', 'dukandaar').get(pk=self.pk)._post(-1)
         self.pending_amount_as_of_today = self.dukandaar.pending_amount - self.amount_collected
-
-        # Reduce the pending amount of the bill if a bill is associated
-        if self.bill:
-            self.bill.pending_amount -= self.amount_collected
-            self.bill.save()
-            if self.bill.pending_amount <= 0:
-                self.bill.paid = True
-                self.bill.save()
-
         super().save(*args, **kwargs)
-        self.dukandaar.pending_amount -= self.amount_collected
-        self.dukandaar.save()
-
-    def __delete__(self,  *args, **kwargs):
-        if self.bill:
-            self.bill.pending_amount += self.amount_collected
-            self.bill.save()
-            if self.bill.pending_amount > 0:
-                self.bill.paid = False
-                self.bill.save()
+        self._post(1)
+
+    @immediate_atomic
+    def delete(self, *args, **kwargs):
+        self._post(-1)
         super().delete(*args, **kwargs)
 
     def __str__(self):
         return f"Collection by {self.dukandaar} on {self.collection_time}"
 
+def settled_outside_collections():
+    """Q of the bills paid with nothing collected against them, which have nothing pending, see Bill.post_amount."""
+    return Q(paid=True) & ~Exists(DailyCollection.objects.filter(bill=OuterRef('pk')))
+
 class PurchaseOrder(models.Model):
     id = models.AutoField(primary_key=True, blank=False)
     date = models.DateField(auto_now_add=True)
@@ -132,10 +377,15 @@ class PurchaseOrder(models.Model):
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
     disc_percent = models.DecimalField(max_digits=4, decimal_places=2, default=2)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['date'], name='purchase_order_date_idx'),
+        ]
+
+    @immediate_atomic
     def delete(self, *args, **kwargs):
-        self.company.loan_amount -= self.total_amount
-        self.company.save()
-        for item in self.purchase_order.all():
+        # Each PurchaseItem.delete takes its amount off the total and the company loan
+        for item in self.purchase_order.select_related('product', 'purchase_order__company'):
             item.delete()
         super().delete(*args, **kwargs)
 
@@ -150,22 +400,30 @@ class PurchaseItem(models.Model):
     price_per_kg = models.DecimalField(max_digits=10, decimal_places=2)
     amount = models.DecimalField(max_digits=10, decimal_places=2, editable=False)
 
+    @property
+    def kg_bought(self):
+        return (self.bora * self.product.one_bora_in_kg) + self.kg
+
+    def _post(self, sign):
+        # Apply (sign=1) or reverse (sign=-1) this line on the order, company loan and stock
+        amount = sign * self.amount
+        apply_deltas(self.purchase_order, total_amount=amount)
+        apply_deltas(self.purchase_order.company, loan_amount=amount)
+        StockMovement.record(self.product, StockMovement.PURCHASE, sign * self.kg_bought,
+                             unit_cost=self.price_per_kg, date=self.purchase_order.date,
+                             purchase_order=self.purchase_order)
+
+    @immediate_atomic
     def save(self, *args, **kwargs):
+        if not self._state.adding:
+            PurchaseItem.objects.select_related('purchase_order__company', 'product').get(pk=self.pk)._post(-1)
         self.amount = (self.kg * self.price_per_kg) + (self.bora * self.price_per_kg * self.product.one_bora_in_kg)
         super().save(*args, **kwargs)
-        self.purchase_order.total_amount += self.amount
-        self.purchase_order.company.loan_amount += self.amount
-        self.purchase_order.company.save()
-        self.product.stock_in_kg += ((self.bora * self.product.one_bora_in_kg) + self.kg)
-        self.product.save()
+        self._post(1)
 
+    @immediate_atomic
     def delete(self, *args, **kwargs):
-        self.purchase_order.total_amount -= self.amount
-        self.purchase_order.company.loan_amount -= self.amount
-        self.purchase_order.company.save()
-        self.purchase_order.save()
-        self.product.stock_in_kg -= ((self.bora * self.product.one_bora_in_kg) + self.kg)
-        self.product.save()
+        self._post(-1)
         super().delete(*args, **kwargs)
 
     def __str__(self):
@@ -176,10 +434,59 @@ class CompanyPayment(models.Model):
     payment_date = models.DateField(auto_now_add=True)
     amount_paid = models.DecimalField(max_digits=10, decimal_places=2)
 
+    @immediate_atomic
     def save(self, *args, **kwargs):
+        if not self._state.adding:
+            previous = CompanyPayment.objects.select_related('company').get(pk=self.pk)
+            apply_deltas(previous.company, loan_amount=previous.amount_paid)
         super().save(*args, **kwargs)
-        self.company.loan_amount -= self.amount_paid
-        self.company.save()
+        apply_deltas(self.company, loan_amount=-self.amount_paid)
+
+    @immediate_atomic
+    def delete(self, *args, **kwargs):
+        apply_deltas(self.company, loan_amount=self.amount_paid)
+        super().delete(*args, **kwargs)
+
+    def __str__(self):
+        return f"Paid to {self.company} on {self.payment_date}"
+
+class Job(models.Model):
+    """
+    A unit of background work, run by `manage.py run_worker` (see jobs.py).
+    The table is the queue: workers claim the oldest due job with a
+    conditional UPDATE, so no broker is needed.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    task = models.CharField(max_length=50)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    # What the task returned, e.g. the name of the file it wrote
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    submitted_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Claiming: the oldest due job that is still queued
+            models.Index(fields=['run_after', 'id'], condition=models.Q(status='queued'), name='job_queued_idx'),
+        ]
 
     def __str__(self):
-        return f"Paid to {self.company} on {self.payment_date}"
\ No newline at end of file
+        return f"{self.id} - {self.task} - {self.status}"
@@ -0,0 +1,175 @@
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import django
+from django.conf import settings
+from django.db.models import Prefetch
+from django.template.loader import get_template
+from pypdf import PdfReader, PdfWriter
+from xhtml2pdf import pisa
+
+from .models import Bill, Item
+
+
+class PdfRenderError(Exception):
+    pass
+
+
+def get_pdf_cache_dir():
+    return getattr(settings, 'BILL_PDF_CACHE_DIR', os.path.join(settings.MEDIA_ROOT, 'bill_pdfs'))
+
+
+def bill_document_queryset():
+    """
+    Bills with everything bill_template.html touches loaded up front: the
+    dukandaar and area joined, and the items with their products in one
+    extra query, so rendering costs the same number of queries for any size.
+    """
+    return Bill.objects.select_related('dukandaar__area').prefetch_related(
+        Prefetch('items', queryset=Item.objects.select_related('product').order_by('id'))
+    )
+
+
+def load_bill_document(bill_id):
+    return bill_document_queryset().get(pk=bill_id)
+
+
+def bill_fingerprint(bill):
+    """
+    Hash of everything bill_template.html prints, so a cached PDF is reused
+    only while the bill and its item rows are unchanged.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((bill.id, bill.date, bill.dukandaar.name, bill.dukandaar.area.area_name,
+                        bill.total_amount)).encode())
+    for item in bill.items.all():
+        digest.update(repr((item.id, item.product.name, item.bora, item.kg, item.price_per_kg,
+                            item.amount)).encode())
+    return digest.hexdigest()[:32]
+
+
+def render_bill_pdf(bill):
+    html = get_template('bill_template.html').render({'bill': bill})
+    result = BytesIO()
+    pisa_status = pisa.CreatePDF(html, dest=result)
+    if pisa_status.err:
+        raise PdfRenderError(f'Error generating PDF for bill {bill.id}')
+    return result.getvalue()
+
+
+def render_template_pdf(template_name, context):
+    html = get_template(template_name).render(context)
+    result = BytesIO()
+    pisa_status = pisa.CreatePDF(html, dest=result)
+    if pisa_status.err:
+        raise PdfRenderError(f'Error generating PDF from {template_name}')
+    return result.getvalue()
+
+
+def render_statement_pdf(statement):
+    return render_template_pdf('statement_template.html', {'statement': statement})
+
+
+def render_route_sheet_pdf(sheet):
+    return render_template_pdf('route_sheet_template.html', {'sheet': sheet})
+
+
+def get_bill_pdf(bill):
+    """
+    Return the PDF for bill, rendering it only when no cached copy exists for
+    its current content. bill should come from load_bill_document().
+    """
+    cache_dir = get_pdf_cache_dir()
+    path = os.path.join(cache_dir, f'bill_{bill.id}_{bill_fingerprint(bill)}.pdf')
+    try:
+        with open(path, 'rb') as cached:
+            pdf = cached.read()
+        # Mark it as used, prune_pdf_cache() expires the ones left alone
+        os.utime(path)
+        return pdf
+    except FileNotFoundError:
+        pass
+
+    pdf = render_bill_pdf(bill)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first so concurrent readers never see a partial PDF
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as tmp:
+        tmp.write(pdf)
+    os.replace(tmp_path, path)
+    return pdf
+
+
+def prune_pdf_cache(days=None):
+    """
+    Delete cached PDFs unused for BILL_PDF_CACHE_DAYS days: those of edited
+    bills, whose fingerprint changed, and of bills nobody prints any more,
+    along with temporary files left by interrupted renders. Returns the
+    number of files deleted.
+    """
+    days = days or getattr(settings, 'BILL_PDF_CACHE_DAYS', 30)
+    cutoff = time.time() - days * 24 * 3600
+    deleted = 0
+    try:
+        entries = os.scandir(get_pdf_cache_dir())
+    except FileNotFoundError:
+        return 0
+    with entries:
+        for entry in entries:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                try:
+                    os.remove(entry.path)
+                    deleted += 1
+                except FileNotFoundError:
+                    pass
+    return deleted
+
+
+def process_pool(processes):
+    """
+    A pool of renderer processes. They are spawned rather than forked: the
+    web server and run_worker are multi-threaded, and a fork would copy the
+    locks and database connections other threads hold at that moment. Each
+    worker sets Django up afresh and opens its own connection.
+    """
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=django.setup)
+
+
+def _bill_pdf_worker(bill_id):
+    return get_bill_pdf(load_bill_document(bill_id))
+
+
+def render_bills_batch(bill_ids, processes=None):
+    """
+    Render several bills into one multi-page PDF. Bills are rendered (or read
+    from the PDF cache) and merged in the given order; batches of at least
+    BILL_PDF_POOL_MIN_BILLS in a process pool, smaller ones in process, as
+    each spawned worker first has to start Django.
+    """
+    bill_ids = list(bill_ids)
+    if processes is None:
+        processes = getattr(settings, 'BILL_PDF_PROCESSES', os.cpu_count() or 1)
+    processes = min(processes, len(bill_ids))
+
+    if processes > 1 and len(bill_ids) >= getattr(settings, 'BILL_PDF_POOL_MIN_BILLS', 40):
+        with process_pool(processes) as pool:
+            pdfs = list(pool.map(_bill_pdf_worker, bill_ids))
+    else:
+        pdfs = [_bill_pdf_worker(bill_id) for bill_id in bill_ids]
+
+    return merge_pdfs(pdfs)
+
+
+def merge_pdfs(pdfs):
+    writer = PdfWriter()
+    for pdf in pdfs:
+        writer.append(PdfReader(BytesIO(pdf)))
+    result = BytesIO()
+    writer.write(result)
+    return result.getvalue()
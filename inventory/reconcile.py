@@ -0,0 +1,142 @@
+"""
+Recompute the maintained balances from the rows they summarise and find
+(or fix) the ones that drifted. Each check is one query: the expected value
+is a correlated aggregate subquery and only rows off by more than the
+tolerance are returned, so the database does the comparison.
+
+The invariants, in the order they are checked and fixed (later ones read
+the balances fixed by earlier ones):
+
+  Bill.total_amount       sum of its items
+  Bill.pending_amount     total - collections against the bill; paid bills
+                          with no collection against them were settled
+                          outside the collections (created, imported or
+                          ticked as paid) and have nothing pending, see
+                          Bill.post_amount. Fixing it also settles or
+                          reopens the bills collected against, which are
+                          paid while nothing is left pending
+  Dukandaar.pending_amount  pending of all its bills - collections not
+                          made against a bill
+  Company.loan_amount     purchase lines of its orders - payments
+  Product.stock_in_kg     purchased - sold + opening and adjustment movements
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db.models import (Case, DecimalField, Exists, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum,
+                              Value, When)
+from django.db.models.functions import Coalesce
+
+from .cache import bump_ledger_version, invalidate_analytics_cache
+from .db import immediate_atomic
+from .models import (Bill, Company, CompanyPayment, DailyCollection, Dukandaar, Item, Product, PurchaseItem, StockMovement,
+                     settled_outside_collections)
+
+MONEY = DecimalField(max_digits=20, decimal_places=2)
+KG = DecimalField(max_digits=14, decimal_places=2)
+
+Drift = namedtuple('Drift', 'check pk stored expected')
+
+
+def _sum(queryset, expression, output_field=MONEY):
+    """Correlated SUM(expression) over queryset, 0 when it has no rows."""
+    total = (queryset.order_by().values(group=Value(1))
+             .annotate(total=Sum(expression, output_field=output_field)).values('total'))
+    return Coalesce(Subquery(total, output_field=output_field), Value(Decimal(0)), output_field=output_field)
+
+
+def _kg(prefix=''):
+    return F(f'{prefix}kg') + F(f'{prefix}bora') * F(f'{prefix}product__one_bora_in_kg')
+
+
+def bill_total():
+    return _sum(Item.objects.filter(bill=OuterRef('pk')), 'amount')
+
+
+def bill_pending():
+    return Case(
+        When(settled_outside_collections(), then=Value(Decimal(0))),
+        default=ExpressionWrapper(bill_total() - _sum(DailyCollection.objects.filter(bill=OuterRef('pk')),
+                                                      'amount_collected'), output_field=MONEY),
+        output_field=MONEY,
+    )
+
+
+def dukandaar_pending():
+    return ExpressionWrapper(
+        _sum(Bill.objects.filter(dukandaar=OuterRef('pk')), 'pending_amount')
+        - _sum(DailyCollection.objects.filter(dukandaar=OuterRef('pk'), bill__isnull=True), 'amount_collected'),
+        output_field=MONEY,
+    )
+
+
+def company_loan():
+    return ExpressionWrapper(
+        _sum(PurchaseItem.objects.filter(purchase_order__company=OuterRef('pk')), 'amount')
+        - _sum(CompanyPayment.objects.filter(company=OuterRef('pk')), 'amount_paid'),
+        output_field=MONEY,
+    )
+
+
+def product_stock():
+    return ExpressionWrapper(
+        _sum(PurchaseItem.objects.filter(product=OuterRef('pk')), _kg(), KG)
+        - _sum(Item.objects.filter(product=OuterRef('pk')), _kg(), KG)
+        + _sum(StockMovement.objects.filter(product=OuterRef('pk'),
+                                            kind__in=[StockMovement.OPENING, StockMovement.ADJUSTMENT]), 'kg', KG),
+        output_field=KG,
+    )
+
+
+# name: (model, field, expected value, tolerance)
+CHECKS = {
+    'bill_total': (Bill, 'total_amount', bill_total, Decimal('0.005')),
+    'bill_pending': (Bill, 'pending_amount', bill_pending, Decimal('0.005')),
+    'dukandaar_pending': (Dukandaar, 'pending_amount', dukandaar_pending, Decimal('0.005')),
+    'company_loan': (Company, 'loan_amount', company_loan, Decimal('0.005')),
+    'product_stock': (Product, 'stock_in_kg', product_stock, Decimal('0.005')),
+}
+
+
+def find_drift(name):
+    """Rows whose stored balance is off, as Drift tuples."""
+    model, field, expected, tolerance = CHECKS[name]
+    rows = (model.objects
+            .annotate(expected=expected())
+            .annotate(drift=ExpressionWrapper(F('expected') - F(field), output_field=MONEY))
+            .filter(Q(drift__gte=tolerance) | Q(drift__lte=-tolerance))
+            .order_by('pk')
+            .values_list('pk', field, 'expected'))
+    return [Drift(name, pk, stored, expected) for pk, stored, expected in rows]
+
+
+@immediate_atomic
+def fix_drift(name, pks, batch_size=1000):
+    """Set the balance of the given rows to its expected value, one UPDATE per batch."""
+    model, field, expected, _ = CHECKS[name]
+    fixed = 0
+    for start in range(0, len(pks), batch_size):
+        rows = model.objects.filter(pk__in=pks[start:start + batch_size])
+        fixed += rows.update(**{field: expected()})
+        if name == 'bill_pending':
+            # Like a collection would, with the pending amount just fixed
+            rows.filter(Exists(DailyCollection.objects.filter(bill=OuterRef('pk')))).update(
+                paid=Case(When(pending_amount__lte=0, then=Value(True)), default=Value(False))
+            )
+    return fixed
+
+
+def reconcile(fix=False, checks=None, batch_size=1000):
+    """
+    Run the checks in order, fixing each before the next one when fix is
+    set. Returns {check: [Drift, ...]} of what was found.
+    """
+    found = {}
+    for name in checks or CHECKS:
+        found[name] = find_drift(name)
+        if fix and found[name]:
+            fix_drift(name, [drift.pk for drift in found[name]], batch_size)
+    if fix and any(found.values()):
+        invalidate_analytics_cache()
+        bump_ledger_version()
+    return found
@@ -0,0 +1,91 @@
+import json
+import os
+import tempfile
+from datetime import date
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from .models import Area, Bill, DailyCollection, Dukandaar
+from .pdf import process_pool, render_route_sheet_pdf
+
+
+def get_route_sheet_dir(day=None):
+    root = getattr(settings, 'ROUTE_SHEET_DIR', os.path.join(settings.MEDIA_ROOT, 'route_sheets'))
+    return os.path.join(root, (day or date.today()).isoformat())
+
+
+def get_route_sheet(area):
+    """
+    Every shop of area with dues, with its oldest unpaid bill and its last
+    collection, from one query: the bill and collection are correlated
+    subqueries served by the unpaid bill and collection time indexes.
+    Shops are ordered by address and name, roughly the order they are walked.
+    """
+    oldest_unpaid = Bill.objects.filter(dukandaar=OuterRef('pk'), paid=False).order_by('date', 'id')
+    last_collection = DailyCollection.objects.filter(dukandaar=OuterRef('pk')).order_by('-collection_time', '-id')
+    shops = list(
+        Dukandaar.objects.filter(area=area, pending_amount__gt=0)
+        .annotate(
+            oldest_bill_id=Subquery(oldest_unpaid.values('id')[:1]),
+            oldest_bill_date=Subquery(oldest_unpaid.values('date')[:1]),
+            oldest_bill_pending=Subquery(oldest_unpaid.values('pending_amount')[:1]),
+            last_collection_time=Subquery(last_collection.values('collection_time')[:1]),
+            last_collection_amount=Subquery(last_collection.values('amount_collected')[:1]),
+        )
+        .order_by('address', 'name')
+        .values('id', 'name', 'contact_info', 'address', 'pending_amount', 'oldest_bill_id', 'oldest_bill_date',
+                'oldest_bill_pending', 'last_collection_time', 'last_collection_amount')
+    )
+    return {
+        'area': {'id': area.id, 'name': area.area_name, 'city': area.city_name},
+        'generated_at': timezone.now(),
+        'total_pending': sum(shop['pending_amount'] for shop in shops),
+        'shops': shops,
+    }
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as tmp:
+        tmp.write(data)
+    os.replace(tmp_path, path)
+
+
+def write_route_sheet(area_id, day=None):
+    """Build the sheet of one area and store its JSON and PDF for the day. Returns the PDF path."""
+    sheet = get_route_sheet(Area.objects.get(pk=area_id))
+    directory = get_route_sheet_dir(day)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'area_{area_id}')
+    _write_atomic(path + '.json', json.dumps(sheet, cls=DjangoJSONEncoder).encode())
+    _write_atomic(path + '.pdf', render_route_sheet_pdf(sheet))
+    return path + '.pdf'
+
+
+def read_route_sheet(area_id, extension, day=None):
+    """A stored sheet of the day as bytes, or None when it has not been generated."""
+    try:
+        with open(os.path.join(get_route_sheet_dir(day), f'area_{area_id}.{extension}'), 'rb') as stored:
+            return stored.read()
+    except FileNotFoundError:
+        return None
+
+
+def generate_route_sheets(area_ids=None, processes=None, day=None):
+    """
+    Write the route sheets of the given areas (all by default) for the day,
+    one area per worker process. Returns the paths of the PDFs.
+    """
+    if area_ids is None:
+        area_ids = list(Area.objects.order_by('id').values_list('id', flat=True))
+    if processes is None:
+        processes = getattr(settings, 'BILL_PDF_PROCESSES', os.cpu_count() or 1)
+    processes = min(processes, len(area_ids))
+
+    if processes > 1:
+        with process_pool(processes) as pool:
+            return list(pool.map(write_route_sheet, area_ids, [day] * len(area_ids)))
+    return [write_route_sheet(area_id, day) for area_id in area_ids]
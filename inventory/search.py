@@ -0,0 +1,204 @@
+"""
+In-memory name search for dukandaars and products, for the counter's
+type-ahead. Every word of every name is indexed by its prefixes, plus by
+trigrams so misspelt or mid-word queries still find something; neither
+needs a table scan. Only names and labels live in the index: pending amount
+and stock change on every bill, so they are read for the matched rows with
+one primary key lookup.
+
+Each process keeps its own index. Saves and deletes update it in place via
+signals.py and bump a version in a shared cache, so other worker processes
+rebuild theirs on their next search.
+"""
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import Dukandaar, Product
+
+VERSION_KEY = 'search:version:{}'
+MIN_TRIGRAM_SIMILARITY = 0.5
+WORD = re.compile(r'\w+')
+
+
+def normalize(text):
+    return WORD.findall((text or '').casefold())
+
+
+def trigrams(word):
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    def __init__(self, kind, load_rows, load_live, serialize):
+        self.kind = kind
+        # load_rows() -> iterable of (pk, name, label); load_live(pks) -> {pk: live values}
+        self.load_rows = load_rows
+        self.load_live = load_live
+        self.serialize = serialize
+        self.lock = threading.Lock()
+        self.version = None
+        self.entries = {}
+        self.prefixes = defaultdict(set)
+        self.trigrams = defaultdict(set)
+
+    def _add(self, pk, name, label):
+        self.entries[pk] = (name, label, name.casefold())
+        for word in normalize(name):
+            for end in range(1, len(word) + 1):
+                self.prefixes[word[:end]].add(pk)
+            for trigram in trigrams(word):
+                self.trigrams[trigram].add(pk)
+
+    def _remove(self, pk):
+        entry = self.entries.pop(pk, None)
+        if entry is None:
+            return
+        for word in normalize(entry[0]):
+            for end in range(1, len(word) + 1):
+                self.prefixes[word[:end]].discard(pk)
+            for trigram in trigrams(word):
+                self.trigrams[trigram].discard(pk)
+
+    def rebuild(self, version=None):
+        with self.lock:
+            self.entries = {}
+            self.prefixes = defaultdict(set)
+            self.trigrams = defaultdict(set)
+            for pk, name, label in self.load_rows():
+                self._add(pk, name, label)
+            self.version = version
+
+    def update(self, pk, name, label):
+        with self.lock:
+            self._remove(pk)
+            self._add(pk, name, label)
+
+    def remove(self, pk):
+        with self.lock:
+            self._remove(pk)
+
+    def ensure_current(self):
+        version = get_search_cache().get(VERSION_KEY.format(self.kind), 0)
+        if self.version != version:
+            self.rebuild(version)
+
+    def _match(self, query):
+        # Primary keys matching query, best first; callers hold the lock
+        words = normalize(query)
+        if not words:
+            return []
+        # Every word of the query has to be the start of a word of the name
+        matches = set.intersection(*(self.prefixes.get(word, set()) for word in words))
+        if not matches:
+            query_trigrams = set().union(*(trigrams(word) for word in words))
+            counts = Counter(pk for trigram in query_trigrams for pk in self.trigrams.get(trigram, ()))
+            threshold = MIN_TRIGRAM_SIMILARITY * len(query_trigrams)
+            matches = {pk for pk, count in counts.items() if count >= threshold}
+            return sorted(matches, key=lambda pk: (-counts[pk], self.entries[pk][2]))
+        query = ' '.join(words)
+        return sorted(matches, key=lambda pk: (not self.entries[pk][2].startswith(query),
+                                               len(self.entries[pk][2]), self.entries[pk][2]))
+
+    def search(self, query, limit=10):
+        self.ensure_current()
+        # Names are read under the lock too: a concurrent rebuild or delete changes entries
+        with self.lock:
+            found = [(pk, *self.entries[pk][:2]) for pk in self._match(query)[:limit]]
+        live = self.load_live([pk for pk, _, _ in found])
+        return [self.serialize(pk, name, label, live[pk]) for pk, name, label in found if pk in live]
+
+    def containing(self, query):
+        """
+        Primary keys whose name contains every word of query, in any order:
+        the admin's icontains search on the name, without the table scan.
+        """
+        words = query.casefold().split()
+        with self.lock:
+            return [pk for pk, (_, _, folded) in self.entries.items() if all(word in folded for word in words)]
+
+
+def _dukandaar_rows():
+    return Dukandaar.objects.values_list('pk', 'name', 'area__area_name').iterator()
+
+
+def _dukandaar_live(pks):
+    return {row['pk']: row for row in Dukandaar.objects.filter(pk__in=pks).values('pk', 'pending_amount')}
+
+
+def _dukandaar_result(pk, name, area, live):
+    return {'id': pk, 'text': f'{name} {area}', 'name': name, 'area': area,
+            'pending_amount': live['pending_amount']}
+
+
+def _product_rows():
+    return Product.objects.values_list('pk', 'name', 'company__name').iterator()
+
+
+def _product_live(pks):
+    return {row['pk']: row for row in
+            Product.objects.filter(pk__in=pks).values('pk', 'stock_in_kg', 'one_bora_in_kg')}
+
+
+def _product_result(pk, name, company, live):
+    bora = live['one_bora_in_kg'] or 1
+    return {'id': pk, 'text': name, 'name': name, 'company': company,
+            'stock_in_kg': live['stock_in_kg'], 'stock_in_bora': round(live['stock_in_kg'] / bora, 2)}
+
+
+INDEXES = {
+    'dukandaar': SearchIndex('dukandaar', _dukandaar_rows, _dukandaar_live, _dukandaar_result),
+    'product': SearchIndex('product', _product_rows, _product_live, _product_result),
+}
+
+
+def get_search_cache():
+    return caches[getattr(settings, 'SEARCH_INDEX_CACHE_ALIAS', 'default')]
+
+
+def search(kind, query, limit=10):
+    """Search the `kind` index ('dukandaar' or 'product'), returning dicts ready for JSON."""
+    started = time.perf_counter()
+    results = INDEXES[kind].search(query, limit)
+    return results, (time.perf_counter() - started) * 1000
+
+
+def search_ids(kind, query):
+    """Every pk whose name contains each word of query, see SearchIndex.containing."""
+    INDEXES[kind].ensure_current()
+    return INDEXES[kind].containing(query)
+
+
+def index_changed(kind, pk=None, name=None, label=None, deleted=False):
+    """
+    Record a change once the transaction commits: the row is updated in this
+    process's index (or, without a pk, the whole index is rebuilt on the next
+    search) and the shared version is bumped for the other processes.
+    """
+    def apply():
+        index = INDEXES[kind]
+        cache = get_search_cache()
+        key = VERSION_KEY.format(kind)
+        cache.add(key, 0, timeout=None)
+        try:
+            version = cache.incr(key)
+        except ValueError:
+            version = None
+        if index.version is None and not index.entries:
+            return
+        if pk is None or version is None or version != (index.version or 0) + 1:
+            # Someone else changed it too, or a label shared by many rows changed
+            index.version = None
+        elif deleted:
+            index.remove(pk)
+            index.version = version
+        else:
+            index.update(pk, name, label)
+            index.version = version
+    transaction.on_commit(apply)
@@ -0,0 +1,59 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .cache import invalidate_analytics_cache, bump_ledger_version
+from .db import configure_connection
+from .models import Item, Bill, PurchaseItem, DailyCollection, Dukandaar, Product, Area, Company
+from .search import index_changed
+
+
+@receiver([post_save, post_delete], sender=Item)
+@receiver([post_save, post_delete], sender=Bill)
+@receiver([post_save, post_delete], sender=PurchaseItem)
+@receiver([post_save, post_delete], sender=DailyCollection)
+def invalidate_analytics_on_write(sender, **kwargs):
+    invalidate_analytics_cache()
+
+
+@receiver([post_save, post_delete], sender=Bill)
+@receiver([post_save, post_delete], sender=DailyCollection)
+def bump_dukandaar_ledger(sender, instance, **kwargs):
+    bump_ledger_version(instance.dukandaar_id)
+
+
+@receiver([post_save, post_delete], sender=Item)
+def bump_bill_ledger(sender, instance, **kwargs):
+    if Item.bill.is_cached(instance):
+        bump_ledger_version(instance.bill.dukandaar_id)
+    else:
+        # Items deleted in bulk by the collector; without a shop every version is bumped
+        bump_ledger_version(Bill.objects.filter(pk=instance.bill_id).values_list('dukandaar_id', flat=True).first())
+
+
+@receiver(post_save, sender=Dukandaar)
+def index_dukandaar(sender, instance, **kwargs):
+    index_changed('dukandaar', instance.pk, instance.name, instance.area.area_name)
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    index_changed('product', instance.pk, instance.name, instance.company.name)
+
+
+@receiver(post_delete, sender=Dukandaar)
+@receiver(post_delete, sender=Product)
+def unindex(sender, instance, **kwargs):
+    index_changed(sender._meta.model_name, instance.pk, deleted=True)
+
+
+@receiver([post_save, post_delete], sender=Area)
+@receiver([post_save, post_delete], sender=Company)
+def reindex_labels(sender, **kwargs):
+    # The area or company name is shown next to every row using it
+    index_changed('dukandaar' if sender is Area else 'product')
+
+
+@receiver(connection_created)
+def configure_new_connection(sender, connection, **kwargs):
+    configure_connection(connection)
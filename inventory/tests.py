@@ -1,3 +1,902 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from pypdf import PdfReader
+
+from . import backup, cache, jobs
+from .benchmark import measure
+from .cache import get_analytics_cache
+from .ledger import BillLine, get_statement, post_bill
+from .models import (Area, Company, Product, Dukandaar, Bill, Item, DailyCollection, DailySalesRollup, Job,
+                     PurchaseOrder, PurchaseItem, StockMovement)
+from .pdf import load_bill_document, get_bill_pdf, prune_pdf_cache, render_bill_pdf, render_bills_batch
+from .reconcile import CHECKS, find_drift, reconcile
+from .search import INDEXES, VERSION_KEY, get_search_cache, search, search_ids
+from .utils import (AGEING_BUCKETS, ANALYTICS_WIDGETS, EstimatedCountPaginator, get_ageing_summary,
+                    get_receivables_ageing, get_sales_time_series, write_receivables_ageing_csv)
+
+
+class InventoryTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.area = Area.objects.create(area_name='Station Road')
+        cls.company = Company.objects.create(name='Neelkamal')
+        cls.products = [
+            Product.objects.create(name=f'Product {i}', company=cls.company, one_bora_in_kg=50)
+            for i in range(5)
+        ]
+        cls.dukandaar = Dukandaar.objects.create(name='Gupta Store', area=cls.area)
+
+    def create_bill(self, lines):
+        items = post_bill(self.dukandaar, [
+            BillLine(self.products[i % len(self.products)], Decimal(1), Decimal(2), Decimal(30))
+            for i in range(lines)
+        ])
+        return items[0].bill
+
+
+class SalesRollupTests(InventoryTestCase):
+    def rollup(self):
+        return {row[:3]: row[3:] for row in DailySalesRollup.objects.exclude(bill_count=0).values_list(
+            'date', 'product_id', 'dukandaar_id', 'revenue', 'kg_sold', 'bill_count')}
+
+    def test_item_writes_maintain_rollup(self):
+        bill = Bill.objects.create(dukandaar=self.dukandaar)
+        first, second = (Item.objects.create(bill=bill, product=self.products[0], kg=Decimal(10), price_per_kg=20)
+                         for _ in range(2))
+        Item.objects.create(bill=bill, product=self.products[1], bora=1, kg=0, price_per_kg=10)
+        key = (bill.date, self.products[0].pk, self.dukandaar.pk)
+        self.assertEqual(self.rollup()[key], (Decimal(400), Decimal(20), 1))
+
+        first.delete()
+        self.assertEqual(self.rollup()[key], (Decimal(200), Decimal(10), 1))
+        second.delete()
+        self.assertNotIn(key, self.rollup())
+        self.assertEqual(self.rollup()[(bill.date, self.products[1].pk, self.dukandaar.pk)],
+                         (Decimal(500), Decimal(50), 1))
+
+    def test_maintained_rollup_matches_rebuild(self):
+        for lines in (1, 3, 7):
+            self.create_bill(lines)
+        item = Item.objects.select_related('bill__dukandaar', 'product').first()
+        item.kg = Decimal('4.5')
+        item.save()
+        maintained = self.rollup()
+        call_command('rebuild_sales_rollup', stdout=StringIO())
+        self.assertEqual(self.rollup(), maintained)
+
+
+class SalesTimeSeriesTests(InventoryTestCase):
+    buckets = {
+        'day': lambda day: day,
+        'week': lambda day: day - timedelta(days=day.weekday()),
+        'month': lambda day: day.replace(day=1),
+    }
+
+    def setUp(self):
+        other = Dukandaar.objects.create(name='Sharma Kirana', area=self.area)
+        # Monday 29 January 2024 is the day before the window
+        for day, lines in ((29, 1), (30, 2), (31, 3), (33, 1), (43, 4), (45, 2)):
+            bill = self.create_bill(lines)
+            Bill.objects.filter(pk=bill.pk).update(date=date(2024, 1, 1) + timedelta(days=day - 1))
+        bill = post_bill(other, [BillLine(self.products[0], 0, 5, 20)])[0].bill
+        Bill.objects.filter(pk=bill.pk).update(date=date(2024, 1, 31))
+        call_command('rebuild_sales_rollup', stdout=StringIO())
+
+    def test_buckets_match_item_totals_and_empty_buckets_are_filled(self):
+        start, end = date(2024, 1, 30), date(2024, 2, 14)
+        items = Item.objects.filter(bill__date__range=[start, end]).select_related('bill')
+        for bucket, period_of in self.buckets.items():
+            with self.subTest(bucket=bucket):
+                expected = defaultdict(lambda: [Decimal(0), set(), set()])
+                for item in items:
+                    totals = expected[period_of(item.bill.date)]
+                    totals[0] += item.amount
+                    totals[1].add(item.bill_id)
+                    totals[2].add(item.bill.dukandaar_id)
+                series = get_sales_time_series(start, end, bucket)
+                periods = [row['period'] for row in series]
+                self.assertEqual(periods, sorted({period_of(start + timedelta(days=n)) for n in range(16)}))
+                self.assertLessEqual(set(expected), set(periods))
+                for row in series:
+                    revenue, bills, customers = expected.get(row['period'], [0, (), ()])
+                    self.assertEqual((row['revenue'], row['bills'], row['customers']),
+                                     (revenue, len(bills), len(customers)), row['period'])
+
+    def test_empty_window_is_all_zeros(self):
+        series = get_sales_time_series(date(2023, 12, 30), date(2024, 1, 2), 'day')
+        self.assertEqual([(row['period'], row['revenue'], row['bills']) for row in series],
+                         [(date(2023, 12, 30) + timedelta(days=n), 0, 0) for n in range(4)])
+
+
+class LedgerPostingTests(InventoryTestCase):
+    def setUp(self):
+        self.product = self.products[0]
+        self.bill = Bill.objects.create(dukandaar=self.dukandaar)
+
+    def assertBalances(self, bill_total, bill_pending, shop_pending):
+        self.bill.refresh_from_db()
+        self.dukandaar.refresh_from_db()
+        self.assertEqual(self.bill.total_amount, Decimal(bill_total))
+        self.assertEqual(self.bill.pending_amount, Decimal(bill_pending))
+        self.assertEqual(self.dukandaar.pending_amount, Decimal(shop_pending))
+
+    def test_item_save_and_delete_post_and_reverse(self):
+        item = Item.objects.create(bill=self.bill, product=self.product, kg=Decimal(10), price_per_kg=Decimal(20))
+        self.assertBalances(200, 200, 200)
+        item.kg = Decimal(5)
+        item.save()
+        self.assertBalances(100, 100, 100)
+        item.delete()
+        self.assertBalances(0, 0, 0)
+
+    def test_collections_settle_and_reopen_bill(self):
+        Item.objects.create(bill=self.bill, product=self.product, kg=Decimal(10), price_per_kg=Decimal(20))
+        collection = DailyCollection.objects.create(dukandaar=self.dukandaar, bill=self.bill, amount_collected=200)
+        self.assertBalances(200, 0, 0)
+        self.assertTrue(self.bill.paid)
+        collection.delete()
+        self.assertBalances(200, 200, 200)
+        self.assertFalse(self.bill.paid)
+
+    def test_bill_delete_settles_shop(self):
+        Item.objects.create(bill=self.bill, product=self.product, kg=Decimal(10), price_per_kg=Decimal(20))
+        DailyCollection.objects.create(dukandaar=self.dukandaar, bill=self.bill, amount_collected=80)
+        self.bill.delete()
+        self.dukandaar.refresh_from_db()
+        self.assertEqual(self.dukandaar.pending_amount, 0)
+
+    def test_fractional_kg(self):
+        # Every write loads the product again, as separate requests would
+        def product():
+            return Product.objects.get(pk=self.product.pk)
+        first = Item.objects.create(bill=self.bill, product=product(), kg=Decimal('2.5'), price_per_kg=20)
+        Item.objects.create(bill=self.bill, product=product(), kg=Decimal('1.25'), price_per_kg=20)
+        order = PurchaseOrder.objects.create(company=self.company)
+        PurchaseItem.objects.create(purchase_order=order, product=product(), kg=Decimal('10.5'), price_per_kg=15)
+        Item.objects.select_related('bill__dukandaar', 'product').get(pk=first.pk).delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_in_kg, Decimal('9.25'))
+        self.assertBalances(25, 25, 25)
+
+
+class StockJournalTests(InventoryTestCase):
+    def setUp(self):
+        self.product = self.products[0]
+        self.order = PurchaseOrder.objects.create(company=self.company)
+
+    def buy(self, kg, price):
+        return PurchaseItem.objects.create(purchase_order=self.order, product=self.product, kg=kg, price_per_kg=price)
+
+    def assertStock(self, stock, average_cost):
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock_in_kg, self.product.average_cost), (stock, average_cost))
+
+    def test_purchases_blend_into_weighted_average(self):
+        self.buy(100, 10)
+        self.assertStock(100, 10)
+        second = self.buy(300, 20)
+        self.assertStock(400, Decimal('17.5'))
+        # Deleting a purchase takes its cost back out of the average
+        second.delete()
+        self.assertStock(100, 10)
+        self.assertEqual(list(StockMovement.objects.filter(kind=StockMovement.PURCHASE)
+                              .order_by('id').values_list('kg', 'unit_cost', 'value')),
+                         [(100, 10, 1000), (300, 20, 6000), (-300, 20, -6000)])
+
+    def test_sales_move_stock_at_average_cost(self):
+        self.buy(100, 10)
+        self.buy(100, 20)
+        item = post_bill(self.dukandaar, [BillLine(self.product, 0, 40, 30)])[0]
+        self.assertStock(160, 15)
+        item.delete()
+        self.assertStock(200, 15)
+        self.assertEqual(list(StockMovement.objects.filter(kind=StockMovement.SALE)
+                              .order_by('id').values_list('kg', 'unit_cost', 'value')),
+                         [(-40, 15, -600), (40, 15, 600)])
+
+    def test_restocking_after_running_out_costs_the_new_price(self):
+        self.buy(50, 10)
+        post_bill(self.dukandaar, [BillLine(self.product, 0, 60, 30)])
+        self.assertStock(-10, 10)
+        self.buy(100, 12)
+        self.assertStock(90, 12)
+
+    def test_record_many_matches_record(self):
+        other = self.products[1]
+        movements = [(StockMovement.OPENING, 20, Decimal(8)), (StockMovement.PURCHASE, 30, Decimal(13)),
+                     (StockMovement.SALE, -45, None), (StockMovement.PURCHASE, 10, Decimal('9.5')),
+                     (StockMovement.ADJUSTMENT, 5, None)]
+        for kind, kg, unit_cost in movements:
+            StockMovement.record(self.product, kind, kg, unit_cost=unit_cost)
+        StockMovement.record_many([StockMovement(product=other, kind=kind, kg=kg, unit_cost=unit_cost,
+                                                 date=date.today()) for kind, kg, unit_cost in movements])
+
+        def journal(product):
+            product.refresh_from_db()
+            return (product.stock_in_kg, product.average_cost,
+                    list(product.movements.order_by('id').values_list('kind', 'kg', 'unit_cost', 'value')))
+        self.assertEqual(journal(other), journal(self.product))
+
+
+class PostBillTests(InventoryTestCase):
+    def test_post_bill_matches_posting_items_one_by_one(self):
+        lines = [BillLine(self.products[i % 2], Decimal(i % 2), Decimal('2.5'), Decimal(30)) for i in range(5)]
+        bill = post_bill(self.dukandaar, lines)[0].bill
+        other = Dukandaar.objects.create(name='Sharma Store', area=self.area)
+        one_by_one = Bill.objects.create(dukandaar=other)
+        for product, bora, kg, price_per_kg in lines:
+            Item.objects.create(bill=one_by_one, product=product, bora=bora, kg=kg, price_per_kg=price_per_kg)
+
+        for bill, dukandaar in ((bill, self.dukandaar), (one_by_one, other)):
+            bill.refresh_from_db()
+            dukandaar.refresh_from_db()
+            self.assertEqual(bill.total_amount, Decimal('3375'))
+            self.assertEqual(bill.pending_amount, bill.total_amount)
+            self.assertEqual(dukandaar.pending_amount, bill.total_amount)
+            self.assertEqual(
+                list(DailySalesRollup.objects.filter(dukandaar=dukandaar).order_by('product_id')
+                     .values_list('revenue', 'kg_sold', 'bill_count')),
+                [(Decimal('225'), Decimal('7.5'), 1), (Decimal('3150'), Decimal('105'), 1)],
+            )
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock_in_kg, Decimal(-15))
+
+    def test_adding_to_a_bill_counts_it_once_per_product(self):
+        bill = post_bill(self.dukandaar, [BillLine(self.products[0], 0, 1, 10)])[0].bill
+        post_bill(self.dukandaar, [BillLine(self.products[0], 0, 1, 10), BillLine(self.products[1], 0, 1, 10)], bill)
+        self.assertEqual(
+            list(DailySalesRollup.objects.order_by('product_id').values_list('product_id', 'bill_count')),
+            [(self.products[0].pk, 1), (self.products[1].pk, 1)],
+        )
+        bill.refresh_from_db()
+        self.assertEqual(bill.total_amount, Decimal(30))
+
+    def test_query_count_does_not_grow_with_lines(self):
+        # Per product, not per line
+        counts = []
+        for lines in (2, 20):
+            dukandaar = Dukandaar.objects.create(name=f'Shop {lines}', area=self.area)
+            with CaptureQueriesContext(connection) as queries:
+                post_bill(dukandaar, [BillLine(self.products[i % 2], 0, 1, 10) for i in range(lines)])
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+
+class ImportLedgerTests(InventoryTestCase):
+    files = {
+        'purchases': ['order_ref,date,company,product,bora,kg,price_per_kg',
+                      'P1,2024-01-01,Neelkamal,Product 0,2,0,30',
+                      'P2,2024-01-06,Neelkamal,Product 0,0,50,36'],
+        'bills': ['bill_ref,date,dukandaar,product,bora,kg,price_per_kg,paid',
+                  'B1,2024-01-05,Gupta Store,Product 0,0,2.5,40,',
+                  'B1,2024-01-05,Gupta Store,Product 1,1,0,40,',
+                  'B2,2024-01-07,Gupta Store,Product 0,0,10,42,yes'],
+        'collections': ['date,dukandaar,amount_collected,bill_ref',
+                        '2024-01-08,Gupta Store,420,B2',
+                        '2024-01-08,Gupta Store,100,B1'],
+    }
+
+    def write_files(self, files):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        options = {}
+        for name, lines in files.items():
+            options[name] = os.path.join(directory, f'{name}.csv')
+            with open(options[name], 'w') as out:
+                out.write('\n'.join(lines) + '\n')
+        return options
+
+    def test_import_leaves_consistent_balances(self):
+        call_command('import_ledger', chunk_size=1, stdout=StringIO(), **self.write_files(self.files))
+
+        for check in CHECKS:
+            self.assertEqual(find_drift(check), [], check)
+        self.dukandaar.refresh_from_db()
+        # B2 was imported paid and its collection is what paid it
+        self.assertEqual(self.dukandaar.pending_amount, Decimal('2000'))
+        # As entered one by one: the collection that paid B2 reopened it first
+        self.assertEqual(
+            list(DailyCollection.objects.order_by('id').values_list('pending_amount_as_of_today', flat=True)),
+            [Decimal('2100'), Decimal('2000')],
+        )
+        self.assertEqual(
+            list(StockMovement.objects.filter(product=self.products[0]).order_by('id')
+                 .values_list('date', 'kind', 'kg', 'unit_cost')),
+            [(date(2024, 1, 1), 'purchase', Decimal(100), Decimal(30)),
+             (date(2024, 1, 6), 'purchase', Decimal(50), Decimal(36)),
+             (date(2024, 1, 5), 'sale', Decimal('-2.5'), Decimal(32)),
+             (date(2024, 1, 7), 'sale', Decimal(-10), Decimal(32))],
+        )
+        self.assertEqual(DailySalesRollup.objects.filter(date=date(2024, 1, 5)).count(), 2)
+
+    def test_collections_in_one_batch_record_the_running_balance(self):
+        opening = self.create_bill(1).pending_amount
+        call_command('import_ledger', stdout=StringIO(), **self.write_files(self.files))
+        self.assertEqual(
+            list(DailyCollection.objects.order_by('id').values_list('pending_amount_as_of_today', flat=True)),
+            [opening + 2100, opening + 2000],
+        )
+
+    def test_missing_columns_are_rejected_before_importing(self):
+        files = {'bills': ['bill_ref,date,dukandaar,product,bora,price_per_kg',
+                           'B1,2024-01-05,Gupta Store,Product 0,0,40']}
+        with self.assertRaisesMessage(CommandError, 'missing the columns kg'):
+            call_command('import_ledger', stdout=StringIO(), **self.write_files(files))
+        self.assertFalse(Bill.objects.exists())
+
+
+class ReconcileTests(InventoryTestCase):
+    def setUp(self):
+        self.bill = self.create_bill(3)
+        DailyCollection.objects.create(dukandaar=self.dukandaar, bill=self.bill, amount_collected=Decimal(100))
+        order = PurchaseOrder.objects.create(company=self.company)
+        PurchaseItem.objects.create(purchase_order=order, product=self.products[0], kg=200, price_per_kg=10)
+
+    def test_finds_and_repairs_drift(self):
+        self.assertEqual(reconcile(), {name: [] for name in CHECKS})
+        # Balances written behind the ledger's back
+        Bill.objects.filter(pk=self.bill.pk).update(total_amount=F('total_amount') + 1, pending_amount=0)
+        Dukandaar.objects.filter(pk=self.dukandaar.pk).update(pending_amount=7)
+        Company.objects.filter(pk=self.company.pk).update(loan_amount=0)
+        Product.objects.filter(pk=self.products[0].pk).update(stock_in_kg=F('stock_in_kg') - Decimal('0.5'))
+
+        found = reconcile(fix=True)
+        self.assertEqual({name: [drift.pk for drift in drifts] for name, drifts in found.items()}, {
+            'bill_total': [self.bill.pk],
+            'bill_pending': [self.bill.pk],
+            'dukandaar_pending': [self.dukandaar.pk],
+            'company_loan': [self.company.pk],
+            'product_stock': [self.products[0].pk],
+        })
+        self.assertEqual(reconcile(), {name: [] for name in CHECKS})
+        self.bill.refresh_from_db()
+        self.dukandaar.refresh_from_db()
+        self.assertEqual((self.bill.total_amount, self.bill.pending_amount), (Decimal(4680), Decimal(4580)))
+        self.assertEqual(self.dukandaar.pending_amount, Decimal(4580))
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock_in_kg, Decimal(148))
+
+    def assertNoDrift(self, bill, pending, paid):
+        self.assertEqual(reconcile(), {name: [] for name in CHECKS})
+        bill.refresh_from_db()
+        self.assertEqual((bill.pending_amount, bill.paid), (Decimal(pending), paid))
+
+    def test_items_of_a_collected_bill_keep_it_consistent(self):
+        bill = post_bill(self.dukandaar, [BillLine(self.products[0], 0, 10, 20)])[0].bill
+        DailyCollection.objects.create(dukandaar=self.dukandaar, bill=bill, amount_collected=200)
+        self.assertNoDrift(bill, 0, True)
+        # What was collected is now owed back to the shop
+        admin.site._registry[Item].delete_queryset(None, Item.objects.filter(bill=bill))
+        self.assertNoDrift(bill, -200, True)
+        Item.objects.create(bill=bill, product=self.products[0], kg=15, price_per_kg=20)
+        self.assertNoDrift(bill, 100, False)
+
+    def test_ticking_paid_settles_a_bill_outside_the_collections(self):
+        bill = self.create_bill(1)
+        bill.paid = True
+        bill.save()
+        self.assertNoDrift(bill, 0, True)
+        Item.objects.create(bill=bill, product=self.products[0], kg=10, price_per_kg=20)
+        self.assertNoDrift(bill, 0, True)
+        bill.paid = False
+        bill.save()
+        self.assertNoDrift(bill, 1760, False)
+
+    def test_fixing_pending_settles_or_reopens_collected_bills(self):
+        collected = self.create_bill(1)
+        DailyCollection.objects.create(dukandaar=self.dukandaar, bill=collected, amount_collected=Decimal(1560))
+        Bill.objects.filter(pk=collected.pk).update(pending_amount=10, paid=False)
+        Bill.objects.filter(pk=self.bill.pk).update(pending_amount=0, paid=True)
+        self.assertEqual([drift.pk for drift in reconcile(fix=True)['bill_pending']], [self.bill.pk, collected.pk])
+        self.assertNoDrift(self.bill, 4580, False)
+        self.assertNoDrift(collected, 0, True)
+
+    def test_opening_and_adjustment_movements_are_counted(self):
+        product = self.products[1]
+        StockMovement.record(product, StockMovement.OPENING, Decimal(40), unit_cost=Decimal(12))
+        StockMovement.record(product, StockMovement.ADJUSTMENT, Decimal(-3))
+        self.assertEqual(find_drift('product_stock'), [])
+
+
+class StatementTests(InventoryTestCase):
+    def setUp(self):
+        # 1560 each: a bill collected in part, one ticked as paid and one collected after the day's bill
+        self.bills = [self.create_bill(1) for _ in range(3)]
+        self.bills[1].paid = True
+        self.bills[1].save()
+        for bill, day in zip(self.bills, (1, 2, 3)):
+            Bill.objects.filter(pk=bill.pk).update(date=date(2024, 3, day))
+        for bill, day, hour, amount in ((self.bills[0], 1, 10, 500), (None, 3, 9, 300)):
+            collection = DailyCollection.objects.create(dukandaar=self.dukandaar, bill=bill, amount_collected=amount)
+            DailyCollection.objects.filter(pk=collection.pk).update(
+                collection_time=timezone.make_aware(datetime(2024, 3, day, hour)))
+        self.dukandaar.refresh_from_db()
+
+    def lines(self, statement):
+        return [(line.date.day, line.kind, line.debit, line.credit, line.balance) for line in statement['lines']]
+
+    def test_running_balance_closes_at_pending_amount(self):
+        statement = get_statement(self.dukandaar)
+        self.assertEqual(self.lines(statement), [
+            (1, 'bill', 1560, 0, 1560),
+            (1, 'collection', 0, 500, 1060),
+            # Settled outside the collections, so it is never owed
+            (2, 'bill', 1560, 1560, 1060),
+            # Before the collection entered earlier that day
+            (3, 'bill', 1560, 0, 2620),
+            (3, 'collection', 0, 300, 2320),
+        ])
+        self.assertEqual((statement['total_debit'], statement['total_credit']), (4680, 2360))
+        self.assertEqual(statement['closing_balance'], self.dukandaar.pending_amount)
+
+    def test_dates_carry_the_opening_balance(self):
+        statement = get_statement(self.dukandaar, date(2024, 3, 2))
+        self.assertEqual(statement['opening_balance'], 1060)
+        self.assertEqual([line[:2] for line in self.lines(statement)], [(2, 'bill'), (3, 'bill'), (3, 'collection')])
+        self.assertEqual(statement['closing_balance'], self.dukandaar.pending_amount)
+
+        statement = get_statement(self.dukandaar, date(2024, 3, 3), date(2024, 3, 3))
+        self.assertEqual(statement['opening_balance'], 1060)
+        self.assertEqual(statement['closing_balance'], 2320)
+        statement = get_statement(self.dukandaar, end_date=date(2024, 3, 2))
+        self.assertEqual((statement['opening_balance'], statement['closing_balance']), (0, 1060))
+
+
+class ReceivablesAgeingTests(InventoryTestCase):
+    ages = (0, 30, 31, 60, 61, 90, 91, 400)
+
+    def setUp(self):
+        # A bill of age + 1 rupees per age, so each bucket's sum names the bills in it
+        for age in self.ages:
+            bill = post_bill(self.dukandaar, [BillLine(self.products[0], 0, age + 1, 1)])[0].bill
+            Bill.objects.filter(pk=bill.pk).update(date=date.today() - timedelta(days=age))
+        other = Dukandaar.objects.create(name='Sharma Store', area=Area.objects.create(area_name='Bazaar'))
+        partly_paid, paid = (post_bill(other, [BillLine(self.products[0], 0, 100, 1)])[0].bill for _ in range(2))
+        DailyCollection.objects.create(dukandaar=other, bill=partly_paid, amount_collected=40)
+        DailyCollection.objects.create(dukandaar=other, bill=paid, amount_collected=100)
+
+    def test_bucket_boundaries(self):
+        row = next(row for row in get_receivables_ageing() if row['dukandaar_id'] == self.dukandaar.pk)
+        self.assertEqual([row[key] for key, _, _, _ in AGEING_BUCKETS], [1 + 31, 32 + 61, 62 + 91, 92 + 401])
+        self.assertEqual(row['total'], sum(age + 1 for age in self.ages))
+
+    def test_csv_totals_match_summary_widget(self):
+        self.client.force_login(User.objects.create_superuser('owner'))
+        response = self.client.get(reverse('receivables_ageing'), {'group': 'area', 'format': 'csv'})
+        header, *rows = csv.reader(response.content.decode().splitlines())
+        self.assertEqual(header, ['Area'] + [label for _, label, _, _ in AGEING_BUCKETS] + ['Total'])
+        self.assertEqual(sorted(row[0] for row in rows), ['Bazaar', 'Station Road'])
+        totals = [sum(Decimal(row[column]) for row in rows) for column in range(1, len(header))]
+        summary = get_ageing_summary()
+        self.assertEqual(totals, [bucket['amount'] for bucket in summary['buckets']] + [summary['total']])
+        self.assertEqual(summary['total'], 771 + 60)
+
+
+@override_settings(SEARCH_INDEX_CACHE_ALIAS='default')
+class SearchTests(InventoryTestCase):
+    def setUp(self):
+        for name in ('Gupta General Store', 'Raj Gupta', 'Guptaji', 'Sharma Kirana'):
+            Dukandaar.objects.create(name=name, area=self.area)
+        # Each test starts from a fresh index, built by its first search
+        get_search_cache().clear()
+        self.index = INDEXES['dukandaar']
+        self.index.version = None
+
+    def names(self, query):
+        return [result['name'] for result in search('dukandaar', query)[0]]
+
+    def test_prefix_matches_rank_names_starting_with_the_query_first(self):
+        self.assertEqual(self.names('gupta'), ['Guptaji', 'Gupta Store', 'Gupta General Store', 'Raj Gupta'])
+        self.assertEqual(self.names('sto GUP'), ['Gupta Store', 'Gupta General Store'])
+        self.assertEqual(self.names('gup'), self.names('gupta'))
+
+    def test_misspelt_and_mid_word_queries_fall_back_to_trigrams(self):
+        self.assertEqual(self.names('kirrana'), ['Sharma Kirana'])
+        self.assertEqual(self.names('upta')[-1:], ['Raj Gupta'])
+        self.assertEqual(self.names('xyz'), [])
+
+    def test_containing_matches_words_anywhere_in_any_order(self):
+        found = set(Dukandaar.objects.filter(pk__in=search_ids('dukandaar', 'ORE gup')).values_list('name', flat=True))
+        self.assertEqual(found, {'Gupta Store', 'Gupta General Store'})
+        self.client.force_login(User.objects.create_superuser('owner'))
+        response = self.client.get(reverse('admin:inventory_dukandaar_changelist'), {'q': 'upt raj'})
+        self.assertEqual([row.name for row in response.context['cl'].result_list], ['Raj Gupta'])
+
+    def test_rename_updates_the_index_once_committed(self):
+        self.assertEqual(self.names('verma'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dukandaar.name = 'Verma Traders'
+            self.dukandaar.save()
+            # Not before the transaction commits
+            self.assertEqual(self.names('verma'), [])
+        self.assertEqual(self.names('verma'), ['Verma Traders'])
+        self.assertNotIn('Gupta Store', self.names('gupta'))
+        # Updated in place, so the index is still current
+        self.assertEqual(self.index.version, get_search_cache().get(VERSION_KEY.format('dukandaar')))
+
+    def test_version_change_from_another_process_forces_a_rebuild(self):
+        self.assertEqual(self.names('bansal'), [])
+        # Rows written without signals, then the version bumped as another process would
+        Dukandaar.objects.bulk_create([Dukandaar(name='Bansal Stores', area=self.area)])
+        self.assertEqual(self.names('bansal'), [])
+        get_search_cache().set(VERSION_KEY.format('dukandaar'), 7)
+        self.assertEqual(self.names('bansal'), ['Bansal Stores'])
+        self.assertEqual(self.index.version, 7)
+
+
+@override_settings(ANALYTICS_CACHE_ALIAS='default')
+class UnpaidBillsETagTests(InventoryTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        self.other = Dukandaar.objects.create(name='Sharma Store', area=self.area)
+        # Ledger versions are bumped once the write commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bill = self.create_bill(2)
+
+    def get(self, dukandaar, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(reverse('get_unpaid_bills'), {'dukandaar': dukandaar.pk}, **headers)
+
+    def test_not_modified_until_the_shop_changes(self):
+        response = self.get(self.dukandaar)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['bills']), 1)
+        etag = response['ETag']
+        self.assertEqual(self.get(self.dukandaar, etag).status_code, 304)
+
+        # Another shop's bill leaves this one's version alone
+        with self.captureOnCommitCallbacks(execute=True):
+            post_bill(self.other, [BillLine(self.products[0], 0, 1, 10)])
+        self.assertEqual(self.get(self.dukandaar, etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            DailyCollection.objects.create(dukandaar=self.dukandaar, bill=self.bill,
+                                           amount_collected=self.bill.total_amount)
+        response = self.get(self.dukandaar, etag)
+        self.assertEqual(response.status_code, 404)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class BackupTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.db_path = os.path.join(self.directory, 'live.sqlite3')
+        self.storage = backup.LocalDirectoryStorage(os.path.join(self.directory, 'storage'))
+        with self.connect(self.db_path) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE note (id INTEGER PRIMARY KEY, body TEXT)')
+        self.names = []
+
+    def connect(self, path):
+        db = sqlite3.connect(path)
+        self.addCleanup(db.close)
+        return db
+
+    def write_and_back_up(self, rows):
+        with self.connect(self.db_path) as db:
+            # Random, so the full copy does not compress away
+            db.executemany('INSERT INTO note (body) VALUES (?)', [(os.urandom(100).hex(),) for _ in range(rows)])
+            db.execute('UPDATE note SET body = ? WHERE id = 1', (f'{rows} more',))
+        self.names.append(backup.make_backup(self.db_path, self.storage, os.path.join(self.directory, 'state'),
+                                             full_every=3, keep_chains=2))
+
+    def restored(self, name=None):
+        path = os.path.join(self.directory, 'restored.sqlite3')
+        self.assertEqual(backup.restore(self.storage, path, name), name or self.names[-1])
+        db = self.connect(path)
+        self.assertEqual(db.execute('PRAGMA integrity_check').fetchone(), ('ok',))
+        return db.execute('SELECT COUNT(*) FROM note').fetchone()[0]
+
+    def test_full_and_deltas_restore_and_expire(self):
+        for rows in (2000, 10, 500, 20, 30):
+            self.write_and_back_up(rows)
+        self.assertEqual([name.split('.')[-2] for name in self.names], ['full', 'delta', 'delta', 'full', 'delta'])
+        first, delta = (os.path.getsize(os.path.join(self.storage.path, name)) for name in self.names[:2])
+        # Only the blocks holding the header, the first row and the new rows
+        self.assertLess(delta, first / 2)
+
+        self.assertEqual(self.restored(), 2560)
+        self.assertEqual(self.restored(self.names[2]), 2510)
+        self.assertEqual(self.restored(self.names[1]), 2010)
+
+        # A third chain expires the first
+        self.write_and_back_up(1)
+        self.write_and_back_up(1)
+        self.assertEqual(self.storage.list(), sorted(self.names[3:]))
+        self.assertEqual(self.restored(self.names[3]), 2530)
+        self.assertEqual(self.restored(), 2562)
+
+
+@override_settings(JOB_RETRY_DELAY=10)
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        jobs.TASKS['test_task'] = jobs.Task(self.task, None)
+        self.addCleanup(jobs.TASKS.pop, 'test_task')
+
+    def task(self, job, fail=False):
+        self.calls.append(job.pk)
+        if fail:
+            raise RuntimeError('Printer on fire')
+        return {'done': job.pk}
+
+    def test_claims_each_due_job_once_oldest_first(self):
+        first = jobs.submit('test_task')
+        second = jobs.submit('test_task')
+        later = jobs.submit('test_task')
+        Job.objects.filter(pk=later.pk).update(run_after=timezone.now() + timedelta(hours=1))
+
+        claimed = [jobs.claim('worker:0'), jobs.claim('worker:1'), jobs.claim('worker:0')]
+        self.assertEqual([job and job.pk for job in claimed], [first.pk, second.pk, None])
+        self.assertEqual((claimed[1].status, claimed[1].worker, claimed[1].attempts), (Job.RUNNING, 'worker:1', 1))
+
+    def run_failing(self):
+        with self.assertLogs('inventory.jobs', 'ERROR'):
+            return jobs.run(jobs.claim('worker'))
+
+    def test_failures_retry_with_backoff_until_out_of_attempts(self):
+        job = jobs.submit('test_task', max_attempts=3, fail=True)
+        for attempt, delay in ((1, 10), (2, 20)):
+            job = self.run_failing()
+            self.assertEqual((job.status, job.attempts), (Job.QUEUED, attempt))
+            self.assertIn('Printer on fire', job.error)
+            self.assertAlmostEqual((job.run_after - timezone.now()).total_seconds(), delay, delta=2)
+            self.assertIsNone(jobs.claim('worker'))
+            Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+
+        job = self.run_failing()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 3))
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(self.calls, [job.pk] * 3)
+
+    def test_requeues_jobs_of_dead_workers(self):
+        retried, exhausted = (jobs.submit('test_task', max_attempts=2) for _ in range(2))
+        for job, attempts in ((retried, 1), (exhausted, 2)):
+            Job.objects.filter(pk=job.pk).update(status=Job.RUNNING, attempts=attempts,
+                                                 started_at=timezone.now() - timedelta(hours=2))
+
+        self.assertEqual(jobs.requeue_stale(timeout=3600), (1, 1))
+        retried.refresh_from_db()
+        exhausted.refresh_from_db()
+        self.assertEqual(retried.status, Job.QUEUED)
+        self.assertEqual((exhausted.status, exhausted.error), (Job.FAILED, 'Timed out'))
+        self.assertEqual(jobs.run(jobs.claim('worker')).result, {'done': retried.pk})
+
+
+class JobViewTests(InventoryTestCase):
+    def setUp(self):
+        result_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, result_dir)
+        patcher = override_settings(JOB_RESULT_DIR=result_dir)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def login(self, username, **flags):
+        user = User.objects.create_user(username, **flags)
+        self.client.force_login(user)
+        return user
+
+    def post_job(self, task, **kwargs):
+        return self.client.post(reverse('submit_job', args=[task]), json.dumps(kwargs),
+                                content_type='application/json')
+
+    def test_submit_status_download(self):
+        self.create_bill(2)
+        self.login('owner', is_staff=True, is_superuser=True)
+        response = self.post_job('ageing_csv', group_by='area')
+        self.assertEqual(response.status_code, 202)
+        status_url = response['Location']
+        self.assertEqual(self.client.get(status_url).json()['status'], Job.QUEUED)
+
+        jobs.run(jobs.claim('worker'))
+        status = self.client.get(status_url).json()
+        self.assertEqual(status['status'], Job.SUCCEEDED)
+        response = self.client.get(status['download_url'])
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        expected = StringIO()
+        write_receivables_ageing_csv(expected, 'area')
+        self.assertEqual(b''.join(response.streaming_content).decode(), expected.getvalue())
+        area, *amounts = expected.getvalue().splitlines()[1].split(',')
+        self.assertEqual((area, [Decimal(amount) for amount in amounts]), ('Station Road', [3120, 0, 0, 0, 3120]))
+
+    def test_submit_needs_the_task_permission(self):
+        user = self.login('salesman')
+        self.assertEqual(self.post_job('bills_pdf', bill_ids=[1]).status_code, 403)
+        with self.assertRaises(PermissionDenied):
+            jobs.submit('bills_pdf', user, bill_ids=[1])
+        self.assertEqual(self.post_job('statement_pdf', dukandaar_id=self.dukandaar.pk).status_code, 202)
+
+        self.login('staff', is_staff=True)
+        self.assertEqual(self.post_job('ageing_csv').status_code, 403)
+        self.assertEqual(self.post_job('bills_pdf', bill_ids=[1]).status_code, 202)
+        self.assertEqual(Job.objects.count(), 2)
+
+    def test_results_need_the_task_permission(self):
+        user = self.login('staff', is_staff=True)
+        job = jobs.submit('route_sheets', user)
+        job_status = reverse('job_status', args=[job.pk])
+        self.assertEqual(self.client.get(job_status).status_code, 200)
+
+        User.objects.filter(pk=user.pk).update(is_staff=False)
+        self.assertEqual(self.client.get(job_status).status_code, 403)
+        self.assertEqual(self.client.get(reverse('job_download', args=[job.pk])).status_code, 403)
+        # Nor can other users see the job at all
+        self.login('other', is_staff=True)
+        self.assertEqual(self.client.get(job_status).status_code, 404)
+
+
+@override_settings(ANALYTICS_CACHE_ALIAS='default')
+class AnalyticsProfilingTests(TransactionTestCase):
+    # The widgets run on their own connections, which must see committed rows
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('owner'))
+        self.addCleanup(self.close_widget_connections)
+
+    def close_widget_connections(self):
+        # The widget threads keep their connections open, which would keep the test database in use
+        threads = settings.ANALYTICS_WIDGET_THREADS
+        barrier = threading.Barrier(threads)
+
+        def close():
+            barrier.wait()
+            connection.close()
+        for future in [cache._widget_executor.submit(close) for _ in range(threads)]:
+            future.result()
+
+    def profile(self):
+        with self.assertLogs('inventory.requests') as logs:
+            response = self.client.get(reverse('analytics_data'), {'_profile': 1})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(logs.records[-1].getMessage())
+
+    def test_widget_queries_count_towards_profiled_request(self):
+        get_analytics_cache().clear()
+        cold = self.profile()
+        warm = self.profile()
+        # Each widget computed on a cache miss runs at least one query on its own thread
+        self.assertGreaterEqual(cold['queries'], warm['queries'] + len(ANALYTICS_WIDGETS))
+
+    def test_benchmark_counts_widget_queries(self):
+        def cold_load():
+            get_analytics_cache().clear()
+            self.assertEqual(self.client.get(reverse('analytics_data')).status_code, 200)
+        self.assertGreaterEqual(measure(cold_load, repeat=1)['queries'], len(ANALYTICS_WIDGETS))
+
+
+class BillDocumentTests(InventoryTestCase):
+    def setUp(self):
+        self.pdf_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.pdf_dir)
+
+    def test_render_query_count_does_not_grow_with_items(self):
+        for lines in (1, 25):
+            bill = self.create_bill(lines)
+            with self.assertNumQueries(2):
+                document = load_bill_document(bill.id)
+                render_bill_pdf(document)
+
+    def test_cached_reprint_query_count_does_not_grow_with_items(self):
+        with override_settings(BILL_PDF_CACHE_DIR=self.pdf_dir):
+            for lines in (1, 25):
+                bill = self.create_bill(lines)
+                first = get_bill_pdf(load_bill_document(bill.id))
+                with self.assertNumQueries(2):
+                    self.assertEqual(get_bill_pdf(load_bill_document(bill.id)), first)
+
+    @override_settings(BILL_PDF_PROCESSES=4, BILL_PDF_POOL_MIN_BILLS=4)
+    def test_small_batches_render_in_process(self):
+        bills = [self.create_bill(1) for _ in range(3)]
+        with override_settings(BILL_PDF_CACHE_DIR=self.pdf_dir), mock.patch('inventory.pdf.process_pool') as pool:
+            pdf = render_bills_batch([bill.id for bill in bills])
+        pool.assert_not_called()
+        self.assertEqual(len(PdfReader(BytesIO(pdf)).pages), 3)
+
+    def test_prune_deletes_only_unused_pdfs(self):
+        with override_settings(BILL_PDF_CACHE_DIR=self.pdf_dir):
+            old, recent = (self.create_bill(1) for _ in range(2))
+            get_bill_pdf(load_bill_document(old.id))
+            get_bill_pdf(load_bill_document(recent.id))
+            month_ago = time.time() - 31 * 24 * 3600
+            for name in os.listdir(self.pdf_dir):
+                if name.startswith(f'bill_{old.id}_'):
+                    os.utime(os.path.join(self.pdf_dir, name), (month_ago, month_ago))
+            self.assertEqual(prune_pdf_cache(30), 1)
+            self.assertEqual([name.split('_')[1] for name in os.listdir(self.pdf_dir)], [str(recent.id)])
+
+
+class AdminChangelistQueryTests(InventoryTestCase):
+    # Session, user, count, page rows and, where present, the dukandaar filter choices
+    changelist_queries = {
+        'bill': 5,
+        'item': 4,
+        'dailycollection': 5,
+        'purchaseitem': 4,
+        'purchaseorder': 4,
+    }
+
+    def setUp(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def add_rows(self, count):
+        for i in range(count):
+            area = Area.objects.create(area_name=f'Area {i}')
+            dukandaar = Dukandaar.objects.create(name=f'Shop {count}-{i}', area=area)
+            bill = post_bill(dukandaar, [BillLine(self.products[0], 0, 5, 20), BillLine(self.products[1], 1, 0, 20)])[0].bill
+            DailyCollection.objects.create(dukandaar=dukandaar, bill=bill, amount_collected=Decimal(50))
+            order = PurchaseOrder.objects.create(company=Company.objects.create(name=f'Company {count}-{i}'))
+            PurchaseItem.objects.create(purchase_order=order, product=self.products[2], kg=10, price_per_kg=15)
+
+    def test_changelist_query_count_is_constant(self):
+        for rows in (2, 20):
+            self.add_rows(rows)
+            for model_name, queries in self.changelist_queries.items():
+                model_admin = admin.site._registry[apps.get_model('inventory', model_name)]
+                if model_admin.paginator is EstimatedCountPaginator and connection.vendor == 'postgresql':
+                    # EstimatedCountPaginator reads the planner's estimate first
+                    queries += 1
+                with self.subTest(model=model_name, rows=rows), self.assertNumQueries(queries):
+                    response = self.client.get(reverse(f'admin:inventory_{model_name}_changelist'))
+                    self.assertEqual(response.status_code, 200)
+
+
+class AdminExportTests(InventoryTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        other = Dukandaar.objects.create(name='Sharma Kirana', area=self.area)
+        self.bills = [self.create_bill(lines) for lines in (1, 2, 3)]
+        self.bills.append(post_bill(other, [BillLine(self.products[0], 0, 5, 20)])[0].bill)
+        Bill.objects.filter(pk=self.bills[0].pk).update(date=date(2024, 1, 10))
+        self.bills[1].paid = True
+        self.bills[1].save()
+
+    def test_export_streams_the_filtered_changelist(self):
+        first, paid, unpaid, other = self.bills
+        filters = [
+            ({}, [first, paid, unpaid, other]),
+            ({'dukandaar__id__exact': self.dukandaar.pk}, [first, paid, unpaid]),
+            ({'dukandaar__id__exact': self.dukandaar.pk, 'paid__exact': 0}, [first, unpaid]),
+            ({'date__gte': '2024-01-01', 'date__lt': '2024-02-01'}, [first]),
+            ({'q': 'sharma'}, [other]),
+        ]
+        for params, bills in filters:
+            with self.subTest(params=params):
+                changelist = self.client.get(reverse('admin:inventory_bill_changelist'), params).context['cl']
+                self.assertCountEqual(changelist.queryset, bills)
+                expected = Item.objects.filter(bill__in=changelist.queryset).order_by('bill_id', 'id')
+                response = self.client.get(reverse('admin:inventory_bill_export'), params)
+                self.assertEqual(response.status_code, 200)
+                rows = list(csv.DictReader(line.decode() for line in response.streaming_content))
+                self.assertEqual([(int(row['Bill Id']), row['Product']) for row in rows],
+                                 [(item.bill_id, item.product.name) for item in expected])
+
+    def test_invalid_filter_is_a_bad_request(self):
+        for params in ({'date__gte': 'yesterday'}, {'dukandaar__id__exact': 'gupta'},
+                       {'paid__exact': 'maybe'}, {'no_such_field': 1}):
+            with self.subTest(params=params):
+                response = self.client.get(reverse('admin:inventory_bill_export'), params)
+                self.assertEqual(response.status_code, 400)
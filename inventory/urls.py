@@ -5,8 +5,23 @@ urlpatterns = [
     path('add_collection/', views.add_daily_collection, name='add_collection'),
     path('collection_success/', views.collection_success, name='collection_success'),
     path('pdf/<int:bill_id>/', views.GeneratePdf.as_view(), name='generatepdf'),
+    path('pdf/batch/', views.GenerateBatchPdf.as_view(), name='generatepdf_batch'),
     path('analytics/', views.analytics_view, name='analytics'),
+    path('analytics/data/', views.analytics_data, name='analytics_data'),
+    path('analytics/cache_stats/', views.analytics_cache_stats, name='analytics_cache_stats'),
+    path('analytics/ageing/', views.receivables_ageing, name='receivables_ageing'),
+    path('stock/reorder/', views.reorder_suggestions, name='reorder_suggestions'),
     path('', views.index_page, name='index'),
     path('admin/', views.redirect_to_admin, name='admin'),
     path('get_unpaid_bills/', views.get_unpaid_bills, name='get_unpaid_bills'),
+    path('export/<str:name>/', views.export_csv, name='export_csv'),
+    path('profiling/', views.slow_endpoints, name='slow_endpoints'),
+    path('search/', views.search_view, name='search'),
+    path('statement/<int:dukandaar_id>/', views.dukandaar_statement, name='dukandaar_statement'),
+    path('statement/<int:dukandaar_id>/pdf/', views.dukandaar_statement_pdf, name='dukandaar_statement_pdf'),
+    path('route_sheets/', views.route_sheets, name='route_sheets'),
+    path('route_sheets/pdf/', views.route_sheets_pdf, name='route_sheets_pdf'),
+    path('jobs/submit/<str:task>/', views.submit_job, name='submit_job'),
+    path('jobs/<int:job_id>/', views.job_status, name='job_status'),
+    path('jobs/<int:job_id>/download/', views.job_download, name='job_download'),
 ]
@@ -2,12 +2,20 @@ from django.template.loader import get_template
 from xhtml2pdf import pisa
 from io import BytesIO
 from django.http import HttpResponse
-from django.contrib.admin import SimpleListFilter
+from django.contrib.admin import SimpleListFilter, RelatedFieldListFilter
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from datetime import date
-from django.db.models import F
+from django.db.models import FilteredRelation, Q
 from datetime import timedelta, datetime
-from django.db.models import Sum
-from .models import Bill, Item, Dukandaar, PurchaseItem
+from django.db.models import Sum, Count
+from django.db.models.functions import Coalesce, TruncDay, TruncWeek, TruncMonth
+from decimal import Decimal
+import csv
+import math
+from django.conf import settings
+from .models import Bill, Dukandaar, Product, PurchaseItem, DailySalesRollup
 
 def render_to_pdf(template_src, context_dict):
     template = get_template(template_src)
@@ -51,6 +59,71 @@ class DateRangeFilter(SimpleListFilter):
             return queryset.filter(collection_time__range=[start_date, end_date])
         return queryset
 
+class DukandaarListFilter(RelatedFieldListFilter):
+    # Dukandaar.__str__ reads the area, so load all choices with their areas in one query
+    def field_choices(self, field, request, model_admin):
+        ordering = self.field_admin_ordering(field, request, model_admin) or ['name']
+        return [(dukandaar.pk, str(dukandaar))
+                for dukandaar in Dukandaar.objects.select_related('area').order_by(*ordering)]
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that, for unfiltered changelists of large tables on PostgreSQL,
+    uses the planner's row estimate instead of a full COUNT(*).
+    """
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            connection = connections[self.object_list.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                                   [self.object_list.model._meta.db_table])
+                    row = cursor.fetchone()
+                if row and row[0] >= self.estimate_threshold:
+                    return int(row[0])
+        return super().count
+
+def unpaid_bills_query(dukandaar_ids):
+    """
+    The shops left joined to their unpaid bills, oldest first, so shops
+    without any still come back (with no bills) and unknown ids do not.
+    """
+    return (Dukandaar.objects.filter(pk__in=dukandaar_ids)
+            .annotate(unpaid=FilteredRelation('bill', condition=Q(bill__paid=False)))
+            .order_by('pk', 'unpaid__date', 'unpaid__id')
+            .values_list('pk', 'name', 'area__area_name', 'unpaid__id', 'unpaid__date',
+                         'unpaid__total_amount', 'unpaid__pending_amount'))
+
+
+def group_unpaid_bills(rows):
+    """
+    {dukandaar id: {'name', 'bills'}} out of the rows of unpaid_bills_query.
+    Each bill carries the label Bill.__str__ would give it.
+    """
+    result = {}
+    for dukandaar_id, name, area_name, bill_id, bill_date, total_amount, pending_amount in rows:
+        dukandaar = result.setdefault(dukandaar_id, {'name': name, 'bills': []})
+        if bill_id is None:
+            continue
+        dukandaar['bills'].append({
+            'id': bill_id,
+            'dukandaar': name,
+            'date': bill_date,
+            'total_amount': total_amount,
+            'pending_amount': pending_amount,
+            '__str__': f"{bill_id} - {name} {area_name} - {bill_date} - {pending_amount}",
+        })
+    return result
+
+
+async def aget_unpaid_bills_by_dukandaar(dukandaar_ids):
+    """Each shop's unpaid bills, oldest first, from one query, see group_unpaid_bills."""
+    return group_unpaid_bills([row async for row in unpaid_bills_query(dukandaar_ids)])
+
 # 1. Fetch today's bill count and percentage increase or decrease compared to yesterday
 def get_sales_count_comparison():
     today = date.today()
@@ -86,15 +159,15 @@ def get_monthly_revenue_comparison():
     first_day_of_this_month = today.replace(day=1)
     first_day_of_last_month = (first_day_of_this_month - timedelta(days=1)).replace(day=1)
 
-    # This month's revenue (sum of item amounts)
-    this_month_revenue = Item.objects.filter(bill__date__gte=first_day_of_this_month).aggregate(
-        total_revenue=Sum('amount')
+    # This month's revenue (from the daily sales rollup)
+    this_month_revenue = DailySalesRollup.objects.filter(date__gte=first_day_of_this_month).aggregate(
+        total_revenue=Sum('revenue')
     )['total_revenue'] or 0
 
-    # Last month's revenue (sum of item amounts)
-    last_month_revenue = Item.objects.filter(bill__date__gte=first_day_of_last_month,
-                                             bill__date__lt=first_day_of_this_month).aggregate(
-        total_revenue=Sum('amount')
+    # Last month's revenue (from the daily sales rollup)
+    last_month_revenue = DailySalesRollup.objects.filter(date__gte=first_day_of_last_month,
+                                                         date__lt=first_day_of_this_month).aggregate(
+        total_revenue=Sum('revenue')
     )['total_revenue'] or 0
 
     # Calculate percentage change
@@ -139,11 +212,11 @@ def get_top_20_products_by_revenue():
     first_day_of_this_month = today.replace(day=1)
 
     # Fetch products with total revenue generated in the current month, grouped by product id
-    top_revenue_products = Item.objects.filter(bill__date__gte=first_day_of_this_month).values(
+    top_revenue_products = DailySalesRollup.objects.filter(date__gte=first_day_of_this_month).values(
         'product__id', 'product__name', 'product__stock_in_kg'
     ).annotate(
-        total_revenue=Sum('amount'),
-        total_kgs_sold=Sum('kg') + Sum(F('bora') * F('product__one_bora_in_kg'))
+        total_revenue=Sum('revenue'),
+        total_kgs_sold=Sum('kg_sold')
     ).order_by('-total_revenue')[:20]
 
     # Construct the list of top-selling products by revenue
@@ -193,44 +266,76 @@ def get_annual_customer_count_and_trend():
             'decreasePerc': percentage_change
         }
 
-def get_last_15_days_sales_data():
-    # Initialize arrays
-    sale_array = []
-    revenue_array = []
-    customer_array = []
-    time_array = []
+SALES_SERIES_BUCKETS = {
+    'day': TruncDay,
+    'week': TruncWeek,
+    'month': TruncMonth,
+}
 
+def get_sales_buckets(start_date, end_date, bucket='day'):
+    """First day of every bucket overlapping start_date..end_date, as Trunc returns it."""
+    if bucket == 'month':
+        period = start_date.replace(day=1)
+    else:
+        period = start_date - timedelta(days=start_date.weekday() if bucket == 'week' else 0)
+    while period <= end_date:
+        yield period
+        if bucket == 'month':
+            period = (period + timedelta(days=32)).replace(day=1)
+        else:
+            period += timedelta(days=7 if bucket == 'week' else 1)
+
+def get_sales_time_series(start_date, end_date, bucket='day'):
+    """
+    Revenue, bill count and distinct customer count per bucket between
+    start_date and end_date (both inclusive), computed with two grouped queries.
+    Every bucket is listed, those without sales with zeros.
+    """
+    if bucket not in SALES_SERIES_BUCKETS:
+        raise ValueError(f"Unknown bucket '{bucket}', expected one of {list(SALES_SERIES_BUCKETS)}")
+    trunc = SALES_SERIES_BUCKETS[bucket]
+
+    # Revenue per bucket, read from the daily sales rollup
+    revenue_rows = (DailySalesRollup.objects
+                    .filter(date__range=[start_date, end_date])
+                    .annotate(period=trunc('date'))
+                    .values('period')
+                    .annotate(revenue=Sum('revenue')))
+    revenue_by_period = {row['period']: row['revenue'] for row in revenue_rows}
+
+    # Bill count and unique customers per bucket
+    bill_rows = (Bill.objects
+                 .filter(date__range=[start_date, end_date])
+                 .annotate(period=trunc('date'))
+                 .values('period')
+                 .annotate(bills=Count('id'), customers=Count('dukandaar', distinct=True)))
+    bills_by_period = {row['period']: row for row in bill_rows}
+
+    series = []
+    for period in get_sales_buckets(start_date, end_date, bucket):
+        counts = bills_by_period.get(period, {})
+        series.append({
+            'period': period,
+            'revenue': revenue_by_period.get(period) or Decimal(0),
+            'bills': counts.get('bills', 0),
+            'customers': counts.get('customers', 0),
+        })
+    return series
+
+def get_last_15_days_sales_data(days=15, bucket='day'):
     # Get the current date and the start date (15 days ago)
     end_date = datetime.now().date()
-    start_date = end_date - timedelta(days=14)
-
-    # Loop through each day in the last 15 days
-    for i in range(30):
-        current_date = start_date + timedelta(days=i)
-        # Total revenue generated in thousands for the day
-        total_revenue = Item.objects.filter(bill__date=current_date).aggregate(revenue=Sum('amount'))['revenue'] or 0
-        if total_revenue == 0:
-            continue
-        revenue_array.append(int(total_revenue) / 1000)  # Convert to thousands
+    start_date = end_date - timedelta(days=days - 1)
 
-        # Bill count (sales) for the day
-        bill_count = Bill.objects.filter(date=current_date).count()
-        sale_array.append(bill_count)
-
-        # Customer count (unique customers who had bills) for the day
-        customer_count = Dukandaar.objects.filter(bill__date=current_date).distinct().count()
-        customer_array.append(customer_count)
-
-        # Time array (in the required format)
-        time_string = current_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        time_array.append(time_string)
+    # The chart only plots the days with sales
+    series = [row for row in get_sales_time_series(start_date, end_date, bucket=bucket) if row['revenue']]
 
     # Return the result as a dictionary
     return {
-        'sale_array': sale_array,
-        'revenue_array': revenue_array,
-        'customer_array': customer_array,
-        'time_array': time_array
+        'sale_array': [row['bills'] for row in series],
+        'revenue_array': [int(row['revenue']) / 1000 for row in series],  # Convert to thousands
+        'customer_array': [row['customers'] for row in series],
+        'time_array': [row['period'].strftime("%Y-%m-%dT%H:%M:%S.000Z") for row in series]
     }
 
 
@@ -246,10 +351,10 @@ def get_purchase_sell_data_for_chart():
                  .annotate(total_purchase_value=Sum('amount')))
 
     # Get the total sell value for each product sold this month
-    sells = (Item.objects
-             .filter(bill__date__month=current_month, bill__date__year=current_year)
+    sells = (DailySalesRollup.objects
+             .filter(date__month=current_month, date__year=current_year)
              .values('product__name')
-             .annotate(total_sell_value=Sum('amount')))
+             .annotate(total_sell_value=Sum('revenue')))
 
     # Prepare the dynamic product list with 300000 as the maximum for each indicator
     indicators = []
@@ -281,16 +386,148 @@ def get_purchase_sell_data_for_chart():
 
 def get_sold_products_last_month():
     # Calculate the date range for the last month
-    today = datetime.now()
+    today = datetime.now().date()
     last_30_date = today - timedelta(days=30)
 
     # Query to get the unique products sold in the last month
-    sold_products = (Item.objects
-                     .filter(bill__date__range=[last_30_date, today])  # Filter bills within the last month
+    sold_products = (DailySalesRollup.objects
+                     .filter(date__range=[last_30_date, today])  # Filter sales within the last month
                      .values('product__name')  # Group by product name
-                     .annotate(total_kgs_sold=Sum(F('kg') + F('bora') * F('product__one_bora_in_kg'))))
+                     .annotate(total_kgs_sold=Sum('kg_sold')))
 
     # Convert the QuerySet to a list of dictionaries
     result = [{'name': item['product__name'], 'value': float(item['total_kgs_sold'])} for item in sold_products]
 
     return result
+
+# Receivables ageing: (bucket key, label, min age in days, max age in days or None)
+AGEING_BUCKETS = [
+    ('days_0_30', '0-30 days', 0, 30),
+    ('days_31_60', '31-60 days', 31, 60),
+    ('days_61_90', '61-90 days', 61, 90),
+    ('days_over_90', '90+ days', 91, None),
+]
+
+AGEING_GROUPS = {
+    'dukandaar': ['dukandaar_id', 'dukandaar__name', 'dukandaar__area__area_name'],
+    'area': ['dukandaar__area_id', 'dukandaar__area__area_name'],
+}
+
+
+def get_ageing_aggregates(as_of=None):
+    """Sum(pending_amount) per ageing bucket, by bill date, plus the total."""
+    as_of = as_of or date.today()
+    aggregates = {}
+    for key, _, min_age, max_age in AGEING_BUCKETS:
+        condition = Q(date__lte=as_of - timedelta(days=min_age))
+        if max_age is not None:
+            condition &= Q(date__gte=as_of - timedelta(days=max_age))
+        aggregates[key] = Coalesce(Sum('pending_amount', filter=condition), Decimal(0))
+    aggregates['total'] = Coalesce(Sum('pending_amount'), Decimal(0))
+    return aggregates
+
+
+def get_receivables_ageing(group_by='dukandaar', as_of=None):
+    """
+    Outstanding dues per dukandaar or per area split into ageing buckets, in
+    one grouped query over the unpaid bills using conditional aggregation.
+    Largest total first.
+    """
+    return list(Bill.objects.filter(paid=False, pending_amount__gt=0)
+                .values(*AGEING_GROUPS[group_by])
+                .annotate(**get_ageing_aggregates(as_of))
+                .order_by('-total'))
+
+
+AGEING_HEADERS = {'dukandaar__name': 'Dukandaar', 'dukandaar__area__area_name': 'Area'}
+
+
+def write_receivables_ageing_csv(out, group_by='dukandaar'):
+    """Write get_receivables_ageing as CSV to the file-like out, name columns without the id."""
+    columns = AGEING_GROUPS[group_by][1:]
+    writer = csv.writer(out)
+    writer.writerow([AGEING_HEADERS[column] for column in columns]
+                    + [label for _, label, _, _ in AGEING_BUCKETS] + ['Total'])
+    for row in get_receivables_ageing(group_by):
+        writer.writerow([row[column] for column in columns]
+                        + [row[key] for key, _, _, _ in AGEING_BUCKETS] + [row['total']])
+
+
+def get_ageing_summary():
+    """Dashboard widget: the bucket totals over all shops."""
+    totals = Bill.objects.filter(paid=False, pending_amount__gt=0).aggregate(**get_ageing_aggregates())
+    return {
+        'buckets': [{'label': label, 'amount': totals[key]} for key, label, _, _ in AGEING_BUCKETS],
+        'total': totals['total'],
+    }
+
+
+# Dashboard widgets by cache name, see analytics_view
+ANALYTICS_WIDGETS = {
+    'sales': get_sales_count_comparison,
+    'revenue': get_monthly_revenue_comparison,
+    'customer': get_annual_customer_count_and_trend,
+    'todaysaleslist': get_todays_sales_list,
+    'topsellinglist': get_top_20_products_by_revenue,
+    'sales_data': get_last_15_days_sales_data,
+    'spider_data': get_purchase_sell_data_for_chart,
+    'products_sold': get_sold_products_last_month,
+    'ageing': get_ageing_summary,
+}
+
+
+def get_sales_velocity(days=None, company=None):
+    """
+    Average kg sold per day over the last days (REORDER_WINDOW_DAYS by
+    default) per product, from the daily sales rollup in one grouped query.
+    """
+    days = days or getattr(settings, 'REORDER_WINDOW_DAYS', 30)
+    rows = DailySalesRollup.objects.filter(date__gt=date.today() - timedelta(days=days))
+    if company is not None:
+        rows = rows.filter(product__company=company)
+    return {product_id: kg_sold / days
+            for product_id, kg_sold in rows.values_list('product_id').annotate(Sum('kg_sold'))}
+
+
+def get_reorder_suggestions(company=None):
+    """
+    Stock position of every product, grouped by company. A product is due
+    for reorder when its stock covers less than the supplier lead time at
+    the current sales velocity; the suggested order brings it up to lead
+    time plus REORDER_COVER_DAYS, rounded up to whole bora.
+    """
+    lead_days = getattr(settings, 'REORDER_LEAD_DAYS', 7)
+    cover_days = getattr(settings, 'REORDER_COVER_DAYS', 14)
+    velocity = get_sales_velocity(company=company)
+    products = Product.objects.select_related('company').order_by('company__name', 'name')
+    if company is not None:
+        products = products.filter(company=company)
+
+    companies = {}
+    for product in products:
+        per_day = velocity.get(product.pk, Decimal(0))
+        stock = Decimal(product.stock_in_kg)
+        suggested_kg = 0
+        if per_day and stock < per_day * lead_days:
+            bora_kg = product.one_bora_in_kg or 1
+            suggested_kg = math.ceil((per_day * (lead_days + cover_days) - stock) / bora_kg) * bora_kg
+        entry = companies.setdefault(product.company_id, {
+            'company_id': product.company_id,
+            'company': product.company.name,
+            'stock_value': Decimal(0),
+            'products': [],
+        })
+        entry['stock_value'] += round(stock * product.average_cost, 2)
+        entry['products'].append({
+            'product_id': product.pk,
+            'name': product.name,
+            'stock_in_kg': product.stock_in_kg,
+            'average_cost': product.average_cost,
+            'stock_value': round(stock * product.average_cost, 2),
+            'kg_per_day': round(per_day, 2),
+            'days_of_cover': round(stock / per_day, 1) if per_day else None,
+            'reorder': bool(suggested_kg),
+            'suggested_kg': suggested_kg,
+            'suggested_bora': suggested_kg // (product.one_bora_in_kg or 1),
+        })
+    return list(companies.values())
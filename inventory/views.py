@@ -1,10 +1,35 @@
 from django.shortcuts import render, redirect
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from .forms import DailyCollectionForm
 from django.views.generic import View
+from django.utils.decorators import method_decorator
 from django.shortcuts import get_object_or_404
 from .utils import *
-from django.http import HttpResponseForbidden, JsonResponse
+from .models import Area, Job
+from .cache import aget_cached_widgets, aget_ledger_versions, get_cached_widget, get_analytics_cache_stats
+from .exports import EXPORTS, get_export_queryset, stream_csv
+from .pdf import (PdfRenderError, bill_document_queryset, get_bill_pdf, render_bills_batch, render_statement_pdf,
+                  render_route_sheet_pdf, merge_pdfs)
+from .routes import get_route_sheet, read_route_sheet
+from .ledger import get_statement
+from .middleware import get_endpoint_stats
+from .search import INDEXES, search
+from .jobs import TASKS, check_kwargs, get_result_path, has_permission, submit
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.utils.dateparse import parse_date
+from django.http import (FileResponse, Http404, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotModified,
+                         JsonResponse)
+from django.core.serializers.json import DjangoJSONEncoder
+from django.urls import reverse
+from django.contrib.auth import get_user
+from django.contrib.auth.views import redirect_to_login
+from asgiref.sync import sync_to_async
+from functools import wraps
+from datetime import date
+import json
+import os
 
 
 @login_required
@@ -31,30 +56,167 @@ def collection_success(request):
 class GeneratePdf(View):
     def get(self, request, bill_id, *args, **kwargs):
         # Retrieve the Bill object
-        bill = get_object_or_404(Bill, pk=bill_id)
+        bill = get_object_or_404(bill_document_queryset(), pk=bill_id)
 
-        # Define the context as a dictionary
-        context = {
-            'bill': bill
-        }
-
-        # Render the template with context
-        template = get_template('bill_template.html')
-        html = template.render(context)
+        # Reprints are served from the PDF cache
+        try:
+            pdf = get_bill_pdf(bill)
+        except PdfRenderError:
+            return HttpResponse('Error generating PDF', status=500)
 
-        # Create a response object for the PDF
-        response = HttpResponse(content_type='application/pdf')
+        response = HttpResponse(pdf, content_type='application/pdf')
         response['Content-Disposition'] = 'inline; filename="bill_{}.pdf"'.format(bill.id)
+        return response
+
+@method_decorator(staff_member_required, name='dispatch')
+class GenerateBatchPdf(View):
+    """
+    Many bills in one PDF, selected with ?ids=1,2,3 or all bills of ?date=YYYY-MM-DD.
+    With ?async=1 the PDF is rendered by a background job instead, see submit_job.
+    Staff only: a whole day of bills keeps a pool of renderer processes busy.
+    """
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('ids'):
+            try:
+                bill_ids = [int(bill_id) for bill_id in request.GET['ids'].split(',')]
+            except ValueError:
+                return HttpResponseBadRequest('Invalid bill ids')
+            bill_ids = list(Bill.objects.filter(pk__in=bill_ids).order_by('id').values_list('id', flat=True))
+        elif request.GET.get('date'):
+            try:
+                bill_date = date.fromisoformat(request.GET['date'])
+            except ValueError:
+                return HttpResponseBadRequest('date must be a date as YYYY-MM-DD')
+            bill_ids = list(Bill.objects.filter(date=bill_date).order_by('id').values_list('id', flat=True))
+        else:
+            return HttpResponseBadRequest('Pass ids or date')
+
+        if not bill_ids:
+            return HttpResponse('No bills found', status=404)
 
-        # Generate the PDF
-        pisa_status = pisa.CreatePDF(html, dest=response)
+        if request.GET.get('async') == '1':
+            return job_accepted(submit('bills_pdf', request.user, bill_ids=bill_ids))
 
-        # If an error occurs during PDF generation
-        if pisa_status.err:
+        try:
+            pdf = render_bills_batch(bill_ids)
+        except PdfRenderError:
             return HttpResponse('Error generating PDF', status=500)
 
+        response = HttpResponse(pdf, content_type='application/pdf')
+        response['Content-Disposition'] = 'inline; filename="bills.pdf"'
         return response
 
+def get_date_range(request):
+    """?start=YYYY-MM-DD&end=YYYY-MM-DD, both optional."""
+    dates = {}
+    for param in ('start', 'end'):
+        value = request.GET.get(param)
+        try:
+            # None when malformed, ValueError when well formed but not a date, like 2024-02-30
+            dates[param] = parse_date(value) if value else None
+        except ValueError:
+            dates[param] = None
+        if value and dates[param] is None:
+            raise ValueError(f'{param} must be a date as YYYY-MM-DD')
+    return dates
+
+
+def get_statement_for_request(request, dukandaar_id):
+    """The statement of a dukandaar for the dates of get_date_range."""
+    dukandaar = get_object_or_404(Dukandaar.objects.select_related('area'), pk=dukandaar_id)
+    dates = get_date_range(request)
+    return get_statement(dukandaar, dates['start'], dates['end'])
+
+
+@login_required
+def dukandaar_statement(request, dukandaar_id):
+    try:
+        statement = get_statement_for_request(request, dukandaar_id)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    return JsonResponse({
+        'dukandaar': {'id': statement['dukandaar'].id, 'name': statement['dukandaar'].name,
+                      'area': statement['dukandaar'].area.area_name},
+        'start_date': statement['start_date'],
+        'end_date': statement['end_date'],
+        'opening_balance': statement['opening_balance'],
+        'lines': [line._asdict() for line in statement['lines']],
+        'total_debit': statement['total_debit'],
+        'total_credit': statement['total_credit'],
+        'closing_balance': statement['closing_balance'],
+    })
+
+
+@login_required
+def dukandaar_statement_pdf(request, dukandaar_id):
+    if request.GET.get('async') == '1':
+        try:
+            dates = get_date_range(request)
+        except ValueError as error:
+            return HttpResponse(str(error), status=400)
+        get_object_or_404(Dukandaar, pk=dukandaar_id)
+        return job_accepted(submit('statement_pdf', request.user, dukandaar_id=dukandaar_id,
+                                   start=dates['start'] and dates['start'].isoformat(),
+                                   end=dates['end'] and dates['end'].isoformat()))
+    try:
+        statement = get_statement_for_request(request, dukandaar_id)
+    except ValueError as error:
+        return HttpResponse(str(error), status=400)
+    try:
+        pdf = render_statement_pdf(statement)
+    except PdfRenderError:
+        return HttpResponse('Error generating PDF', status=500)
+    response = HttpResponse(pdf, content_type='application/pdf')
+    response['Content-Disposition'] = 'inline; filename="statement_{}.pdf"'.format(dukandaar_id)
+    return response
+
+def get_route_sheet_areas(request):
+    """Areas of ?area=<id>,<id>... (or the parameter repeated), all areas by default."""
+    values = [value for param in request.GET.getlist('area') for value in param.split(',') if value]
+    areas = Area.objects.order_by('id')
+    if values:
+        areas = areas.filter(pk__in=[int(value) for value in values])
+    return list(areas)
+
+
+@login_required
+def route_sheets(request):
+    """
+    Route sheets of the requested areas as JSON. The sheets generated this
+    morning by generate_route_sheets are served as stored; ?live=1, or an
+    area without a stored sheet, computes it now.
+    """
+    try:
+        areas = get_route_sheet_areas(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid area ID'}, status=400)
+    live = request.GET.get('live') == '1'
+    sheets = []
+    for area in areas:
+        stored = None if live else read_route_sheet(area.id, 'json')
+        sheets.append(json.loads(stored) if stored else get_route_sheet(area))
+    return JsonResponse({'sheets': sheets}, encoder=DjangoJSONEncoder)
+
+
+@login_required
+def route_sheets_pdf(request):
+    """The route sheets of the requested areas in one PDF, see route_sheets."""
+    try:
+        areas = get_route_sheet_areas(request)
+    except ValueError:
+        return HttpResponse('Invalid area ID', status=400)
+    if not areas:
+        return HttpResponse('No areas found', status=404)
+    live = request.GET.get('live') == '1'
+    try:
+        pdfs = [(None if live else read_route_sheet(area.id, 'pdf')) or render_route_sheet_pdf(get_route_sheet(area))
+                for area in areas]
+    except PdfRenderError:
+        return HttpResponse('Error generating PDF', status=500)
+    response = HttpResponse(pdfs[0] if len(pdfs) == 1 else merge_pdfs(pdfs), content_type='application/pdf')
+    response['Content-Disposition'] = 'inline; filename="route_sheets.pdf"'
+    return response
+
 # Custom decorator to check if the user is a superuser
 def superuser_required(view_func):
     def _wrapped_view(request, *args, **kwargs):
@@ -64,34 +226,205 @@ def superuser_required(view_func):
             return HttpResponseForbidden("You do not have permission to access this page.")
     return _wrapped_view
 
-@login_required
-@superuser_required
-def analytics_view(request):
-    context = {}
-    context['sales'] = get_sales_count_comparison()
-    context['revenue'] = get_monthly_revenue_comparison()
-    context['customer'] = get_annual_customer_count_and_trend()
-    context['todaysaleslist'] = get_todays_sales_list()
-    context['topsellinglist'] = get_top_20_products_by_revenue()
+def async_login_required(superuser=False):
+    """
+    login_required (and superuser_required) for async views. The user is
+    loaded from the session off the event loop, then set on the request.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        async def _wrapped_view(request, *args, **kwargs):
+            request.user = await sync_to_async(get_user)(request)
+            if not request.user.is_authenticated:
+                return redirect_to_login(request.get_full_path())
+            if superuser and not request.user.is_superuser:
+                return HttpResponseForbidden("You do not have permission to access this page.")
+            return await view_func(request, *args, **kwargs)
+        return _wrapped_view
+    return decorator
 
-    sales_data = get_last_15_days_sales_data()
+@async_login_required(superuser=True)
+async def analytics_view(request):
+    # The widgets do not depend on each other, so they are computed (or read from the cache) concurrently
+    widgets = await aget_cached_widgets(ANALYTICS_WIDGETS)
+    context = {name: widgets[name] for name in
+               ('sales', 'revenue', 'customer', 'todaysaleslist', 'topsellinglist', 'products_sold', 'ageing')}
 
     # Pass the data as context to the template
+    sales_data = widgets['sales_data']
     context['sale_array'] = sales_data['sale_array']
     context['revenue_array'] = sales_data['revenue_array']
     context['customer_array'] = sales_data['customer_array']
     context['time_array'] = sales_data['time_array']
 
-    spider_data = get_purchase_sell_data_for_chart()
+    spider_data = widgets['spider_data']
     context['indicators'] = spider_data['indicators']
     context['purchase_values'] = spider_data['purchase_values']
     context['sell_values'] = spider_data['sell_values']
 
-    context['products_sold'] = get_sold_products_last_month()
-
     context['user'] = request.user
 
-    return render(request, 'analytics.html', context=context)
+    return await sync_to_async(render)(request, 'analytics.html', context=context)
+
+
+@async_login_required(superuser=True)
+async def analytics_data(request):
+    """Every dashboard widget as JSON, for charts refreshed without reloading the page."""
+    return JsonResponse(await aget_cached_widgets(ANALYTICS_WIDGETS))
+
+
+@login_required
+@superuser_required
+def analytics_cache_stats(request):
+    return JsonResponse(get_analytics_cache_stats())
+
+
+@login_required
+@superuser_required
+def export_csv(request, name):
+    if name not in EXPORTS:
+        return JsonResponse({'error': f'Unknown export {name}'}, status=404)
+    try:
+        dates = get_date_range(request)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    queryset = get_export_queryset(name, start_date=dates['start'], end_date=dates['end'])
+    return stream_csv(name, queryset, f'{name}.csv')
+
+
+@login_required
+@superuser_required
+def receivables_ageing(request):
+    """Dues per dukandaar (or ?group=area) by age; ?format=csv downloads it."""
+    group_by = request.GET.get('group', 'dukandaar')
+    if group_by not in AGEING_GROUPS:
+        return HttpResponse(f'Unknown group {group_by}', status=400)
+    if request.GET.get('format') == 'csv':
+        response = HttpResponse(content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="receivables_ageing_{group_by}.csv"'
+        write_receivables_ageing_csv(response, group_by)
+        return response
+
+    rows = get_receivables_ageing(group_by)
+    # Name columns, without the id
+    columns = AGEING_GROUPS[group_by][1:]
+    context = {
+        'title': 'Receivables ageing',
+        'group_by': group_by,
+        'headers': [AGEING_HEADERS[column] for column in columns],
+        'buckets': [label for _, label, _, _ in AGEING_BUCKETS],
+        'rows': [([row[column] for column in columns], [row[key] for key, _, _, _ in AGEING_BUCKETS], row['total'])
+                 for row in rows],
+        'summary': get_cached_widget('ageing', get_ageing_summary),
+    }
+    return render(request, 'admin/receivables_ageing.html', context=context)
+
+
+@login_required
+@superuser_required
+def slow_endpoints(request):
+    context = {
+        'title': 'Slowest endpoints',
+        'endpoints': get_endpoint_stats(),
+        'sampling': settings.REQUEST_PROFILING_ENABLED,
+        'sample_rate': settings.REQUEST_PROFILING_SAMPLE_RATE,
+    }
+    return render(request, 'admin/slow_endpoints.html', context=context)
+
+
+@async_login_required()
+async def search_view(request):
+    kind = request.GET.get('type', 'dukandaar')
+    if kind not in INDEXES:
+        return JsonResponse({'error': f'Unknown search type {kind}'}, status=400)
+    try:
+        limit = min(int(request.GET.get('limit', 10)), 50)
+    except ValueError:
+        return JsonResponse({'error': 'limit must be a number'}, status=400)
+    # In memory once the index is built; building and refreshing it reads the database
+    results, took_ms = await sync_to_async(search)(kind, request.GET.get('q', ''), limit)
+    return JsonResponse({'results': results, 'took_ms': round(took_ms, 2)})
+
+
+@login_required
+@superuser_required
+def reorder_suggestions(request):
+    """Stock value, sales velocity and reorder suggestions per company (?company=<id> for one)."""
+    company = request.GET.get('company')
+    if company is not None and not company.isdigit():
+        return JsonResponse({'error': 'company must be an id'}, status=400)
+    return JsonResponse({'companies': get_reorder_suggestions(company and int(company))})
+
+
+def job_status_payload(job):
+    payload = {
+        'id': job.id,
+        'task': job.task,
+        'status': job.status,
+        'attempts': job.attempts,
+        'created_at': job.created_at,
+        'finished_at': job.finished_at,
+        'status_url': reverse('job_status', args=[job.id]),
+    }
+    if job.status == Job.SUCCEEDED:
+        payload['result'] = job.result
+        if get_result_path(job):
+            payload['download_url'] = reverse('job_download', args=[job.id])
+    elif job.error:
+        # The last line of the traceback
+        payload['error'] = job.error.strip().splitlines()[-1]
+    return payload
+
+
+def job_accepted(job):
+    """202 response for a just submitted job, pointing at its status."""
+    response = JsonResponse(job_status_payload(job), status=202)
+    response['Location'] = reverse('job_status', args=[job.id])
+    return response
+
+
+def get_job_for_request(request, job_id):
+    job = get_object_or_404(Job, pk=job_id)
+    if not request.user.is_superuser and job.submitted_by_id != request.user.id:
+        raise Http404('No such job')
+    # The submitter may have lost the permission since, e.g. no longer staff
+    if not has_permission(job.task, request.user):
+        raise PermissionDenied
+    return job
+
+
+@login_required
+def submit_job(request, task):
+    """POST a JSON object of the task's arguments; answers 202 with the job and where to poll it."""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST the job arguments'}, status=405)
+    if task not in TASKS:
+        return JsonResponse({'error': f'Unknown task {task}'}, status=404)
+    if not has_permission(task, request.user):
+        return HttpResponseForbidden("You do not have permission to run this job.")
+    try:
+        kwargs = json.loads(request.body or '{}')
+        if not isinstance(kwargs, dict):
+            raise ValueError('Arguments must be a JSON object')
+        check_kwargs(task, kwargs)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    return job_accepted(submit(task, request.user, **kwargs))
+
+
+@login_required
+def job_status(request, job_id):
+    return JsonResponse(job_status_payload(get_job_for_request(request, job_id)))
+
+
+@login_required
+def job_download(request, job_id):
+    job = get_job_for_request(request, job_id)
+    path = get_result_path(job)
+    if path is None or not os.path.exists(path):
+        raise Http404('The job has no file to download')
+    return FileResponse(open(path, 'rb'), content_type=job.result.get('content_type'),
+                        filename=job.result['file'])
 
 
 def index_page(request):
@@ -101,37 +434,38 @@ def index_page(request):
 def redirect_to_admin(request):
     return redirect('/admin/login/')
 
-@login_required
-def get_unpaid_bills(request):
-    dukandaar_id = request.GET.get('dukandaar')
-
-    if not dukandaar_id:
+@async_login_required()
+async def get_unpaid_bills(request):
+    """
+    Unpaid bills of ?dukandaar=<id>, or of several shops with
+    ?dukandaar=<id>,<id>... (or the parameter repeated), in which case they
+    are returned per shop under 'dukandaars'. The ETag is the shops' ledger
+    version, so a matching If-None-Match is answered without touching the
+    bills at all.
+    """
+    values = [value for param in request.GET.getlist('dukandaar') for value in param.split(',') if value]
+    if not values:
         return JsonResponse({'error': 'No dukandaar ID provided'}, status=400)
-
     try:
-        # Ensure the dukandaar exists before filtering bills
-        dukandaar = Dukandaar.objects.get(id=dukandaar_id)
-
-        bills = Bill.objects.filter(dukandaar_id=dukandaar_id, paid=False)
-
-        # Manually constructing the string representation
-        bill_data = [{
-            'id': bill.id,
-            'dukandaar': bill.dukandaar.name,  # Assuming __str__ uses the dukandaar's name
-            'date': bill.date,
-            'total_amount': bill.total_amount,
-            'pending_amount': bill.pending_amount,
-            '__str__': str(bill)  # This will call the __str__() method
-        } for bill in bills]
-
-        if bills.exists():
-            return JsonResponse({'bills': bill_data}, status=200)
-        else:
-            return JsonResponse({'error': 'No unpaid bills found for this dukandaar'}, status=404)
-
-    except Dukandaar.DoesNotExist:
-        return JsonResponse({'error': 'Dukandaar does not exist'}, status=404)
+        dukandaar_ids = sorted({int(value) for value in values})
+    except ValueError:
+        return JsonResponse({'error': 'Invalid dukandaar ID'}, status=400)
 
-    except Exception as e:
-        print(f"Error fetching unpaid bills: {e}")
-        return JsonResponse({'error': 'An error occurred while fetching unpaid bills'}, status=500)
+    versions = await aget_ledger_versions(dukandaar_ids)
+    etag = '"{}"'.format('-'.join(str(versions[key]) for key in [None, *dukandaar_ids]))
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        unpaid = await aget_unpaid_bills_by_dukandaar(dukandaar_ids)
+        if len(values) > 1:
+            response = JsonResponse({'dukandaars': unpaid})
+        elif not unpaid:
+            return JsonResponse({'error': 'Dukandaar does not exist'}, status=404)
+        elif not unpaid[dukandaar_ids[0]]['bills']:
+            response = JsonResponse({'error': 'No unpaid bills found for this dukandaar'}, status=404)
+        else:
+            response = JsonResponse({'bills': unpaid[dukandaar_ids[0]]['bills']})
+    response['ETag'] = etag
+    # Let the browser keep the response but check back every time
+    response['Cache-Control'] = 'private, no-cache'
+    return response
@@ -1,25 +1,51 @@
 $(function($) {
+    // Responses per dukandaar with their ETag. A cached list is shown straight
+    // away and revalidated; the server answers 304 when nothing changed.
+    var unpaidBills = {};
+
+    function renderBills(billDropdown, bills) {
+        var options = '<option value="">Select a bill</option>';
+        bills.forEach(function(bill) {
+            options += '<option value="' + bill.id + '">' + bill.__str__ + '</option>';
+        });
+        billDropdown.html(options);
+    }
+
     $('#id_dukandaar').on('change', function() {
         var dukandaarId = $(this).val();
         var billDropdown = $('#id_bill');
-        console.log("ya")
         if (!dukandaarId) {
             billDropdown.html('<option value="">Select a bill</option>');
             return;
         }
-        console.log(dukandaarId)
+        var cached = unpaidBills[dukandaarId];
+        if (cached) {
+            renderBills(billDropdown, cached.bills);
+        }
         $.ajax({
             url: '/get_unpaid_bills/',  // URL to fetch unpaid bills
             data: {
                 'dukandaar': dukandaarId
             },
-            success: function(data) {
-                console.log(data);
-                var options = '<option value="">Select a bill</option>';
-                data.bills.forEach(function(bill) {
-                    options += '<option value="' + bill.id + '">' + bill.__str__ + '</option>';
-                });
-                billDropdown.html(options);
+            headers: cached ? {'If-None-Match': cached.etag} : {},
+            success: function(data, status, xhr) {
+                if (xhr.status === 304) {
+                    return;
+                }
+                unpaidBills[dukandaarId] = {etag: xhr.getResponseHeader('ETag'), bills: data.bills};
+                if ($('#id_dukandaar').val() === dukandaarId) {
+                    renderBills(billDropdown, data.bills);
+                }
+            },
+            error: function(xhr) {
+                if (xhr.status !== 404) {
+                    return;
+                }
+                // No unpaid bills for this dukandaar
+                unpaidBills[dukandaarId] = {etag: xhr.getResponseHeader('ETag'), bills: []};
+                if ($('#id_dukandaar').val() === dukandaarId) {
+                    renderBills(billDropdown, []);
+                }
             }
         });
     });
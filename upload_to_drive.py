@@ -1,16 +1,17 @@
-from google.oauth2.credentials import Credentials
+import argparse
+
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from google_auth_oauthlib.flow import InstalledAppFlow
-import datetime
-from datetime import datetime
 
-# Define the file to be uploaded and the folder in Google Drive (optional)
+from inventory.backup import GoogleDriveStorage, LocalDirectoryStorage, make_backup, restore
+
+# Define the file to be backed up and the folder in Google Drive
 FILE_PATH = "./db.sqlite3"  # Change this to your file path
 PARENT_FOLDER_ID = "1lxI0aCMO1ilM6S_xGMpoAheMQpdyOov_"
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 service_account_file = './service_account.json'
+# Block hashes of the last snapshot, used to ship only what changed
+STATE_DIR = './backups/state'
 
 
 # Google Drive authentication
@@ -18,27 +19,36 @@ def authenticate_drive():
     creds = service_account.Credentials.from_service_account_file(service_account_file, scopes=SCOPES)
     return creds
 
-# Upload file to Google Drive
-def upload_file():
-    creds = authenticate_drive()
-    service = build('drive', 'v3', credentials=creds)
-    date = str(datetime.now().strftime("%m-%d-%Y"))
-    upload_file_name = 'db.sqlite3-' + date
-    file_metadata = {
-        'name': upload_file_name,
-        'parents': [PARENT_FOLDER_ID]
-    }
-    media = MediaFileUpload(FILE_PATH, mimetype='application/octet-stream')  # You can adjust the mimetype if necessary
-    file = service.files().create(
-        body=file_metadata,
-        media_body=media,
-        fields='id'
-    ).execute()
-
-# Schedule the task for daily upload at 12 AM
+
+def get_storage(local_dir=None):
+    if local_dir:
+        return LocalDirectoryStorage(local_dir)
+    service = build('drive', 'v3', credentials=authenticate_drive())
+    return GoogleDriveStorage(service, PARENT_FOLDER_ID)
+
+
+# Snapshot the database and upload it, a full copy or the changes since the last one
+def upload_file(local_dir=None, full_every=7, keep=4):
+    return make_backup(FILE_PATH, get_storage(local_dir), STATE_DIR, full_every=full_every, keep_chains=keep)
+
+
+# Run daily (cron / task scheduler) at 12 AM, or queue it for the worker: manage.py submit_job backup
 def schedule_task():
     upload_file()
 
+
 if __name__ == '__main__':
-    print("Running upload")
-    schedule_task()
+    parser = argparse.ArgumentParser(description='Back up db.sqlite3 to Google Drive')
+    parser.add_argument('--local', metavar='DIR', help='Keep backups in this directory instead of Drive')
+    parser.add_argument('--full-every', type=int, default=7, help='Take a full copy every N backups')
+    parser.add_argument('--keep', type=int, default=4, help='Number of full backups (with their deltas) to keep')
+    parser.add_argument('--restore', metavar='PATH', help='Rebuild the database into PATH instead of backing up')
+    parser.add_argument('--name', help='Backup to restore, the latest by default')
+    args = parser.parse_args()
+
+    if args.restore:
+        restored = restore(get_storage(args.local), args.restore, args.name)
+        print(f"Restored {restored} to {args.restore}")
+    else:
+        print("Running upload")
+        print("Uploaded", upload_file(args.local, args.full_every, args.keep))